@@ -0,0 +1,209 @@
+from typing import Sequence
+
+import torch
+from torch import Tensor
+
+
+def left_pad(seqs: list[list[int]], pad_token_id: int = 0) -> tuple[Tensor, Tensor]:
+    """Left-pad token sequences into `input_ids` and `attention_mask` of shape [B, T].
+
+    Left padding keeps the last real token of every sequence at position -1, so the
+    final hidden state and next-token logits can be read off with a single index.
+    """
+    max_len = max(len(seq) for seq in seqs)
+    input_ids = torch.full([len(seqs), max_len], pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros([len(seqs), max_len], dtype=torch.long)
+    for i, seq in enumerate(seqs):
+        input_ids[i, max_len - len(seq) :] = torch.as_tensor(seq)
+        attention_mask[i, max_len - len(seq) :] = 1
+
+    return input_ids, attention_mask
+
+
+def token_budget_batches(
+    lengths: Sequence[int],
+    max_tokens: int | None = None,
+    max_batch_size: int | None = None,
+) -> list[list[int]]:
+    """Group row indices into batches of rows with similar lengths.
+
+    Rows are sorted by length, longest first, so that padding is minimal and any
+    out-of-memory error happens on the first batch rather than the last. Rows are
+    then packed greedily while the padded size of the batch, its number of rows times
+    its longest row, stays within `max_tokens`. A row that is longer than the budget
+    on its own gets a batch to itself.
+
+    Callers run each batch and scatter the results back with the returned indices,
+    e.g. `out[batch] = results`, to restore the original row order.
+
+    Args:
+        lengths: The length in tokens of each row.
+        max_tokens: The maximum number of padded tokens per batch, or None for no
+            limit.
+        max_batch_size: The maximum number of rows per batch, or None for no limit.
+
+    Returns:
+        A list of batches, each a list of indices into `lengths`.
+    """
+    assert max_tokens is None or max_tokens > 0, "max_tokens must be positive"
+    assert max_batch_size is None or max_batch_size > 0, "max_batch_size must be >0"
+
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    for i in order:
+        # rows come longest first, so the first row of a batch sets its padded length
+        longest = lengths[batch[0]] if batch else lengths[i]
+        full = (max_batch_size is not None and len(batch) >= max_batch_size) or (
+            max_tokens is not None and (len(batch) + 1) * longest > max_tokens
+        )
+        if batch and full:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    """The number of leading tokens that `a` and `b` have in common."""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def shared_prefix_groups(
+    seqs: Sequence[Sequence[int]],
+    min_prefix_len: int = 32,
+    max_prefix_lens: Sequence[int] | None = None,
+) -> list[tuple[int, list[int]]]:
+    """Group token sequences that start with a long common prefix.
+
+    Sorting the sequences visits them in the order of a depth-first walk of their
+    radix tree, so sequences with a common prefix are adjacent, and the prefix shared
+    by a run of them is the shortest common prefix of neighbors in the run. Runs are
+    grown greedily for as long as that saves recomputing at least as many prefix
+    tokens as it gives up, and the prefix is shared by at least `min_prefix_len`
+    tokens. Every sequence keeps at least its last token out of the prefix, so its
+    final state is still computed, and no more than its `max_prefix_lens` tokens go in
+    the prefix, e.g. to keep states at earlier positions computed too.
+
+    Args:
+        seqs: The token ids of each sequence.
+        min_prefix_len: The shortest prefix worth sharing. If 0 or less, no
+            sequences are grouped.
+        max_prefix_lens: The longest prefix each sequence may share. Defaults to its
+            length minus one.
+
+    Returns:
+        A list of (prefix length, indices into `seqs`) groups covering every
+        sequence. Sequences that share no prefix are in one group of prefix length 0.
+    """
+    if min_prefix_len <= 0 or len(seqs) < 2:
+        return [(0, list(range(len(seqs))))]
+
+    def max_len(i: int) -> int:
+        if max_prefix_lens is None:
+            return len(seqs[i]) - 1
+        return min(len(seqs[i]) - 1, max_prefix_lens[i])
+
+    groups: list[tuple[int, list[int]]] = []
+    unshared: list[int] = []
+
+    def close_run(run: list[int], prefix_len: int):
+        if len(run) > 1:
+            groups.append((prefix_len, run))
+        else:
+            unshared.extend(run)
+
+    order = sorted(range(len(seqs)), key=lambda i: list(seqs[i]))
+    run, prefix_len = [order[0]], max_len(order[0])
+    for i in order[1:]:
+        shared = min(
+            prefix_len, common_prefix_length(seqs[run[-1]], seqs[i]), max_len(i)
+        )
+        # with k rows sharing p tokens we skip (k - 1) * p tokens of computation
+        if (
+            shared >= min_prefix_len
+            and len(run) * shared >= (len(run) - 1) * prefix_len
+        ):
+            run.append(i)
+            prefix_len = shared
+        else:
+            close_run(run, prefix_len)
+            run, prefix_len = [i], max_len(i)
+    close_run(run, prefix_len)
+
+    if unshared:
+        groups.append((0, unshared))
+    return groups
+
+
+def plan_batches(
+    prompts: Sequence[Sequence[int]],
+    min_prefix_len: int = 32,
+    max_tokens: int | None = None,
+    max_batch_size: int | None = None,
+    max_prefix_lens: Sequence[int] | None = None,
+) -> list[tuple[int, list[int]]]:
+    """Plan the batches to run `prompts` in, sharing the KV cache of long prefixes.
+
+    Prompts are grouped by `shared_prefix_groups`, and within each group the rest of
+    the prompts, after the prefix, are packed by `token_budget_batches`.
+
+    Args:
+        prompts: The token ids of each prompt.
+        min_prefix_len: The shortest prefix worth sharing. If 0 or less, no prompts
+            share a prefix.
+        max_tokens: The maximum number of padded tokens per batch, not counting the
+            prefix, or None for no limit.
+        max_batch_size: The maximum number of rows per batch, or None for no limit.
+        max_prefix_lens: The longest prefix each prompt may share, see
+            `shared_prefix_groups`.
+
+    Returns:
+        A list of (prefix length, indices into `prompts`) batches covering every
+        prompt. Each batch starts with the same prefix of that length.
+    """
+    return [
+        (prefix_len, [group[j] for j in batch])
+        for prefix_len, group in shared_prefix_groups(
+            prompts, min_prefix_len, max_prefix_lens
+        )
+        for batch in token_budget_batches(
+            [len(prompts[i]) - prefix_len for i in group], max_tokens, max_batch_size
+        )
+    ]
+
+
+def prefix_inputs(
+    prompts: list[list[int]],
+    prefix_len: int,
+    pad_token_id: int,
+    device: str | torch.device,
+) -> tuple[Tensor, Tensor, Tensor]:
+    """Model inputs for prompts that continue a cached prefix of `prefix_len` tokens.
+
+    The prompts, without the prefix, are left-padded, so the padding sits between the
+    prefix and the rest and is masked out. Position ids are computed from the mask,
+    so each row sees exactly the same positions as it would in a batch of one.
+
+    Returns:
+        input_ids: [B, T] tensor of the left-padded prompts.
+        attention_mask: [B, prefix_len + T] mask of the prefix and the prompts.
+        position_ids: [B, T] position of each token in its full prompt.
+    """
+    input_ids, attention_mask = left_pad(prompts, pad_token_id)
+    input_ids = input_ids.to(device)
+    attention_mask = attention_mask.to(device)
+    position_ids = prefix_len + (attention_mask.cumsum(-1) - 1).clamp(min=0)
+    if prefix_len:
+        attention_mask = torch.cat(
+            [attention_mask.new_ones(len(prompts), prefix_len), attention_mask], 1
+        )
+    return input_ids, attention_mask, position_ids
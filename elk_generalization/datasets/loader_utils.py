@@ -1,4 +1,5 @@
 import random
+import string
 from typing import Any, Literal
 
 from datasets import Dataset, DatasetDict, Split, load_dataset
@@ -69,6 +70,28 @@ def load_templates(
     return [{"template": t, "choices": c} for t, c in class_.quirky_templates.items()]
 
 
+def format_with_spans(
+    template: str, **kwargs
+) -> tuple[str, dict[str, tuple[int, int]]]:
+    """Format `template` like `str.format`, also returning the character span of each
+    field in the result. If a field occurs more than once, its last span is kept."""
+    formatter = string.Formatter()
+    parts, spans, length = [], {}, 0
+    for literal, field, spec, conversion in formatter.parse(template):
+        parts.append(literal)
+        length += len(literal)
+        if field is None:
+            continue
+
+        obj, _ = formatter.get_field(field, (), kwargs)
+        text = formatter.format_field(formatter.convert_field(obj, conversion), spec)
+        spans[field] = (length, length + len(text))
+        parts.append(text)
+        length += len(text)
+
+    return "".join(parts), spans
+
+
 def templatize_quirky_dataset(
     ds: Dataset | DatasetDict,
     ds_name: str,
@@ -83,6 +106,10 @@ def templatize_quirky_dataset(
     Templatize a quirky dataset, producing a dataset with columns
     "statement", "choices", "label", "character", "difficulty",
     "difficulty_quantile", "alice_label", "bob_label".
+    "character_span" is the [start, end) character span of the character's name in
+    the statement, empty if the template doesn't name them, and "statement_end" the
+    end of the last other template field, i.e. of the claim being judged, so that
+    states at those positions can be probed.
 
     Template "single" from the paper corresponds to method="first" and standardize_templates=False.
     "mixture" corresponds to method="random" and standardize_templates=False.
@@ -118,6 +145,17 @@ def templatize_quirky_dataset(
             raise ValueError(f"Unknown method: {method}")
         template, choices = t["template"], t["choices"]
 
-        return {"statement": template.format(**targs), "choices": choices, **ex}
+        statement, spans = format_with_spans(template, **targs)
+        statement_end = max(
+            (end for field, (_, end) in spans.items() if field != "character"),
+            default=len(statement),
+        )
+        return {
+            "statement": statement,
+            "choices": choices,
+            "character_span": spans.get("character", (0, 0)),
+            "statement_end": statement_end,
+            **ex,
+        }
 
     return ds.map(map_fn, batched=False)
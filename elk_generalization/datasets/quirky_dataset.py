@@ -12,14 +12,19 @@ from scipy.special import log_expit as logsigmoid  # type: ignore
 from sklearn.metrics import roc_auc_score
 from tqdm import tqdm
 from transformers import (
-    AutoModelForCausalLM,
     AutoTokenizer,
     PreTrainedModel,
     PreTrainedTokenizer,
     PreTrainedTokenizerFast,
 )
 
-from elk_generalization.utils import assert_type
+from elk_generalization.batching import plan_batches, prefix_inputs
+from elk_generalization.model_utils import (
+    PrefixCache,
+    choice_logits,
+    load_pretrained,
+    repeat_past_key_values,
+)
 
 StatementTemplate = namedtuple("StatementTemplate", ["context", "statement"])
 
@@ -56,11 +61,21 @@ class QuirkyDataset(ABC):
         self,
         model_name: str,
         max_examples: int = 1000,
+        batch_size: int = 32,
+        max_tokens: int | None = 4096,
+        min_prefix_len: int = 32,
+        device: str | None = None,
+        dtype: str = "auto",
     ) -> pd.DataFrame:
         """
         Evaluate the model on the dataset and save the results as huggingface dataset
         If the results already exist, skip the evaluation
 
+        Prompts are run in batches of up to `batch_size` prompts of similar length,
+        holding at most `max_tokens` padded tokens. Prefixes of at least
+        `min_prefix_len` tokens that are shared by several prompts are only run once.
+        The model is loaded on `device` in `dtype`, see `load_pretrained`.
+
         Returns:
             The dataset with the results added as a column, with order preserved
         """
@@ -82,41 +97,55 @@ class QuirkyDataset(ABC):
                 print(f"Loading results from {save_path}")
             return pd.read_json(str(save_path))
 
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            device_map={"": torch.cuda.current_device()},
-            torch_dtype="auto",
-        )
+        model, _ = load_pretrained(model_name, device=device, dtype=dtype)
         tokenizer = AutoTokenizer.from_pretrained(model_name, truncation_side="left")
 
         dataframe = self.dataframe.iloc[:max_examples]
 
-        log_odds = torch.full(
-            [
-                len(dataframe),
-            ],
-            torch.nan,
-            device=model.device,
-            dtype=model.dtype,
-        )
-        for i, example in tqdm(dataframe.iterrows(), total=len(dataframe)):
-            example = assert_type(dict, dict(example))
-            i = assert_type(int, i)
-
-            # either get log odds from prompt or all prompts
-            if "prompt" in example:
-                log_odds[i] = self._get_log_odds(
-                    model,
-                    tokenizer,
-                    example["prompt"],
-                    example["choices"],
+        # either get log odds from prompt or average them over all prompts, so we
+        # flatten all prompts and remember which example each one belongs to
+        example_idxs, prompts, choice_toks = [], [], []
+        for i, example in enumerate(dataframe.to_dict("records")):
+            example_prompts = (
+                [example["prompt"]] if "prompt" in example else example["prompts"]
+            )
+            for prompt_str in example_prompts:
+                prompt, ctoks = self._tokenize(
+                    model, tokenizer, prompt_str, example["choices"]
                 )
-            elif "prompts" in example:
-                example_log_odds = [
-                    self._get_log_odds(model, tokenizer, p, example["choices"])
-                    for p in example["prompts"]
-                ]
-                log_odds[i] = torch.mean(torch.stack(example_log_odds))
+                example_idxs.append(i)
+                prompts.append(prompt)
+                choice_toks.append(ctoks)
+
+        prompt_log_odds = torch.full(
+            [len(prompts)], torch.nan, device=model.device, dtype=torch.float32
+        )
+        # prompts sharing a long prefix, e.g. few-shot demonstrations, reuse its KV
+        # cache, and within each group prompts of similar length are batched together
+        batches = plan_batches(prompts, min_prefix_len, max_tokens, batch_size)
+        prefix_cache = PrefixCache()
+        for prefix_len, batch in tqdm(batches):
+            prompt_log_odds[batch] = self._get_log_odds(
+                model,
+                [prompts[j][prefix_len:] for j in batch],
+                [choice_toks[j] for j in batch],
+                pad_token_id=tokenizer.pad_token_id or 0,
+                prefix_past_key_values=(
+                    prefix_cache.get(model, prompts[batch[0]][:prefix_len], len(batch))
+                    if prefix_len
+                    else None
+                ),
+                prefix_len=prefix_len,
+            )
+
+        example_idxs = torch.as_tensor(example_idxs, device=model.device)
+        counts = torch.bincount(example_idxs, minlength=len(dataframe))
+        log_odds = (
+            torch.zeros(len(dataframe), device=model.device).index_add_(
+                0, example_idxs, prompt_log_odds
+            )
+            / counts
+        )
 
         np_lo = log_odds.cpu().float().numpy()
         dataframe.loc[:, "log_odds"] = np_lo
@@ -138,12 +167,12 @@ class QuirkyDataset(ABC):
         return dataframe
 
     @staticmethod
-    def _get_log_odds(
+    def _tokenize(
         model: PreTrainedModel,
         tokenizer: PreTrainedTokenizer | PreTrainedTokenizerFast,
         prompt_str: str,
         choice_strs: list[str],
-    ) -> torch.Tensor:
+    ) -> tuple[list[int], list[list[int]]]:
         # warn if truncating
         prompt = tokenizer.encode(prompt_str)
         choice_toks = [tokenizer.encode(c) for c in choice_strs]
@@ -157,35 +186,89 @@ class QuirkyDataset(ABC):
                 -model.config.max_position_embeddings + num_completion_toks :
             ]
 
+        return prompt, choice_toks
+
+    @staticmethod
+    def _get_log_odds(
+        model: PreTrainedModel,
+        prompts: list[list[int]],
+        choice_toks: list[list[list[int]]],
+        pad_token_id: int = 0,
+        prefix_past_key_values=None,
+        prefix_len: int = 0,
+    ) -> torch.Tensor:
+        """Get the log odds of the second over the first choice after each prompt.
+
+        Args:
+            model: The model to evaluate.
+            prompts: The token ids of each prompt, without the shared prefix if any.
+            choice_toks: The token ids of the two completions of each prompt.
+            pad_token_id: The token id used for padding.
+            prefix_past_key_values: A KV cache of a prefix that every prompt starts
+                with, repeated for each prompt.
+            prefix_len: The number of tokens in the shared prefix.
+
+        Returns:
+            A [B] tensor of log odds.
+        """
+        input_ids, attention_mask, position_ids = prefix_inputs(
+            prompts, prefix_len, pad_token_id, model.device
+        )
+
+        # we compute log_odds of the whole completion, possibly multiple tokens,
+        # so each completion gets its own row, right-padded to the longest one
+        completions = [ctoks for row in choice_toks for ctoks in row]
+        lengths = torch.as_tensor([len(c) for c in completions], device=model.device)
+        max_len = int(lengths.max())
+        completion_ids = torch.full(
+            [len(completions), max_len], pad_token_id, device=model.device
+        )
+        for i, ctoks in enumerate(completions):
+            completion_ids[i, : len(ctoks)] = torch.as_tensor(ctoks)
+
         with torch.inference_mode():
-            # get model outputs and cache in response to prompt
-            outputs = model(
-                torch.as_tensor([prompt], device=model.device), use_cache=True
+            # get the logits of the first token of both completions and the cache in
+            # response to the prompts. Both are scored at the same position, so the
+            # softmax normalizer cancels in their difference and the logits suffice.
+            first_logits, outputs = choice_logits(
+                model,
+                completion_ids[:, 0].view(-1, 2),
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=prefix_past_key_values,
+                use_cache=True,
             )
-            logprob_output = outputs.logits[0, -1, :].log_softmax(dim=-1)
-            logprobs = logprob_output[[choice_toks[0][0], choice_toks[1][0]]]
-
-            # we compute log_odds of the whole completion, possibly multiple tokens
-            # for each completion, while there are more tokens, get more outputs
-            for j, ctoks in enumerate(choice_toks):
-                cache = outputs.past_key_values
-                input_ids = prompt.copy()
-                for k in range(len(ctoks) - 1):
-                    input_ids.append(ctoks[k])
-                    choice_outputs = model(
-                        torch.as_tensor([input_ids], device=model.device),
-                        past_key_values=cache,
-                        use_cache=True,
-                    )
-                    cache = choice_outputs.past_key_values
-                    # add the logit for the next token
-                    logprobs[j] += choice_outputs.logits.log_softmax(dim=-1)[
-                        0, -1, ctoks[k + 1]
-                    ]
-
-        # softmax adds constant to both, which cancels out, so is unnecessary here
+            logprobs = first_logits.float().flatten()
+
+            # for completions with more tokens, feed all but the last one after the
+            # prompt in a single call that reuses the prompt's cache for both choices
+            if max_len > 1:
+                mask = attention_mask.repeat_interleave(2, dim=0)
+                choice_outputs = model(
+                    completion_ids[:, :-1],
+                    attention_mask=torch.cat(
+                        [mask, mask.new_ones(len(completions), max_len - 1)], 1
+                    ),
+                    position_ids=mask.sum(-1, keepdim=True)
+                    + torch.arange(max_len - 1, device=model.device),
+                    past_key_values=repeat_past_key_values(outputs.past_key_values, 2),
+                )
+                # add the logits for the next tokens, ignoring padding
+                token_logprobs = (
+                    choice_outputs.logits.float()
+                    .log_softmax(dim=-1)
+                    .gather(-1, completion_ids[:, 1:, None])
+                    .squeeze(-1)
+                )
+                is_real = (
+                    torch.arange(1, max_len, device=model.device) < lengths[:, None]
+                )
+                logprobs += token_logprobs.where(is_real, 0.0).sum(-1)
+
         # log(p / (1 - p)) = log(p) - log(1 - p)
-        log_odds = logprobs[1] - logprobs[0]
+        logprobs = logprobs.view(-1, 2)
+        log_odds = logprobs[:, 1] - logprobs[:, 0]
 
         return log_odds
 
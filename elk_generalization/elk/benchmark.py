@@ -0,0 +1,278 @@
+"""Measure the throughput of `extract_hiddens` without downloading any checkpoints.
+
+Randomly initialized GPTNeoX, Llama and Mistral models of a few sizes are built
+locally, together with a byte-level BPE tokenizer trained on a synthetic quirky
+addition dataset generated by `AdditionDataset`. Each model is then run through the
+same code path as `extract_hiddens` (model loading, dataset loading and
+templatization, tokenization and `extract_split`) in its own process, so that peak
+memory is measured per model. Results are printed, and written as JSON with
+--output, e.g.
+
+    python -m elk_generalization.elk.benchmark --archs llama --sizes tiny small \\
+        --output bench.json -- --batch-size 16 --storage float16
+
+Unrecognized arguments, e.g. those after `--`, are passed on to `extract_hiddens`.
+"""
+
+import json
+import multiprocessing as mp
+import random
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from contextlib import ExitStack
+from pathlib import Path
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import (
+    GPTNeoXConfig,
+    GPTNeoXForCausalLM,
+    LlamaConfig,
+    LlamaForCausalLM,
+    MistralConfig,
+    MistralForCausalLM,
+    PreTrainedTokenizerFast,
+)
+
+from elk_generalization.datasets.binary_operation_dataset import AdditionDataset
+from elk_generalization.datasets.loader_utils import load_templates
+from elk_generalization.elk import extract_hiddens
+from elk_generalization.model_utils import parse_layers, set_cpu_threads
+from elk_generalization.profiling import StageTimer
+from elk_generalization.token_cache import cached_tokenize
+
+ARCHS = {
+    "neox": (GPTNeoXConfig, GPTNeoXForCausalLM),
+    "llama": (LlamaConfig, LlamaForCausalLM),
+    "mistral": (MistralConfig, MistralForCausalLM),
+}
+# (hidden size, layers, attention heads) of each model size
+SIZES = {
+    "tiny": (64, 4, 4),
+    "small": (256, 8, 8),
+    "medium": (1024, 16, 16),
+    "large": (2048, 24, 16),
+}
+DATASET_NAME = "quirky_addition_raw"
+RESULTS_FILE = "benchmark.json"
+
+
+def make_config(arch: str, size: str, vocab_size: int):
+    """Get the config of a randomly initialized `arch` model of the given size."""
+    hidden_size, num_layers, num_heads = SIZES[size]
+    kwargs = dict(
+        vocab_size=vocab_size,
+        hidden_size=hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        intermediate_size=4 * hidden_size,
+        max_position_embeddings=1024,
+    )
+    if arch == "mistral":
+        # grouped-query attention, as in Mistral-7B
+        kwargs["num_key_value_heads"] = max(num_heads // 4, 1)
+    return ARCHS[arch][0](**kwargs)
+
+
+def make_dataset(root: Path, num_examples: int, seed: int = 633) -> Path:
+    """Write a quirky addition dataset with validation and test splits of
+    `num_examples` rows each to `root`, in the format of the hub datasets."""
+    path = root / DATASET_NAME
+    if path.exists():
+        return path
+
+    random.seed(seed)
+    # each base example gives one row for Alice and one for Bob
+    dataset = AdditionDataset(working_dir=root, base_examples=num_examples)
+    base_df, transform_kwargs = dataset._generate_base_dataset(num_examples, [])
+    quirky_ds = dataset._transform_base_dataset(base_df, transform_kwargs).shuffle(seed)
+    for i, split in enumerate(["validation", "test"]):
+        quirky_ds.select(
+            range(i * num_examples, min((i + 1) * num_examples, len(quirky_ds)))
+        ).to_json(path / f"{split}.jsonl")
+    return path
+
+
+def make_tokenizer(
+    dataset_path: Path, vocab_size: int = 1024
+) -> PreTrainedTokenizerFast:
+    """Train a byte-level BPE tokenizer on the dataset's templates and operands,
+    like the GPTNeoX tokenizer but much smaller."""
+    corpus = [
+        text
+        for template in load_templates(DATASET_NAME)
+        for text in (template["template"], *template["choices"])
+    ]
+    with open(dataset_path / "validation.jsonl") as f:
+        corpus.extend(
+            " ".join(map(str, json.loads(line)["template_args"].values())) for line in f
+        )
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(
+        corpus,
+        trainers.BpeTrainer(
+            vocab_size=vocab_size,
+            special_tokens=["<|endoftext|>"],
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        ),
+    )
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<|endoftext|>",
+        eos_token="<|endoftext|>",
+    )
+
+
+def get_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Benchmark hidden state extraction on random local models. "
+        "Unrecognized arguments are passed on to extract_hiddens."
+    )
+    parser.add_argument("--archs", nargs="+", choices=list(ARCHS), default=list(ARCHS))
+    parser.add_argument(
+        "--sizes", nargs="+", choices=list(SIZES), default=["tiny", "small"]
+    )
+    parser.add_argument(
+        "--num-examples",
+        type=int,
+        default=1000,
+        help="Number of rows to extract, half of them Alice's and half Bob's",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=Path,
+        default=None,
+        help="Directory to keep the dataset, models and outputs in, defaults to a "
+        "temporary directory",
+    )
+    parser.add_argument(
+        "--output", type=Path, default=None, help="Path to write the results to"
+    )
+    parser.add_argument("--seed", type=int, default=633, help="Random seed")
+    return parser
+
+
+def run_benchmark(
+    model_path: Path, dataset_path: Path, save_path: Path, extract_args: list[str]
+):
+    """Extract the validation split with the model in `model_path` to `save_path`,
+    timing each stage like `extract_hiddens.main` does, and write the measurements to
+    `save_path / RESULTS_FILE`. Meant to run in a fresh process."""
+    args = extract_hiddens.get_parser().parse_args(
+        [
+            "--model",
+            str(model_path),
+            "--dataset",
+            str(dataset_path),
+            "--save-path",
+            str(save_path),
+            "--templatization-method",
+            "first",
+            *extract_args,
+        ]
+    )
+    set_cpu_threads(args.num_threads, args.num_interop_threads)
+    timer = StageTimer(cuda_sync=True)
+
+    with ExitStack() as stack:
+        with timer.stage("load_model"):
+            model, tokenizer = extract_hiddens.load_model(args, stack)
+        dataset = extract_hiddens.load_split(
+            args, "validation", args.max_examples[0], timer
+        )
+        with timer.stage("tokenize"):
+            tokens = cached_tokenize(
+                tokenizer, dataset, args.templatization_method, cache_dir=None
+            )
+
+        start = time.perf_counter()
+        extract_hiddens.extract_split(
+            model,
+            tokenizer,
+            dataset,
+            save_path / "validation",
+            parse_layers(args.layers, model.config.num_hidden_layers),
+            batch_size=args.batch_size,
+            chunk_size=args.chunk_size,
+            max_tokens=args.max_tokens,
+            min_prefix_len=args.min_prefix_len,
+            storage=args.storage,
+            stats_only=args.stats_only,
+            positions=tuple(args.positions),
+            tokens=tokens,
+            timer=timer,
+        )
+        extract_time = time.perf_counter() - start
+
+    num_tokens = int(tokens.lengths.sum())
+    result = dict(
+        num_params=sum(p.numel() for p in model.parameters()),
+        dtype=str(model.dtype),
+        device=str(model.device),
+        num_examples=len(dataset),
+        num_tokens=num_tokens,
+        extract_time=extract_time,
+        examples_per_sec=len(dataset) / extract_time,
+        tokens_per_sec=num_tokens / extract_time,
+        # stage times, token counts and peak memory, as in extract_hiddens' sidecar
+        **timer.summary(),
+    )
+    with open(save_path / RESULTS_FILE, "w") as f:
+        json.dump(result, f)
+
+
+def main(args: Namespace, extract_args: list[str]):
+    if extract_args[:1] == ["--"]:
+        extract_args = extract_args[1:]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or Path(tmp_dir)
+        dataset_path = make_dataset(work_dir, args.num_examples, args.seed)
+        tokenizer = make_tokenizer(dataset_path)
+
+        ctx = mp.get_context("spawn")
+        results = []
+        for arch in args.archs:
+            for size in args.sizes:
+                name = f"{arch}-{size}"
+                model_path = work_dir / "models" / name
+                if not model_path.exists():
+                    torch.manual_seed(args.seed)
+                    config = make_config(arch, size, len(tokenizer))
+                    ARCHS[arch][1](config).save_pretrained(model_path)
+                    tokenizer.save_pretrained(model_path)
+
+                print(f"Benchmarking {name}...")
+                save_path = work_dir / "outputs" / name
+                shutil.rmtree(save_path, ignore_errors=True)
+                proc = ctx.Process(
+                    target=run_benchmark,
+                    args=(
+                        model_path,
+                        dataset_path,
+                        save_path,
+                        ["--max-examples", str(args.num_examples), *extract_args],
+                    ),
+                )
+                proc.start()
+                proc.join()
+                if proc.exitcode != 0:
+                    raise RuntimeError(f"Benchmark of {name} failed")
+
+                with open(save_path / RESULTS_FILE) as f:
+                    result = json.load(f)
+                results.append(dict(model=name, extract_args=extract_args, **result))
+                print(json.dumps(results[-1], indent=2))
+
+    if args.output is not None:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(*get_parser().parse_known_args())
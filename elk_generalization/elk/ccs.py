@@ -2,12 +2,12 @@
 
 import math
 from copy import deepcopy
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field
 from typing import Literal, cast
 
 import torch
 import torch.nn as nn
-from concept_erasure import LeaceFitter
+from concept_erasure import LeaceEraser, LeaceFitter
 from einops import repeat
 from torch import Tensor, optim
 from typing_extensions import override
@@ -93,6 +93,18 @@ class CcsReporter(Classifier):
             if param is not self.scale and param is not self.bias:
                 yield param
 
+    def get_extra_state(self) -> dict:
+        # a LEACE eraser isn't a module, so save it with the state dict ourselves
+        norm = getattr(self, "norm", None)
+        return dict(norm=asdict(norm) if isinstance(norm, LeaceEraser) else None)
+
+    def set_extra_state(self, state: dict):
+        if state["norm"] is not None:
+            self.norm = LeaceEraser(**state["norm"])
+        else:
+            # Burns norms are fit on the data they normalize, so they have no state
+            self.norm = BurnsNorm(scale=self.config.norm == "burns")
+
     def maybe_unsqueeze(self, x: Tensor) -> Tensor:
         if x.ndim == 3:
             return x.unsqueeze(1)
@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
 
+import torch
 from torch import Tensor, nn
 
+from elk_generalization.elk.roc_auc import auroc_or_accuracy
+
 
 class Classifier(ABC, nn.Module):
     @abstractmethod
@@ -15,3 +18,23 @@ class Classifier(ABC, nn.Module):
     @abstractmethod
     def resolve_sign(self, x: Tensor, y: Tensor) -> Tensor:
         pass
+
+
+@torch.no_grad()
+def resolve_signs(reporters: list, x: Tensor, y: Tensor):
+    """Batched `resolve_sign` for linear reporters with a `scale`, one per layer.
+
+    The predictions of all layers are scored with a single on-device AUROC.
+
+    Args:
+        reporters: L reporters, like `MeanDiffReporter` or `LdaReporter`.
+        x: Hiddens of shape [L, n, d].
+        y: Binary labels of shape [n].
+    """
+    weights = torch.stack([r.linear.weight[0] * r.scale for r in reporters])
+    biases = torch.stack([r.linear.bias[0] * r.scale[0] for r in reporters])
+    preds = torch.einsum("lnd,ld->ln", x, weights) + biases[:, None]
+    flips = (auroc_or_accuracy(y, preds) < 0.5).tolist()
+    for reporter, flip in zip(reporters, flips):
+        if flip:
+            reporter.scale.data = -reporter.scale.data
@@ -1,3 +1,5 @@
+from dataclasses import asdict
+
 import torch
 import torch.nn.functional as F
 from concept_erasure import LeaceEraser
@@ -19,6 +21,13 @@ class CrcReporter(Classifier):
     def forward(self, hiddens: Tensor) -> Tensor:
         return self.raw_forward(hiddens).diff(dim=1).squeeze()
 
+    def get_extra_state(self) -> dict | None:
+        # the eraser isn't a module, so save it with the state dict ourselves
+        return None if self.eraser is None else asdict(self.eraser)
+
+    def set_extra_state(self, state: dict | None):
+        self.eraser = None if state is None else LeaceEraser(**state)
+
     def raw_forward(self, hiddens: Tensor) -> Tensor:
         if self.eraser is not None:
             hiddens = self.eraser(hiddens)
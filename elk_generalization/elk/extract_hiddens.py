@@ -1,39 +1,317 @@
-from argparse import ArgumentParser
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import shutil
+from argparse import ArgumentParser, Namespace
+from contextlib import ExitStack
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Any, Callable
 
+import numpy as np
 import torch
 from datasets import Dataset
+from torch import Tensor
 from tqdm.auto import tqdm
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import PreTrainedModel
 
+from elk_generalization.batching import plan_batches, prefix_inputs
 from elk_generalization.datasets.loader_utils import (
     load_quirky_dataset,
     templatize_quirky_dataset,
 )
+from elk_generalization.elk.hidden_stats import (
+    LABEL_COLS,
+    HiddenStats,
+    stats_exist,
+)
+from elk_generalization.elk.hidden_store import (
+    POSITIONS,
+    ROW_FILES,
+    ROW_METADATA,
+    STORAGE_FORMATS,
+    STORE_META,
+    TOKEN_OFFSETS,
+    ChunkManifest,
+    HiddenStore,
+    hiddens_exist,
+    position_store_name,
+    write_view,
+)
+from elk_generalization.model_utils import (
+    PrefixCache,
+    capture_last_states,
+    capture_states,
+    choice_logits,
+    load_pretrained,
+    lora_adapter,
+    parse_layers,
+    repeat_past_key_values,
+    set_cpu_threads,
+)
+from elk_generalization.pipeline import OrderedWriter, prefetch
+from elk_generalization.profiling import StageTimer, merge_timings
+from elk_generalization.token_cache import (
+    StatementTokens,
+    cached_tokenize,
+    tokenize_statements,
+)
+from elk_generalization.utils import DATASET_ABBREVS
 
-warned_about_choices = set()
+METADATA_COLS = ("id", "character", "difficulty_quantile")
+# stage timings, token counts and peak memory of the run that wrote a split
+TIMINGS_FILE = "timings.json"
 
 
-def encode_choice(text, tokenizer):
-    global warned_about_choices
+def resolve_positions(
+    tokens: StatementTokens, chunk: dict[str, list], positions: tuple[str, ...]
+) -> dict[str, list[tuple[int, int]]]:
+    """Resolve each of `positions` to a [start, end) range of prompt tokens per row.
 
-    c_ids = tokenizer.encode(text, add_special_tokens=False)
+    The character offsets recorded by `templatize_quirky_dataset` are mapped to
+    tokens with the offset mapping of a fast tokenizer. "mean" covers the tokens of
+    the statement up to "statement_end", skipping special tokens like BOS.
+    """
+    starts = tokens.row_starts
+    needs_offsets = bool({"statement_end", "character", "mean"} & set(positions))
+    assert (
+        tokens.offset_mapping is not None or not needs_offsets
+    ), "Positions other than the last token need a fast tokenizer"
 
-    # some tokenizers split off the leading whitespace character
-    if tokenizer.decode(c_ids[0]).strip() == "":
-        c_ids = c_ids[1:]
-        assert c_ids == tokenizer.encode(text.lstrip(), add_special_tokens=False)
+    def char_to_token(row: int, char: int) -> int:
+        offsets = tokens.offset_mapping[starts[row] : starts[row + 1]]
+        (matches,) = ((offsets[:, 0] <= char) & (char < offsets[:, 1])).nonzero()
+        assert len(matches), f"Character {char} of row {row} isn't in a token"
+        return int(matches[0])
 
-    c_ids = tuple(c_ids)
-    if len(c_ids) != 1 and c_ids not in warned_about_choices:
-        warned_about_choices.add(c_ids)
-        print(f"Choice should be one token: {c_ids} -> {tokenizer.decode(c_ids)}")
-    return c_ids[0]
+    ranges = {position: [] for position in positions}
+    for i, length in enumerate(tokens.lengths.tolist()):
+        for position in positions:
+            if position == "last":
+                start, end = length - 1, length
+            elif position == "all":
+                start, end = 0, length
+            elif position == "character":
+                char_start, char_end = chunk["character_span"][i]
+                assert char_end > char_start, f"Row {i} doesn't name the character"
+                start = char_to_token(i, char_end - 1)
+                end = start + 1
+            else:
+                end = char_to_token(i, chunk["statement_end"][i] - 1) + 1
+                start = (
+                    int(tokens.special_tokens_mask[starts[i] : starts[i + 1]].argmin())
+                    if position == "mean"
+                    else end - 1
+                )
+            ranges[position].append((start, end))
 
+    return ranges
 
-if __name__ == "__main__":
+
+def select_ranges(
+    token_ranges: dict[str, list[tuple[int, int]]],
+    lengths: list[int],
+    prefix_len: int,
+    device: torch.device,
+) -> Callable[[Tensor], dict[str, Tensor]]:
+    """Make a `capture_states` selector for the token ranges of each position.
+
+    Ranges index the full prompts, while the batch holds the `lengths` tokens of each
+    prompt after the shared prefix, left-padded to the longest of them.
+    """
+    width = max(lengths)
+    rows = torch.arange(len(lengths), device=device)
+    cols = torch.arange(width, device=device)
+    # column in the batch of each prompt's first token, as if there were no prefix
+    shift = torch.as_tensor(lengths, device=device).neg() + width - prefix_len
+
+    selections = {}
+    for position, ranges in token_ranges.items():
+        start, end = (torch.as_tensor(r, device=device) for r in zip(*ranges))
+        assert (start >= prefix_len).all(), "Can't select states inside the prefix"
+        start, end = start + shift, end + shift
+        if position != "all" and (end - start == 1).all():
+            selections[position] = start
+        else:
+            selections[position] = (cols >= start[:, None]) & (cols < end[:, None])
+
+    def select(state: Tensor) -> dict[str, Tensor]:
+        selected = {}
+        for position, idx in selections.items():
+            if position == "all":
+                selected[position] = state[idx]
+            elif idx.ndim == 1:
+                selected[position] = state[rows, idx]
+            else:
+                # masked rather than multiplied, in case padding states aren't finite
+                total = torch.where(idx[..., None], state.float(), 0).sum(1)
+                selected[position] = (total / idx.sum(1, keepdim=True)).to(state.dtype)
+        return selected
+
+    return select
+
+
+@torch.inference_mode()
+def extract_batch(
+    model: PreTrainedModel,
+    prompts: list[list[int]],
+    choice_toks: list[list[int]],
+    layers: list[int],
+    pad_token_id: int = 0,
+    prefix_past_key_values=None,
+    prefix_len: int = 0,
+    ccs: bool = True,
+    token_ranges: dict[str, list[tuple[int, int]]] | None = None,
+    timer: StageTimer | None = None,
+) -> tuple[dict[str, list[Tensor]], list[Tensor], Tensor]:
+    """Run a batch of prompts and gather the states needed for probing.
+
+    Prompts are left-padded and position ids are computed from the attention mask, so
+    each row sees exactly the same positions as it would in a batch of one. Only the
+    requested `layers` are captured, using forward hooks on their blocks.
+
+    If every prompt starts with the same `prefix_len` tokens, pass only the rest of
+    each prompt along with a KV cache of the prefix for each row (see `PrefixCache`).
+    The padding then sits between the prefix and the rest, masked out as usual.
+
+    `token_ranges` maps each of `POSITIONS` to a [start, end) range of tokens of each
+    full prompt (see `resolve_positions`), all of which are gathered in the same
+    forward pass. Defaults to the last token only.
+
+    The prompt and CCS forward passes are timed as the "forward" and "ccs" stages of
+    `timer`, if given.
+
+    Returns:
+        hiddens: For each position, one tensor per layer. That is [B, d], the mean
+            state over each prompt's range, or for "all" [N, d], the states of all
+            N tokens of the batch, prompt by prompt.
+        ccs_hiddens: One [B, 2, d] tensor per layer, the state of each choice token
+            appended to the prompt. Both choices are computed in one forward call
+            that reuses the prompt's KV cache. Empty if `ccs` is False.
+        log_odds: [B] tensor of logit(choice 1) - logit(choice 0) after the prompt.
+    """
+    timer = timer or StageTimer()
+    if token_ranges is None:
+        token_ranges = {
+            "last": [(prefix_len + len(p) - 1, prefix_len + len(p)) for p in prompts]
+        }
+    select = select_ranges(
+        token_ranges, [len(p) for p in prompts], prefix_len, model.device
+    )
+
+    input_ids, attention_mask, position_ids = prefix_inputs(
+        prompts, prefix_len, pad_token_id, model.device
+    )
+
+    # we need the choice logits here, so the whole model has to run, but only the
+    # choices' rows of the unembedding are needed
+    choices = torch.as_tensor(choice_toks, device=model.device)  # [B, 2]
+    with timer.stage("forward"), capture_states(model, layers, select) as states:
+        last_logits, outputs = choice_logits(
+            model,
+            choices,
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=prefix_past_key_values,
+            use_cache=True,
+        )
+        log_odds = last_logits[:, 1] - last_logits[:, 0]
+    hiddens = {
+        position: [states[layer][position] for layer in layers]
+        for position in token_ranges
+    }
+    if not ccs:
+        return hiddens, [], log_odds
+
+    # FOR CCS: Gather hidden states for both choices in a single call by repeating
+    # each prompt's cache twice and appending choice 0 and choice 1 as separate rows.
+    # Only hidden states are needed, so we stop after the deepest requested layer.
+    choice_mask = torch.cat(
+        [attention_mask, attention_mask.new_ones(len(prompts), 1)], 1
+    ).repeat_interleave(2, dim=0)
+    choice_positions = attention_mask.sum(-1, keepdim=True).repeat_interleave(2, dim=0)
+    with (
+        timer.stage("ccs"),
+        capture_last_states(model, layers, stop_early=True) as ccs_states,
+    ):
+        model(
+            choices.reshape(-1, 1),
+            attention_mask=choice_mask,
+            position_ids=choice_positions,
+            past_key_values=repeat_past_key_values(outputs.past_key_values, 2),
+        )
+    ccs_hiddens = [
+        ccs_states[layer].unflatten(0, (len(prompts), 2)) for layer in layers
+    ]
+
+    return hiddens, ccs_hiddens, log_odds
+
+
+@dataclass
+class TokenizedChunk:
+    """The rows start:end of a split, tokenized and grouped into batches."""
+
+    start: int
+    end: int
+    prompts: list[list[int]]
+    choice_toks: list[list[int]]
+    token_ranges: dict[str, list[tuple[int, int]]]
+    labels: dict[str, Tensor]
+    # (prefix length, row indices into the chunk) of each batch
+    batches: list[tuple[int, list[int]]]
+
+
+def prepare_chunk(
+    tokens: StatementTokens,
+    dataset: Dataset,
+    start: int,
+    end: int,
+    positions: tuple[str, ...] = ("last",),
+    min_prefix_len: int = 32,
+    max_tokens: int | None = None,
+    batch_size: int = 1,
+) -> TokenizedChunk:
+    """Gather the tokens of rows start:end of `dataset` and plan the batches to run
+    them in."""
+    chunk = dataset[start:end]
+    chunk_tokens = tokens.select(range(start, end))
+    prompts = chunk_tokens.prompts()
+    token_ranges = resolve_positions(chunk_tokens, chunk, positions)
+    choice_toks = chunk_tokens.choice_ids.tolist()
+    labels = {col: torch.as_tensor(chunk[col.removesuffix("s")]) for col in LABEL_COLS}
+
+    # prompts sharing a long prefix, e.g. few-shot demonstrations, reuse its KV
+    # cache. Within each group we batch prompts of similar length together, and
+    # each row is later written back to its original position.
+    first_tokens = [
+        min(ranges[i][0] for ranges in token_ranges.values())
+        for i in range(len(prompts))
+    ]
+    batches = plan_batches(
+        prompts, min_prefix_len, max_tokens, batch_size, max_prefix_lens=first_tokens
+    )
+    return TokenizedChunk(
+        start, end, prompts, choice_toks, token_ranges, labels, batches
+    )
+
+
+def get_parser() -> ArgumentParser:
     parser = ArgumentParser(description="Process and save model hidden states.")
     parser.add_argument("--model", type=str, help="Name of the HuggingFace model")
+    parser.add_argument(
+        "--adapter",
+        type=str,
+        default=None,
+        help="Hub id or path of a LoRA adapter to apply to --model, which is then its "
+        "base model. A worker keeps one base model loaded for all of its adapters.",
+    )
+    parser.add_argument(
+        "--unmerged-adapter",
+        action="store_true",
+        help="Run the adapter alongside the base weights instead of merging it in",
+    )
     parser.add_argument("--dataset", type=str, help="Name of the HuggingFace dataset")
     parser.add_argument(
         "--character",
@@ -59,6 +337,38 @@ if __name__ == "__main__":
         help="Method to use for standardizing the templates",
     )
     parser.add_argument("--save-path", type=Path, help="Path to save the hidden states")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default=None,
+        help="Device to run the model on, defaults to the current GPU if there is one "
+        "and the CPU otherwise",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        choices=["auto", "float32", "bfloat16", "float16"],
+        default="auto",
+        help="Model dtype. auto is the checkpoint's dtype on GPU and float32 on CPU.",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Dynamically quantize the model's linear layers to int8 (CPU only)",
+    )
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=None,
+        help="Threads per CPU op, e.g. the number of physical cores. With "
+        "--num-shards, each shard uses the cores it's pinned to instead.",
+    )
+    parser.add_argument(
+        "--num-interop-threads",
+        type=int,
+        default=None,
+        help="Threads for running independent CPU ops in parallel",
+    )
     parser.add_argument("--seed", type=int, default=633, help="Random seed")
     parser.add_argument(
         "--max-examples",
@@ -67,128 +377,623 @@ if __name__ == "__main__":
         help="Max examples per split",
         default=[1000, 1000],
     )
+    parser.add_argument(
+        "--layers",
+        nargs="+",
+        help="Layers to extract: indices (3 -1), slices (::2) or depth fractions "
+        "(0.5:1.0). Defaults to all layers.",
+    )
+    parser.add_argument(
+        "--positions",
+        nargs="+",
+        choices=list(POSITIONS),
+        default=["last"],
+        help="Token positions to extract hidden states at, all from the same forward "
+        "pass, each to its own store (see `POSITIONS`). The last token is always "
+        "extracted.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Maximum number of prompts to left-pad and run through the model "
+        "together",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=None,
+        help="Maximum number of padded prompt tokens per batch. Prompts are batched "
+        "with others of similar length, so short prompts get larger batches.",
+    )
+    parser.add_argument(
+        "--min-prefix-len",
+        type=int,
+        default=32,
+        help="Prompts sharing a prefix of at least this many tokens compute its KV "
+        "cache once and reuse it. Set to 0 to disable.",
+    )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        choices=list(STORAGE_FORMATS),
+        default=None,
+        help="Format to store hidden states in, defaults to the model's dtype. int8 "
+        "formats are dequantized to float32 on load; see `HiddenStore` for the "
+        "resulting error bounds.",
+    )
+    parser.add_argument(
+        "--stats-only",
+        action="store_true",
+        help="Don't store hidden states, only the per-layer statistics that mean-diff "
+        "and LDA probes are fit from. Statistics are saved with every chunk, so use a "
+        "large --chunk-size.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1024,
+        help="Number of rows to commit to disk at a time. Interrupted extractions "
+        "resume from the first uncommitted chunk.",
+    )
+    parser.add_argument(
+        "--num-shards",
+        type=int,
+        default=1,
+        help="Number of worker processes, each with its own model replica and a "
+        "disjoint slice of the dataset. Shards are merged in the original row order.",
+    )
+    parser.add_argument(
+        "--views",
+        nargs="+",
+        choices=list(DATASET_ABBREVS),
+        help="Character/difficulty subsets (e.g. A AE BH) to write as index views of "
+        "the extracted splits, in sibling directories of --save-path named after them",
+    )
+    parser.add_argument(
+        "--view-max-examples",
+        type=int,
+        nargs="+",
+        help="Max examples per split in each view",
+    )
     parser.add_argument(
         "--splits",
         nargs="+",
         default=["validation", "test"],
         help="Dataset splits to process",
     )
-    args = parser.parse_args()
-
-    # check if all the results already exist
-    if all((args.save_path / split / "hiddens.pt").exists() for split in args.splits):
-        print(f"Hiddens already exist at {args.save_path}")
-        exit()
-
-    model = AutoModelForCausalLM.from_pretrained(
-        args.model,
-        device_map={"": torch.cuda.current_device()},
-        torch_dtype="auto",
+    parser.add_argument(
+        "--profile-sync",
+        action="store_true",
+        help="Synchronize the GPU at the end of each timed stage, so the timings "
+        "attribute GPU time to the right stage at the cost of some overlap",
     )
-    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    return parser
 
-    assert len(args.max_examples) == len(args.splits)
-    for split, max_examples in zip(args.splits, args.max_examples):
-        root = args.save_path / split
-        root.mkdir(parents=True, exist_ok=True)
-        # skip if the results for this split already exist
-        if (root / "hiddens.pt").exists():
-            print(f"Skipping because '{root / 'hiddens.pt'}' already exists")
-            continue
-
-        print(f"Processing '{split}' split...")
 
+def load_split(
+    args: Namespace, split: str, max_examples: int, timer: StageTimer | None = None
+) -> Dataset:
+    """Load, shuffle and templatize one split of the quirky dataset in `args`."""
+    timer = timer or StageTimer()
+    with timer.stage("load_dataset"):
+        dataset = load_quirky_dataset(
+            args.dataset,
+            character=args.character,
+            max_difficulty_quantile=0.25 if args.difficulty == "easy" else 1.0,
+            min_difficulty_quantile=0.75 if args.difficulty == "hard" else 0.0,
+            split=split,
+        ).shuffle(seed=args.seed)
+    with timer.stage("templatize"):
         dataset = templatize_quirky_dataset(
-            load_quirky_dataset(
-                args.dataset,
-                character=args.character,
-                max_difficulty_quantile=0.25 if args.difficulty == "easy" else 1.0,
-                min_difficulty_quantile=0.75 if args.difficulty == "hard" else 0.0,
-                split=split,
-            ).shuffle(seed=args.seed),
+            dataset,
             ds_name=args.dataset,
             standardize_templates=args.standardize_templates,
             method=args.templatization_method,
         )
-        assert isinstance(dataset, Dataset)
-        try:
-            dataset = dataset.select(range(max_examples))
-        except IndexError:
+    assert isinstance(dataset, Dataset)
+    try:
+        dataset = dataset.select(range(max_examples))
+    except IndexError:
+        print(
+            f"Using all {len(dataset)} examples for {args.dataset}/{split} "
+            f"instead of {max_examples}"
+        )
+
+    return dataset
+
+
+def extract_split(
+    model: PreTrainedModel,
+    tokenizer,
+    dataset: Dataset,
+    root: Path,
+    layers: list[int],
+    batch_size: int = 1,
+    chunk_size: int = 1024,
+    max_tokens: int | None = None,
+    min_prefix_len: int = 32,
+    storage: str | None = None,
+    stats_only: bool = False,
+    positions: tuple[str, ...] = ("last",),
+    tokens: StatementTokens | None = None,
+    timer: StageTimer | None = None,
+):
+    """Extract hidden states, CCS hidden states and LM log odds for `dataset` to `root`.
+
+    `tokens` are the dataset's tokens, e.g. from `cached_tokenize`, and are computed
+    here if not given. Rows are processed in chunks of `chunk_size`. Chunks are
+    batched ahead of the model on a background thread, and the results are written
+    behind it on another.
+    Each finished chunk is flushed to disk and recorded in `root / "progress.json"`,
+    so a rerun after a crash skips the committed chunks. Once every chunk is done the
+    split is finalized into the usual layout, the hidden states are converted to
+    `storage` if given, and the progress files are removed.
+
+    With `stats_only`, no hidden states are stored. Instead their `HiddenStats` are
+    accumulated and written to `root / "stats"`, snapshotting them with each chunk.
+
+    Hidden states are gathered at each of `positions` and written to the store named
+    by `position_store_name`. A prompt only shares a cached prefix with others up to
+    the first token any of its positions need.
+
+    Time spent in each stage, token counts and peak memory are recorded in `timer`
+    and written to `root / TIMINGS_FILE` once the split is done. Only the work done
+    by this call is included, so a resumed extraction reports the resumed part.
+    """
+    # the last token's store is always written, since it marks the split as done
+    positions = ("last", *(p for p in positions if p != "last"))
+    assert not (stats_only and len(positions) > 1), "Stats are of the last token only"
+    root.mkdir(parents=True, exist_ok=True)
+    n, hidden_size = len(dataset), model.config.hidden_size
+    timer = timer or StageTimer()
+    if tokens is None:
+        with timer.stage("tokenize"):
+            tokens = tokenize_statements(tokenizer, dataset)
+    assert len(tokens) == n, "Expected the tokens of every row"
+
+    # per-token states of every row are stored contiguously, so we need the number of
+    # tokens of each row up front
+    token_offsets = tokens.row_starts if "all" in positions else None
+
+    # rows and row shape of each store, with the last token's store written last
+    specs = {"ccs_hiddens": (n, (2, hidden_size))}
+    for position in reversed(positions):
+        num_rows = int(token_offsets[-1]) if position == "all" else n
+        specs[position_store_name(position)] = (num_rows, (hidden_size,))
+
+    manifest = ChunkManifest(
+        root / "progress.json",
+        config=dict(
+            num_rows=n,
+            layers=layers,
+            chunk_size=chunk_size,
+            dtype=str(model.dtype),
+            ids=hashlib.md5("".join(dataset["id"]).encode()).hexdigest(),
+            stats_only=stats_only,
+            positions=list(positions),
+        ),
+    )
+    log_odds_path = root / "lm_log_odds.partial.npy"
+    stats_path = root / "stats.partial"
+    stores: dict[str, HiddenStore] = {}
+    stats = None
+    if manifest.done and stats_only:
+        stats = HiddenStats.load(stats_path, device=model.device)
+        committed = sum(end - start for start, end in manifest.done)
+        if stats.num_rows != committed:
+            # the run stopped after saving the statistics of a chunk but before
+            # recording it as done, and its rows can't be taken out of them again
             print(
-                f"Using all {len(dataset)} examples for {args.dataset}/{split} "
-                f"instead of {max_examples}"
+                f"Statistics of {stats.num_rows} rows don't match the {committed} "
+                f"committed rows in '{root}', starting over"
             )
+            stats = None
+            manifest.remove()
 
-        buffers = [
-            torch.full(
-                [len(dataset), model.config.hidden_size],
-                torch.nan,
-                device=model.device,
-                dtype=model.dtype,
-            )
-            for _ in range(model.config.num_hidden_layers)
-        ]
-        ccs_buffers = [
-            torch.full(
-                [len(dataset), 2, model.config.hidden_size],
-                torch.nan,
-                device=model.device,
-                dtype=model.dtype,
-            )
-            for _ in range(model.config.num_hidden_layers)
-        ]
-        log_odds = torch.full(
-            [len(dataset)], torch.nan, device=model.device, dtype=model.dtype
+    if manifest.done:
+        print(f"Resuming from {len(manifest.done)} committed chunks in '{root}'")
+        if not stats_only:
+            stores = {name: HiddenStore(root / name, mode="r+") for name in specs}
+        log_odds = np.load(log_odds_path, mmap_mode="r+")
+    else:
+        if stats_only:
+            stats = HiddenStats(layers, hidden_size, device=model.device)
+        else:
+            stores = {
+                name: HiddenStore.create(
+                    root / name,
+                    num_rows,
+                    layers,
+                    row_shape,
+                    model.dtype,
+                    model_layers=model.config.num_hidden_layers,
+                )
+                for name, (num_rows, row_shape) in specs.items()
+            }
+        if token_offsets is not None:
+            np.save(root / TOKEN_OFFSETS, token_offsets)
+        log_odds = np.lib.format.open_memmap(
+            log_odds_path, mode="w+", dtype=np.float32, shape=(n,)
         )
 
-        for i, record in tqdm(enumerate(dataset), total=len(dataset)):
-            assert isinstance(record, dict)
+    def write_batch(
+        rows: np.ndarray,
+        hiddens: dict[str, list[Tensor]],
+        ccs_hiddens: list[Tensor],
+        batch_log_odds: Tensor,
+        batch_labels: dict[str, Tensor],
+    ):
+        with timer.stage("gather"):
+            # Sanity check, here so that the compute loop doesn't wait for the results
+            assert all(
+                state.isfinite().all()
+                for states in hiddens.values()
+                for state in states
+            )
+            assert all(state.isfinite().all() for state in ccs_hiddens)
+            assert batch_log_odds.isfinite().all()
 
-            prompt = tokenizer.encode(record["statement"])
-            choice_toks = [
-                encode_choice(record["choices"][0], tokenizer),
-                encode_choice(record["choices"][1], tokenizer),
-            ]
+            if stats is not None:
+                stats.update(hiddens["last"], batch_labels)
+            else:
+                stores["ccs_hiddens"].write(rows, ccs_hiddens)
+                for position, states in hiddens.items():
+                    store_rows = rows
+                    if position == "all":
+                        store_rows = np.concatenate(
+                            [np.arange(*token_offsets[r : r + 2]) for r in rows]
+                        )
+                    stores[position_store_name(position)].write(store_rows, states)
+            log_odds[rows] = batch_log_odds.float().cpu().numpy()
 
-            with torch.inference_mode():
-                outputs = model(
-                    torch.as_tensor([prompt], device=model.device),
-                    output_hidden_states=True,
-                    use_cache=True,
-                )
+    def commit_chunk(chunk_start: int, chunk_end: int):
+        with timer.stage("save"):
+            # make sure the chunk is on disk before recording it as done
+            if stats is not None:
+                stats.save(stats_path)
+            for store in stores.values():
+                store.flush()
+            log_odds.flush()
+            manifest.commit(chunk_start, chunk_end)
+
+    chunks = [(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+    todo = [(start, end) for start, end in chunks if not manifest.is_done(start, end)]
+    prefix_cache = PrefixCache()
+    pbar = tqdm(total=n, initial=n - sum(end - start for start, end in todo))
 
-                # FOR CCS: Gather hidden states for each of the two choices
-                ccs_outputs = [
-                    model(
-                        torch.as_tensor([[choice]], device=model.device),
-                        output_hidden_states=True,
-                        past_key_values=outputs.past_key_values,
-                    ).hidden_states[1:]
-                    for choice in choice_toks
-                ]
-                for j, (state1, state2) in enumerate(zip(*ccs_outputs)):
-                    ccs_buffers[j][i, 0] = state1.squeeze()
-                    ccs_buffers[j][i, 1] = state2.squeeze()
-
-                logit1, logit2 = outputs.logits[0, -1, choice_toks]
-                log_odds[i] = logit2 - logit1
-
-                # Extract hidden states of the last token in each layer
-                for j, state in enumerate(outputs.hidden_states[1:]):
-                    buffers[j][i] = state[0, -1, :]
-
-        # Sanity check
-        assert all(buffer.isfinite().all() for buffer in buffers)
-        assert all(buffer.isfinite().all() for buffer in ccs_buffers)
-        assert log_odds.isfinite().all()
+    def prepare(bounds: tuple[int, int]) -> TokenizedChunk:
+        with timer.stage("prepare_chunk"):
+            return prepare_chunk(
+                tokens,
+                dataset,
+                *bounds,
+                positions=positions,
+                min_prefix_len=min_prefix_len,
+                max_tokens=max_tokens,
+                batch_size=batch_size,
+            )
 
+    # Batching runs ahead on one thread and writes trail behind on another, so the
+    # model only waits on them if they can't keep up.
+    with OrderedWriter() as writer:
+        for chunk in prefetch(prepare, todo):
+            for prefix_len, batch in chunk.batches:
+                prefix = chunk.prompts[batch[0]][:prefix_len]
+                lengths = [len(chunk.prompts[i]) for i in batch]
+                timer.count("rows", len(batch))
+                timer.count("batches")
+                timer.count("prompt_tokens", sum(lengths))
+                timer.count("prefix_tokens_reused", prefix_len * (len(batch) - 1))
+                timer.count("padded_tokens", (max(lengths) - prefix_len) * len(batch))
+                hiddens, ccs_hiddens, batch_log_odds = extract_batch(
+                    model,
+                    [chunk.prompts[i][prefix_len:] for i in batch],
+                    [chunk.choice_toks[i] for i in batch],
+                    layers,
+                    pad_token_id=tokenizer.pad_token_id or 0,
+                    prefix_past_key_values=(
+                        prefix_cache.get(model, prefix, len(batch))
+                        if prefix_len
+                        else None
+                    ),
+                    prefix_len=prefix_len,
+                    ccs=not stats_only,
+                    token_ranges={
+                        position: [ranges[i] for i in batch]
+                        for position, ranges in chunk.token_ranges.items()
+                    },
+                    timer=timer,
+                )
+                writer.submit(
+                    write_batch,
+                    chunk.start + np.array(batch),
+                    hiddens,
+                    ccs_hiddens,
+                    batch_log_odds,
+                    {col: y[batch] for col, y in chunk.labels.items()},
+                )
+                pbar.update(len(batch))
+            writer.submit(commit_chunk, chunk.start, chunk.end)
+    pbar.close()
+
+    with timer.stage("save"):
         # Save results to disk for later
         labels = torch.as_tensor(dataset["label"], dtype=torch.int32)
         alice_labels = torch.as_tensor(dataset["alice_label"], dtype=torch.int32)
         bob_labels = torch.as_tensor(dataset["bob_label"], dtype=torch.int32)
-        torch.save(buffers, root / "hiddens.pt")
-        torch.save(ccs_buffers, root / "ccs_hiddens.pt")
         torch.save(labels, root / "labels.pt")
         torch.save(alice_labels, root / "alice_labels.pt")
         torch.save(bob_labels, root / "bob_labels.pt")
-        torch.save(log_odds, root / "lm_log_odds.pt")
+        torch.save(
+            torch.from_numpy(np.array(log_odds)).to(model.dtype),
+            root / "lm_log_odds.pt",
+        )
+        # per-row metadata lets character/difficulty subsets be selected without
+        # re-extracting, see `write_abbrev_views`
+        with open(root / ROW_METADATA, "w") as f:
+            json.dump({col: dataset[col] for col in METADATA_COLS}, f)
+        # the hidden states are marked complete last, since that marks the split as
+        # done
+        if stats is not None:
+            stats.save(root / "stats", final=True)
+            shutil.rmtree(stats_path)
+        elif storage is None:
+            for store in stores.values():
+                store.close()
+        else:
+            for store in stores.values():
+                store.convert(storage)
+
+    log_odds_path.unlink()
+    manifest.remove()
+    timer.save(root / TIMINGS_FILE)
+
+
+def load_model(args: Namespace, stack: ExitStack) -> tuple[PreTrainedModel, Any]:
+    """Load the model, with `args.adapter` active until `stack` is closed."""
+    model, tokenizer = load_pretrained(
+        args.model, device=args.device, dtype=args.dtype, quantize=args.quantize
+    )
+    stack.enter_context(
+        lora_adapter(model, args.adapter, merge=not args.unmerged_adapter)
+    )
+    return model, tokenizer
+
+
+def extract_shard(
+    args: Namespace, split: str, max_examples: int, shard: int, cores: list[int]
+):
+    """Worker process: extract the `shard`-th slice of a split using only `cores`."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    set_cpu_threads(len(cores), args.num_interop_threads)
+
+    root = args.save_path / split / "shards" / str(shard)
+    if hiddens_exist(root) or stats_exist(root):
+        return
+
+    timer = StageTimer(cuda_sync=args.profile_sync)
+    with ExitStack() as stack:
+        with timer.stage("load_model"):
+            model, tokenizer = load_model(args, stack)
+        dataset = load_split(args, split, max_examples, timer)
+        # every shard reads the same cache entry, so the split is only tokenized once
+        with timer.stage("tokenize"):
+            tokens = cached_tokenize(tokenizer, dataset, args.templatization_method)
+        rows = np.array_split(np.arange(len(dataset)), args.num_shards)[shard]
+        extract_split(
+            model,
+            tokenizer,
+            dataset.select(rows),
+            root,
+            parse_layers(args.layers, model.config.num_hidden_layers),
+            batch_size=args.batch_size,
+            chunk_size=args.chunk_size,
+            max_tokens=args.max_tokens,
+            min_prefix_len=args.min_prefix_len,
+            stats_only=args.stats_only,
+            positions=tuple(args.positions),
+            tokens=tokens.select(rows),
+            timer=timer,
+        )
+
+
+def merge_shards(shard_roots: list[Path], root: Path, storage: str | None = None):
+    """Concatenate the outputs of `extract_split` in `shard_roots` into `root`.
+
+    Shards are extracted in the model's dtype and only converted to `storage` once
+    merged, so that quantization scales are computed over all rows.
+    """
+    for name in ROW_FILES:
+        torch.save(
+            torch.cat([torch.load(r / f"{name}.pt") for r in shard_roots]),
+            root / f"{name}.pt",
+        )
+    metadata = {col: [] for col in METADATA_COLS}
+    for r in shard_roots:
+        with open(r / ROW_METADATA) as f:
+            for col, values in json.load(f).items():
+                metadata[col].extend(values)
+    with open(root / ROW_METADATA, "w") as f:
+        json.dump(metadata, f)
+    if (shard_roots[0] / TOKEN_OFFSETS).exists():
+        offsets = [np.load(r / TOKEN_OFFSETS) for r in shard_roots]
+        starts = np.cumsum([0] + [o[-1] for o in offsets[:-1]])
+        np.save(
+            root / TOKEN_OFFSETS,
+            np.concatenate([[0]] + [o[1:] + s for o, s in zip(offsets, starts)]),
+        )
+    if all((r / TIMINGS_FILE).exists() for r in shard_roots):
+        summaries = []
+        for r in shard_roots:
+            with open(r / TIMINGS_FILE) as f:
+                summaries.append(json.load(f))
+        with open(root / TIMINGS_FILE, "w") as f:
+            json.dump(merge_timings(summaries), f, indent=2)
+    # write the hidden states last, since their completion marks the split as done
+    if stats_exist(shard_roots[0]):
+        stats = HiddenStats.load(shard_roots[0] / "stats")
+        for r in shard_roots[1:]:
+            stats.merge(HiddenStats.load(r / "stats"))
+        stats.save(root / "stats", final=True)
+        return
+
+    names = sorted(
+        (p.name for p in shard_roots[0].iterdir() if (p / STORE_META).exists()),
+        key=lambda name: name == "hiddens",
+    )
+    for name in names:
+        merged = HiddenStore.concatenate(
+            root / name, [HiddenStore(r / name) for r in shard_roots]
+        )
+        if storage is not None:
+            merged.convert(storage)
+
+
+def extract_split_sharded(args: Namespace, split: str, max_examples: int):
+    """Extract a split with `args.num_shards` processes, each pinned to its own cores.
+
+    Each shard takes a contiguous slice of the shuffled, templatized split and writes
+    a resumable extraction to `shards/{i}`. The shards are then merged, in order, into
+    the same layout as an unsharded run.
+    """
+    root = args.save_path / split
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    cores = cores or list(range(os.cpu_count() or 1))
+    # with more shards than cores, some shards have to share a core
+    core_groups = [
+        group.tolist() or [cores[shard % len(cores)]]
+        for shard, group in enumerate(np.array_split(cores, args.num_shards))
+    ]
+
+    ctx = mp.get_context("spawn")
+    procs = [
+        ctx.Process(
+            target=extract_shard,
+            args=(args, split, max_examples, shard, core_groups[shard]),
+        )
+        for shard in range(args.num_shards)
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    if any(proc.exitcode != 0 for proc in procs):
+        raise RuntimeError(f"Extraction failed for some shards of '{root}'")
+
+    shard_roots = [root / "shards" / str(shard) for shard in range(args.num_shards)]
+    merge_shards(shard_roots, root, args.storage)
+    shutil.rmtree(root / "shards")
+
+
+def abbrev_rows(
+    metadata: dict[str, list], abbrev: str, max_examples: int | None = None
+) -> list[int]:
+    """Rows of an extraction matching a `DATASET_ABBREVS` character and difficulty.
+
+    Uses the same difficulty quantile bounds as `--difficulty easy/hard`, and keeps
+    the first `max_examples` matches of the (already shuffled) rows.
+    """
+    character, difficulty = DATASET_ABBREVS[abbrev]
+    min_quantile = 0.75 if difficulty == "hard" else 0.0
+    max_quantile = 0.25 if difficulty == "easy" else 1.0
+
+    rows = [
+        i
+        for i, (c, q) in enumerate(
+            zip(metadata["character"], metadata["difficulty_quantile"])
+        )
+        if (character == "none" or c == character) and min_quantile <= q <= max_quantile
+    ]
+    return rows[:max_examples]
+
+
+def write_abbrev_views(args: Namespace, split: str, max_examples: int | None = None):
+    """Write a view of `split` for each abbreviation in `args.views`.
+
+    Views go to `{save_path}/../{abbrev}/{split}`, next to the full extraction, so
+    they can be passed to `transfer.py` like any other extraction directory.
+    """
+    assert (
+        args.character == "none" and args.difficulty == "none"
+    ), "Views can only be taken of an extraction over the full split"
+
+    source = args.save_path / split
+    with open(source / ROW_METADATA) as f:
+        metadata = json.load(f)
+
+    for abbrev in args.views:
+        root = args.save_path.parent / abbrev / split
+        if hiddens_exist(root):
+            continue
+        rows = abbrev_rows(metadata, abbrev, max_examples)
+        print(f"Writing view of {len(rows)} '{abbrev}' rows to '{root}'")
+        write_view(source, root, rows)
+
+
+def main(args: Namespace):
+    view_max_examples = args.view_max_examples or [None] * len(args.splits)
+    assert len(args.max_examples) == len(args.splits) == len(view_max_examples)
+    assert not (args.stats_only and args.views), "Views need stored hidden states"
+    assert not (
+        args.stats_only and args.positions != ["last"]
+    ), "Stats are of the last token only"
+    assert not (
+        args.adapter and args.quantize
+    ), "Adapters can't be applied to quantized models"
+
+    if args.num_shards == 1:
+        set_cpu_threads(args.num_threads, args.num_interop_threads)
+
+    model = tokenizer = None
+    # the adapter stays active until all splits are done
+    with ExitStack() as stack:
+        for split, max_examples, max_view_examples in zip(
+            args.splits, args.max_examples, view_max_examples
+        ):
+            root = args.save_path / split
+            # skip if the results for this split already exist
+            if hiddens_exist(root) or (args.stats_only and stats_exist(root)):
+                print(f"Skipping because the results in '{root}' already exist")
+                if args.views:
+                    write_abbrev_views(args, split, max_view_examples)
+                continue
+
+            print(f"Processing '{split}' split...")
+            if args.num_shards > 1:
+                extract_split_sharded(args, split, max_examples)
+            else:
+                # the model is loaded once, so only the first split includes loading it
+                timer = StageTimer(cuda_sync=args.profile_sync)
+                if model is None:
+                    with timer.stage("load_model"):
+                        model, tokenizer = load_model(args, stack)
+                dataset = load_split(args, split, max_examples, timer)
+                with timer.stage("tokenize"):
+                    tokens = cached_tokenize(
+                        tokenizer, dataset, args.templatization_method
+                    )
+                extract_split(
+                    model,
+                    tokenizer,
+                    dataset,
+                    root,
+                    parse_layers(args.layers, model.config.num_hidden_layers),
+                    batch_size=args.batch_size,
+                    chunk_size=args.chunk_size,
+                    max_tokens=args.max_tokens,
+                    min_prefix_len=args.min_prefix_len,
+                    storage=args.storage,
+                    stats_only=args.stats_only,
+                    positions=tuple(args.positions),
+                    tokens=tokens,
+                    timer=timer,
+                )
+
+            if args.views:
+                write_abbrev_views(args, split, max_view_examples)
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import torch
+from torch import Tensor
+
+STATS_META = "stats.json"
+LABEL_COLS = ("labels", "alice_labels", "bob_labels")
+
+
+class HiddenStats:
+    """Streaming sufficient statistics of hidden states for mean-diff and LDA probes.
+
+    For every layer this keeps the count, mean and scatter matrix (sum of outer
+    products of the centered states) of all rows, updated with Chan et al.'s
+    parallel version of Welford's algorithm, and the per-class sums and counts of the
+    rows for each label column. That is all `MeanDiffReporter` and `LdaReporter`
+    need, since the pooled within-class scatter is the total scatter minus the
+    scatter of the class means. Statistics are accumulated in float64.
+
+    Memory and disk use is O(num_layers * hidden_size^2) regardless of the number of
+    rows, which is less than storing 16-bit hidden states once there are more than
+    about 4 * hidden_size rows.
+    """
+
+    def __init__(
+        self,
+        layers: list[int],
+        hidden_size: int,
+        label_cols: tuple[str, ...] = LABEL_COLS,
+        device: str | torch.device = "cpu",
+    ):
+        self.layers = list(layers)
+        self.hidden_size = hidden_size
+        self.label_cols = tuple(label_cols)
+        self.num_rows = 0
+
+        d, k = hidden_size, len(self.label_cols)
+        kwargs = dict(dtype=torch.float64, device=device)
+        self.means = [torch.zeros(d, **kwargs) for _ in self.layers]
+        self.scatters = [torch.zeros(d, d, **kwargs) for _ in self.layers]
+        self.class_sums = [torch.zeros(k, 2, d, **kwargs) for _ in self.layers]
+        self.class_counts = torch.zeros(k, 2, dtype=torch.int64)
+
+    def __len__(self) -> int:
+        return len(self.layers)
+
+    def update(self, states: list[Tensor], labels: dict[str, Tensor]):
+        """Add a batch of rows.
+
+        Args:
+            states: One [B, d] tensor per layer.
+            labels: A [B] tensor of 0/1 labels for each of `label_cols`.
+        """
+        assert len(states) == len(self.layers), "Expected one tensor per layer"
+        n, b = self.num_rows, len(states[0])
+        onehots = torch.stack(
+            [
+                torch.nn.functional.one_hot(labels[col].long().cpu(), 2)
+                for col in self.label_cols
+            ]
+        )  # [k, B, 2]
+        self.class_counts += onehots.sum(1)
+
+        for idx, state in enumerate(states):
+            x = state.to(self.means[idx].device, torch.float64)
+            batch_mean = x.mean(0)
+            centered = x - batch_mean
+            delta = batch_mean - self.means[idx]
+
+            self.scatters[idx] += centered.T @ centered
+            self.scatters[idx] += delta.outer(delta) * (n * b / (n + b))
+            self.means[idx] += delta * (b / (n + b))
+            self.class_sums[idx] += torch.einsum("kbc,bd->kcd", onehots.to(x), x)
+        self.num_rows += b
+
+    def class_stats(self, idx: int, label_col: str) -> tuple[Tensor, Tensor, Tensor]:
+        """Get the class means, class counts and pooled within-class scatter.
+
+        Returns:
+            means: [2, d] tensor with the mean of the rows labeled 0 and 1.
+            counts: [2] tensor with the number of rows labeled 0 and 1.
+            scatter: [d, d] tensor, the sum over both classes of the outer products
+                of the rows centered at their class mean.
+        """
+        k = self.label_cols.index(label_col)
+        counts = self.class_counts[k].to(self.means[idx].device)
+        means = self.class_sums[idx][k] / counts[:, None]
+        between = means - self.means[idx]
+        scatter = self.scatters[idx] - (between.T * counts) @ between
+        return means, counts, scatter
+
+    def merge(self, other: "HiddenStats") -> "HiddenStats":
+        """Add the rows summarized by `other` to this one, in place."""
+        assert (self.layers, self.hidden_size, self.label_cols) == (
+            other.layers,
+            other.hidden_size,
+            other.label_cols,
+        ), "Can only merge statistics of the same layers and labels"
+
+        n, m = self.num_rows, other.num_rows
+        for idx in range(len(self.layers)):
+            delta = other.means[idx].to(self.means[idx]) - self.means[idx]
+            self.scatters[idx] += other.scatters[idx].to(self.scatters[idx])
+            self.scatters[idx] += delta.outer(delta) * (n * m / max(n + m, 1))
+            self.means[idx] += delta * (m / max(n + m, 1))
+            self.class_sums[idx] += other.class_sums[idx].to(self.class_sums[idx])
+        self.class_counts += other.class_counts
+        self.num_rows += m
+        return self
+
+    def content_hash(self) -> str:
+        """Hash of the statistics, identifying them without reading them again."""
+        h = hashlib.sha256(
+            json.dumps([self.layers, self.label_cols, self.num_rows]).encode()
+        )
+        h.update(self.class_counts.numpy())
+        for tensors in (self.means, self.scatters, self.class_sums):
+            for t in tensors:
+                h.update(t.cpu().contiguous().numpy())
+        return h.hexdigest()
+
+    def save(self, path: str | Path, final: bool = False):
+        """Write the statistics to the directory `path`, replacing it atomically.
+
+        With `final`, their `content_hash` is recorded too. Snapshots of statistics
+        that are still being accumulated skip it, since it reads every statistic.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+
+        for idx, layer in enumerate(self.layers):
+            torch.save(
+                dict(
+                    mean=self.means[idx].cpu(),
+                    scatter=self.scatters[idx].cpu(),
+                    class_sums=self.class_sums[idx].cpu(),
+                ),
+                tmp_path / f"layer_{layer}.pt",
+            )
+        with open(tmp_path / STATS_META, "w") as f:
+            json.dump(
+                dict(
+                    layers=self.layers,
+                    hidden_size=self.hidden_size,
+                    label_cols=list(self.label_cols),
+                    num_rows=self.num_rows,
+                    class_counts=self.class_counts.tolist(),
+                    content_hash=self.content_hash() if final else None,
+                ),
+                f,
+            )
+
+        if path.exists():
+            old_path = path.with_name(path.name + ".old")
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.replace(path, old_path)
+            os.replace(tmp_path, path)
+            shutil.rmtree(old_path)
+        else:
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(
+        cls, path: str | Path, device: str | torch.device = "cpu"
+    ) -> "HiddenStats":
+        path = Path(path)
+        old_path = path.with_name(path.name + ".old")
+        if not path.exists() and old_path.exists():
+            # `save` stopped while swapping in the new statistics, so the old ones
+            # are still the last complete copy
+            os.replace(old_path, path)
+        with open(path / STATS_META) as f:
+            meta = json.load(f)
+
+        stats = cls(meta["layers"], meta["hidden_size"], tuple(meta["label_cols"]))
+        stats.num_rows = meta["num_rows"]
+        stats.class_counts = torch.tensor(meta["class_counts"], dtype=torch.int64)
+        for idx, layer in enumerate(stats.layers):
+            saved = torch.load(path / f"layer_{layer}.pt", map_location=device)
+            stats.means[idx] = saved["mean"]
+            stats.scatters[idx] = saved["scatter"]
+            stats.class_sums[idx] = saved["class_sums"]
+        return stats
+
+
+def stats_exist(root: str | Path) -> bool:
+    """Whether `root` has hidden state statistics written by a stats-only extraction."""
+    return (Path(root) / "stats" / STATS_META).exists()
@@ -0,0 +1,530 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import Tensor
+
+from elk_generalization.elk.hidden_stats import STATS_META
+
+STORE_META = "store.json"
+VIEW_META = "view.json"
+
+# per-row outputs of an extraction that sit next to the hidden stores
+ROW_FILES = ("labels", "alice_labels", "bob_labels", "lm_log_odds")
+ROW_METADATA = "metadata.json"
+
+# token positions that hidden states can be extracted at, each to its own store. All
+# but "all" give one state per row: the last prompt token, the end of the statement,
+# the character's name, or the mean over the statement's tokens. "all" keeps every
+# prompt token, one row per token, with the tokens of row i at rows
+# token_offsets[i]:token_offsets[i + 1] of the store.
+POSITIONS = ("last", "statement_end", "character", "mean", "all")
+TOKEN_OFFSETS = "token_offsets.npy"
+
+# numpy has no bfloat16, so we store its raw bits and reinterpret them on load
+_NUMPY_DTYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+    "bfloat16": np.int16,
+    "int8": np.int8,
+}
+
+# storage formats for `HiddenStore.convert`, as (dtype, quantization)
+STORAGE_FORMATS = {
+    "float32": ("float32", None),
+    "float16": ("float16", None),
+    "bfloat16": ("bfloat16", None),
+    "int8-layer": ("int8", "layer"),
+    "int8-channel": ("int8", "channel"),
+}
+
+
+def position_store_name(position: str) -> str:
+    """Name of the hidden store holding the states at one of `POSITIONS`."""
+    return "hiddens" if position == "last" else f"hiddens_{position}"
+
+
+def _dtype_name(dtype: torch.dtype | str) -> str:
+    return str(dtype).removeprefix("torch.")
+
+
+class HiddenStore:
+    """On-disk hidden states with one contiguous, memory-mapped array per layer.
+
+    A store is a directory containing `store.json` and one `layer_{i}.npy` file per
+    stored layer, each of shape [num_rows, *row_shape]. Rows can be written as they
+    are produced, and the store is marked complete once `close` is called. Readers
+    only map the layers and rows they actually index.
+    Indexing a store with an integer returns that layer as a tensor, so it can be
+    used anywhere a list of per-layer tensors was used before.
+
+    Closing a store records a hash of its contents, which identifies the states
+    without reading them again, e.g. to key cached probes on (see `hash_rows`).
+
+    A complete store can be converted to a smaller storage format with `convert`.
+    Int8 stores keep a float32 `scale_{i}.npy` and `offset_{i}.npy` per layer, with
+    one value per layer or per channel (the last row dimension), and are decoded to
+    float32 on load. Each value is then off by at most half its channel's scale,
+    i.e. 1/508 of the channel's range over all rows. For a linear probe with weights
+    w the score of each row moves by at most delta = sum_c |w_c| * scale_c / 2, so
+    the probe's AUROC can only change through pairs of positive and negative rows
+    whose scores are within 2 * delta of each other, and by at most the fraction of
+    such pairs. float16 and bfloat16 storage likewise bound the relative error of
+    each value by 2^-11 and 2^-8.
+    """
+
+    def __init__(self, path: str | Path, mode: str = "c"):
+        self.path = Path(path)
+        _recover_swap(self.path)
+        with open(self.path / STORE_META) as f:
+            meta = json.load(f)
+
+        self.num_rows: int = meta["num_rows"]
+        self.layers: list[int] = meta["layers"]
+        self.row_shape: tuple[int, ...] = tuple(meta["row_shape"])
+        self.dtype: str = meta["dtype"]
+        self.quantization: str | None = meta.get("quantization")
+        self.complete: bool = meta.get("complete", True)
+        # number of layers of the model, of which `layers` may be a subset
+        self.model_layers: int | None = meta.get("model_layers")
+        # `hash_rows()` of the complete store, recorded by `close`
+        self.content_hash: str | None = meta.get("content_hash")
+        self.mode = mode
+        self._arrays: dict[int, np.ndarray] = {}
+        self._scales: dict[int, tuple[Tensor, Tensor]] = {}
+
+    @classmethod
+    def create(
+        cls,
+        path: str | Path,
+        num_rows: int,
+        layers: list[int],
+        row_shape: tuple[int, ...],
+        dtype: torch.dtype | str,
+        quantization: str | None = None,
+        model_layers: int | None = None,
+    ) -> "HiddenStore":
+        """Create an empty store, preallocating the file for each layer.
+
+        Int8 stores need a `quantization` of "layer" or "channel", and are filled by
+        `convert` rather than `write`. `model_layers` is the number of layers of the
+        model the states are from, so that the stored layers can be placed in it.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        dtype_name = _dtype_name(dtype)
+        if dtype_name not in _NUMPY_DTYPES:
+            raise ValueError(f"Unsupported hidden state dtype: {dtype}")
+        if (dtype_name == "int8") != (quantization in ("layer", "channel")):
+            raise ValueError(
+                f"Quantization {quantization} doesn't match storage dtype {dtype_name}"
+            )
+
+        meta = dict(
+            num_rows=num_rows,
+            layers=list(layers),
+            row_shape=list(row_shape),
+            dtype=dtype_name,
+            quantization=quantization,
+            model_layers=model_layers,
+            complete=False,
+        )
+        for layer in layers:
+            np.lib.format.open_memmap(
+                path / f"layer_{layer}.npy",
+                mode="w+",
+                dtype=_NUMPY_DTYPES[dtype_name],
+                shape=(num_rows, *row_shape),
+            )
+        with open(path / STORE_META, "w") as f:
+            json.dump(meta, f)
+
+        return cls(path, mode="r+")
+
+    @classmethod
+    def concatenate(
+        cls, path: str | Path, stores: list["HiddenStore"]
+    ) -> "HiddenStore":
+        """Create a complete store at `path` holding the rows of `stores` in order.
+
+        Rows are copied one layer at a time, so at most one layer of one input store
+        is paged in at once.
+        """
+        first = stores[0]
+        assert all(
+            (s.layers, s.row_shape, s.dtype)
+            == (first.layers, first.row_shape, first.dtype)
+            for s in stores
+        ), "Can only concatenate stores with the same layers, row shape and dtype"
+        assert first.quantization is None, "Can't concatenate quantized stores"
+
+        out = cls.create(
+            path,
+            sum(s.num_rows for s in stores),
+            first.layers,
+            first.row_shape,
+            first.dtype,
+            model_layers=first.model_layers,
+        )
+        for idx in range(len(out)):
+            start = 0
+            for store in stores:
+                out._array(idx)[start : start + store.num_rows] = store._array(idx)
+                start += store.num_rows
+
+        out.close()
+        return out
+
+    def convert(self, storage: str) -> "HiddenStore":
+        """Rewrite this store in one of `STORAGE_FORMATS`, once all rows are written.
+
+        The converted store is written next to this one, one layer at a time, and
+        then swapped in already marked as complete. Returns the converted store, or
+        this store, unchanged, if it is already in the requested format.
+        """
+        dtype, quantization = STORAGE_FORMATS[storage]
+        if (dtype, quantization) == (self.dtype, self.quantization):
+            return self
+
+        tmp_path = self.path.with_name(self.path.name + ".convert")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        out = HiddenStore.create(
+            tmp_path,
+            self.num_rows,
+            self.layers,
+            self.row_shape,
+            dtype,
+            quantization,
+            model_layers=self.model_layers,
+        )
+        for idx, layer in enumerate(self.layers):
+            states = self.load(idx)
+            if quantization is None:
+                out._write_layer(idx, 0, states.to(getattr(torch, dtype)))
+                continue
+
+            # affine quantization to [-127, 127] over the range of each layer/channel
+            states = states.float()
+            dims = tuple(range(states.ndim - (quantization == "channel")))
+            lo, hi = states.amin(dim=dims), states.amax(dim=dims)
+            offset = (hi + lo) / 2
+            scale = ((hi - lo) / 254).clamp_min(torch.finfo(torch.float32).tiny)
+            quantized = ((states - offset) / scale).round().clamp(-127, 127)
+            out._array(idx)[:] = quantized.to(torch.int8).numpy()
+            np.save(tmp_path / f"scale_{layer}.npy", scale.numpy())
+            np.save(tmp_path / f"offset_{layer}.npy", offset.numpy())
+        out.close()
+
+        # swap the converted store in for this one. If we stop between the two
+        # renames, `_recover_swap` finishes the swap when the store is next opened.
+        self._arrays.clear()
+        old_path = self.path.with_name(self.path.name + ".old")
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(self.path, old_path)
+        os.replace(tmp_path, self.path)
+        shutil.rmtree(old_path)
+        return HiddenStore(self.path, mode=self.mode)
+
+    def __len__(self) -> int:
+        return len(self.layers)
+
+    def __getitem__(self, idx: int) -> Tensor:
+        return self.load(idx)
+
+    def __iter__(self):
+        return (self.load(i) for i in range(len(self)))
+
+    def _array(self, idx: int) -> np.ndarray:
+        layer = self.layers[idx]
+        if layer not in self._arrays:
+            self._arrays[layer] = np.load(
+                self.path / f"layer_{layer}.npy", mmap_mode=self.mode  # type: ignore
+            )
+        return self._arrays[layer]
+
+    def _to_tensor(self, idx: int, array: np.ndarray) -> Tensor:
+        tensor = torch.from_numpy(array)
+        if self.dtype == "bfloat16":
+            tensor = tensor.view(torch.bfloat16)
+        elif self.quantization is not None:
+            scale, offset = self._scale(idx)
+            tensor = tensor.float() * scale + offset
+        return tensor
+
+    def _scale(self, idx: int) -> tuple[Tensor, Tensor]:
+        layer = self.layers[idx]
+        if layer not in self._scales:
+            self._scales[layer] = (
+                torch.from_numpy(np.load(self.path / f"scale_{layer}.npy")),
+                torch.from_numpy(np.load(self.path / f"offset_{layer}.npy")),
+            )
+        return self._scales[layer]
+
+    def load(self, idx: int, rows: slice | Tensor | np.ndarray | None = None) -> Tensor:
+        """Load the `idx`-th stored layer, optionally only the given rows.
+
+        Without `rows` the returned tensor is backed by the memory map and is only
+        paged in as it is read, unless it has to be dequantized to float32.
+        """
+        array = self._array(idx)
+        if rows is not None:
+            if isinstance(rows, Tensor):
+                rows = rows.cpu().numpy()
+            array = np.ascontiguousarray(array[rows])
+        return self._to_tensor(idx, array)
+
+    def write(self, rows: int | np.ndarray, states: list[Tensor]):
+        """Write one [B, *row_shape] tensor per stored layer.
+
+        `rows` is either the first of B consecutive rows, or an array of B row indices.
+        """
+        assert len(states) == len(self.layers), "Expected one tensor per stored layer"
+        for idx, state in enumerate(states):
+            self._write_layer(idx, rows, state)
+
+    def _write_layer(self, idx: int, rows: int | np.ndarray, state: Tensor):
+        assert self.quantization is None, "Quantized stores are written by `convert`"
+        state = state.detach().cpu()
+        if self.dtype == "bfloat16":
+            state = state.view(torch.int16)
+        if isinstance(rows, int):
+            self._array(idx)[rows : rows + len(state)] = state.numpy()
+        else:
+            self._array(idx)[rows] = state.numpy()
+
+    def flush(self):
+        for array in self._arrays.values():
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    def hash_rows(self, rows: list[int] | np.ndarray | None = None) -> str:
+        """Hash of the storage format and the stored states of `rows`, or of every row.
+
+        Rows are read a block at a time, so hashing a view of a large store only
+        pages in the rows of the view.
+        """
+        h = hashlib.sha256(
+            json.dumps(
+                [self.layers, self.row_shape, self.dtype, self.quantization]
+            ).encode()
+        )
+        for idx in range(len(self)):
+            array = self._array(idx)
+            if rows is None:
+                h.update(array)
+            else:
+                for start in range(0, len(rows), 4096):
+                    h.update(np.ascontiguousarray(array[rows[start : start + 4096]]))
+            if self.quantization is not None:
+                for t in self._scale(idx):
+                    h.update(t.numpy())
+        return h.hexdigest()
+
+    def close(self):
+        """Flush all layers, record their hash and mark the store as complete."""
+        self.flush()
+        with open(self.path / STORE_META) as f:
+            meta = json.load(f)
+        meta["content_hash"] = self.content_hash = self.hash_rows()
+        meta["complete"] = self.complete = True
+        with open(self.path / STORE_META, "w") as f:
+            json.dump(meta, f)
+
+
+class ChunkManifest:
+    """Record of which row ranges of an extraction have been committed to disk.
+
+    The manifest is rewritten atomically after each chunk's rows have been flushed,
+    so after a crash it lists exactly the chunks that are safe to keep. A manifest
+    written with a different `config` (e.g. other layers or rows) is ignored.
+    """
+
+    def __init__(self, path: str | Path, config: dict):
+        self.path = Path(path)
+        self.config = config
+        self.done: list[tuple[int, int]] = []
+
+        if self.path.exists():
+            with open(self.path) as f:
+                saved = json.load(f)
+            if saved["config"] == config:
+                self.done = [(start, end) for start, end in saved["done"]]
+
+    def is_done(self, start: int, end: int) -> bool:
+        return (start, end) in self.done
+
+    def commit(self, start: int, end: int):
+        """Mark rows start:end as done. Call only after their data has been flushed."""
+        self.done.append((start, end))
+
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(dict(config=self.config, done=self.done), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        """Forget all committed chunks."""
+        self.done = []
+        self.path.unlink(missing_ok=True)
+
+
+class HiddenStoreView:
+    """A subset of the rows of a `HiddenStore`, indexed like the store itself."""
+
+    def __init__(self, store: HiddenStore, rows: list[int]):
+        self.store = store
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.num_rows = len(self.rows)
+        self.layers = store.layers
+        self.row_shape = store.row_shape
+        self.dtype = store.dtype
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __getitem__(self, idx: int) -> Tensor:
+        return self.load(idx)
+
+    def __iter__(self):
+        return (self.load(i) for i in range(len(self)))
+
+    def load(self, idx: int, rows: slice | Tensor | np.ndarray | None = None) -> Tensor:
+        if isinstance(rows, Tensor):
+            rows = rows.cpu().numpy()
+        return self.store.load(idx, self.rows if rows is None else self.rows[rows])
+
+
+def write_view(source: str | Path, root: str | Path, rows: list[int]):
+    """Make `root` a view of the given rows of the extraction in `source`.
+
+    Only the row indices and the (small) per-row label, log odds and metadata files
+    are written. Hidden states are read from `source` when the view is opened.
+    """
+    source, root = Path(source), Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+
+    for name in ROW_FILES:
+        torch.save(torch.load(source / f"{name}.pt")[rows], root / f"{name}.pt")
+    with open(source / ROW_METADATA) as f:
+        metadata = json.load(f)
+    with open(root / ROW_METADATA, "w") as f:
+        json.dump({k: [v[i] for i in rows] for k, v in metadata.items()}, f)
+
+    # written last, since it marks the view as existing
+    with open(root / VIEW_META, "w") as f:
+        json.dump(dict(source=os.path.relpath(source, root), rows=list(rows)), f)
+
+
+def _recover_swap(path: Path):
+    """Finish a `HiddenStore.convert` that stopped between moving the original store
+    at `path` out of the way and moving the converted one in."""
+    if path.exists():
+        return
+
+    converted = path.with_name(path.name + ".convert")
+    old_path = path.with_name(path.name + ".old")
+    if (converted / STORE_META).exists() and HiddenStore(converted).complete:
+        os.replace(converted, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+    elif old_path.exists():
+        os.replace(old_path, path)
+
+
+def _resolve_view(root: Path) -> tuple[Path, list[int] | None]:
+    """If `root` is a view, return its source directory and rows."""
+    if not (root / VIEW_META).exists():
+        return root, None
+
+    with open(root / VIEW_META) as f:
+        meta = json.load(f)
+    return (root / meta["source"]).resolve(), meta["rows"]
+
+
+def hiddens_exist(root: str | Path, name: str = "hiddens") -> bool:
+    """Whether `root` has complete hidden states called `name` in either format."""
+    root, _ = _resolve_view(Path(root))
+    _recover_swap(root / name)
+    if (root / name / STORE_META).exists():
+        return HiddenStore(root / name).complete
+    return (root / f"{name}.pt").exists()
+
+
+def hiddens_fingerprint(root: str | Path, name: str = "hiddens") -> str:
+    """Hash of the contents of the hidden states called `name` in `root`.
+
+    Copies of the same states share a hash, and any change to them changes it. For a
+    store this is the content hash recorded when it was closed, combined with the
+    rows of a view, so no states are read. Stores without one have the rows they
+    hold hashed, and the statistics of a stats-only extraction use the hash recorded
+    when they were saved. Anything else, like the legacy format, has the name and
+    bytes of every file hashed, which is still much faster than fitting most probes.
+    """
+    root, rows = _resolve_view(Path(root))
+    _recover_swap(root / name)
+    if (root / name / STORE_META).exists():
+        store = HiddenStore(root / name)
+        content_hash = store.content_hash or store.hash_rows(rows)
+        return hashlib.sha256(json.dumps([content_hash, rows]).encode()).hexdigest()
+    if (root / name / STATS_META).exists():
+        with open(root / name / STATS_META) as f:
+            content_hash = json.load(f).get("content_hash")
+        if content_hash:
+            return content_hash
+
+    path = root / name if (root / name).is_dir() else root / f"{name}.pt"
+    files = (
+        sorted(f for f in path.rglob("*") if f.is_file()) if path.is_dir() else [path]
+    )
+    h = hashlib.sha256(json.dumps(rows).encode())
+    for file in files:
+        h.update(f"{file.relative_to(root)}:{file.stat().st_size}\n".encode())
+        with open(file, "rb") as f:
+            while chunk := f.read(1 << 24):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def stored_layers(root: str | Path, name: str = "hiddens") -> list[int] | None:
+    """The model layers held by the hidden store `name` in `root`, if there is one."""
+    root, _ = _resolve_view(Path(root))
+    _recover_swap(root / name)
+    if (root / name / STORE_META).exists():
+        return HiddenStore(root / name).layers
+    return None
+
+
+def model_layers(root: str | Path, name: str = "hiddens") -> int | None:
+    """The number of layers of the model whose states are in `root`, if recorded."""
+    root, _ = _resolve_view(Path(root))
+    _recover_swap(root / name)
+    if (root / name / STORE_META).exists():
+        return HiddenStore(root / name).model_layers
+    return None
+
+
+def open_hiddens(
+    root: str | Path, name: str = "hiddens"
+) -> HiddenStore | HiddenStoreView | list[Tensor]:
+    """Open the hidden states called `name` in `root`.
+
+    Views written by `write_view` are resolved to their source store. Falls back to
+    the legacy format, a `torch.save`d list of per-layer tensors, for directories
+    extracted before hidden stores were introduced.
+    """
+    root, rows = _resolve_view(Path(root))
+    _recover_swap(root / name)
+    if (root / name / STORE_META).exists():
+        assert rows is None or name != position_store_name(
+            "all"
+        ), "Views of per-token hidden states aren't supported"
+        store = HiddenStore(root / name)
+        return store if rows is None else HiddenStoreView(store, rows)
+
+    assert rows is None, "Views of legacy hidden state files aren't supported"
+    return torch.load(root / f"{name}.pt")
@@ -1,9 +1,10 @@
 import torch
 from concept_erasure.shrinkage import optimal_linear_shrinkage
-from sklearn.metrics import accuracy_score, roc_auc_score
 from torch import Tensor, nn
+from torch.nn.functional import one_hot
 
-from elk_generalization.elk.classifier import Classifier
+from elk_generalization.elk.classifier import Classifier, resolve_signs
+from elk_generalization.elk.roc_auc import auroc_or_accuracy
 
 
 class LdaReporter(Classifier):
@@ -40,18 +41,41 @@ class LdaReporter(Classifier):
         self.linear.weight.data = w.mT.to(self.linear.weight.dtype)
 
     def fit(self, x: Tensor, y: Tensor):
-        x0, x1 = x[y == 0], x[y == 1]
-        mu0, mu1 = x0.mean(dim=0), x1.mean(dim=0)
+        """Fit on the hiddens of one layer, see `lda_directions`."""
+        w = lda_directions(*class_stats(x[None], y))[0]
 
-        # Within-class covariance
-        cov0 = x0.mT.cov()
-        cov1 = x1.mT.cov()
+        self.linear.weight.data = w[None].to(self.linear.weight.dtype)
 
-        S = (len(x0) * cov0 + len(x1) * cov1) / len(x)
-        precision = torch.linalg.pinv(S)
-        w = precision @ (mu1 - mu0)
+    @classmethod
+    def fit_layers(cls, x: Tensor, y: Tensor) -> list["LdaReporter"]:
+        """Fit and sign-resolve one reporter per layer, all at once.
 
-        self.linear.weight.data = w[None].to(self.linear.weight.dtype)
+        Equivalent to calling `fit` and `resolve_sign` on each layer, but with
+        batched matmuls and Cholesky factorizations.
+
+        Args:
+            x: Hiddens of shape [L, n, d].
+            y: Binary labels of shape [n], shared by all layers.
+        """
+        assert x.ndim == 3, "x must have shape [L, n, d]"
+        directions = lda_directions(*class_stats(x, y))
+
+        reporters = [cls(x.shape[-1], device=x.device, dtype=x.dtype) for _ in x]
+        for reporter, w in zip(reporters, directions):
+            reporter.linear.weight.data = w[None].to(x.dtype)
+        resolve_signs(reporters, x, y)
+        return reporters
+
+    def fit_from_stats(self, means: Tensor, counts: Tensor, scatter: Tensor):
+        """Fit from class statistics, e.g. from `HiddenStats.class_stats`.
+
+        Equivalent to `fit` on the summarized rows. Since the covariance estimate is
+        positive semi-definite, the class 1 mean always scores at least as high as
+        the class 0 mean, so the sign needs no resolving.
+        """
+        w = lda_directions(means[None], counts, scatter[None])[0]
+
+        self.linear.weight.data = w[None].to(self.linear.weight)
 
     @torch.no_grad()
     def resolve_sign(
@@ -60,11 +84,55 @@ class LdaReporter(Classifier):
         y: Tensor,
     ):
         """Flip the scale term if AUROC < 0.5. Use acc if all labels are the same."""
-        y = y.cpu().numpy()
-        preds = self.forward(x).cpu().numpy()
-        if len(set(y)) == 1:
-            auroc = accuracy_score(y, preds > 0)
-        else:
-            auroc = roc_auc_score(y, preds)
-        if float(auroc) < 0.5:
+        if float(auroc_or_accuracy(y, self.forward(x))) < 0.5:
             self.scale.data = -self.scale.data
+
+
+def class_stats(x: Tensor, y: Tensor) -> tuple[Tensor, Tensor, Tensor]:
+    """Batched version of `HiddenStats.class_stats`, computed from the rows.
+
+    Args:
+        x: Hiddens of shape [L, n, d].
+        y: Binary labels of shape [n].
+
+    Returns:
+        means: [L, 2, d] tensor with the mean of the rows labeled 0 and 1.
+        counts: [2] tensor with the number of rows labeled 0 and 1.
+        scatter: [L, d, d] tensor, the pooled within-class scatter.
+    """
+    y = y.to(x.device).long()
+    counts = torch.bincount(y, minlength=2).to(x.dtype)
+    means = torch.einsum("nc,lnd->lcd", one_hot(y, 2).to(x.dtype) / counts, x)
+    # centering first is more precise than subtracting the means' outer products
+    centered = x - means[:, y]
+    return means, counts, centered.mT @ centered
+
+
+def lda_directions(means: Tensor, counts: Tensor, scatter: Tensor) -> Tensor:
+    """Get the LDA directions Σ⁻¹ (μ1 - μ0) of a batch of layers.
+
+    Σ is the pooled within-class covariance, inverted with a Cholesky factorization.
+    Where Σ is singular, e.g. with fewer rows than dimensions, it's first shrunk
+    towards a multiple of the identity with `optimal_linear_shrinkage`, and only
+    if even that fails, e.g. for constant hiddens, the pseudo-inverse is used.
+
+    Args:
+        means: [L, 2, d] class means.
+        counts: [2] class counts.
+        scatter: [L, d, d] pooled within-class scatter.
+
+    Returns:
+        [L, d] tensor of directions.
+    """
+    n = int(counts.sum())
+    cov = scatter / (n - 2)
+    diff = (means[:, 1] - means[:, 0]).unsqueeze(-1)
+
+    chol, info = torch.linalg.cholesky_ex(cov)
+    if (info > 0).any():
+        shrunk = optimal_linear_shrinkage(cov[info > 0], n)
+        chol[info > 0], info[info > 0] = torch.linalg.cholesky_ex(shrunk)
+    w = torch.cholesky_solve(diff, chol)
+    if (info > 0).any():
+        w[info > 0] = torch.linalg.pinv(cov[info > 0]) @ diff[info > 0]
+    return w.squeeze(-1)
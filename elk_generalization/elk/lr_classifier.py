@@ -1,3 +1,5 @@
+from typing import Literal
+
 import torch
 from torch import Tensor
 from torch.nn.functional import binary_cross_entropy_with_logits as bce_with_logits
@@ -5,6 +7,12 @@ from torch.nn.functional import cross_entropy
 
 from elk_generalization.elk.classifier import Classifier
 
+Solver = Literal["auto", "lbfgs", "newton", "dual"]
+
+# largest number of parameters for which "auto" picks a second order solver, whose
+# float64 Hessian then takes 512MB
+MAX_NEWTON_DIM = 8192
+
 
 class LogisticRegression(Classifier):
     """Linear classifier trained with supervised learning."""
@@ -38,8 +46,9 @@ class LogisticRegression(Classifier):
         *,
         l2_penalty: float = 0.001,
         max_iter: int = 10_000,
+        solver: Solver = "auto",
     ) -> float:
-        """Fits the model to the input data using L-BFGS with L2 regularization.
+        """Fits the model to the input data with L2 regularization.
 
         Args:
             x: Input tensor of shape (N, D), where N is the number of samples and D is
@@ -47,18 +56,39 @@ class LogisticRegression(Classifier):
             y: Target tensor of shape (N,) for binary classification or (N, C) for
                 multiclass classification, where C is the number of classes.
             l2_penalty: L2 regularization strength.
-            max_iter: Maximum number of iterations for the L-BFGS optimizer.
+            max_iter: Maximum number of iterations of the solver.
+            solver: "lbfgs" for L-BFGS, "newton" for Newton's method on the D + 1
+                parameters, or "dual" for Newton's method in the at most N dimensional
+                span of the samples, see `fit_binary_newton`. The second order
+                solvers are for binary classification only, and reach the optimum in
+                a few dozen passes over the data rather than thousands. "auto" picks
+                one of them by shape, see `choose_solver`.
 
         Returns:
             Final value of the loss function after optimization.
         """
+        num_classes = self.linear.out_features
+        if solver == "auto":
+            solver = choose_solver(*x.shape, num_classes=num_classes)
+        if solver != "lbfgs":
+            assert num_classes == 1, f"The {solver} solver is for binary labels only"
+            weight, bias, loss = fit_binary_newton(
+                x,
+                y,
+                l2_penalty=l2_penalty,
+                max_iter=max_iter,
+                dual=solver == "dual",
+            )
+            self.linear.weight.data = weight[None].to(self.linear.weight)
+            self.linear.bias.data = bias[None].to(self.linear.bias)
+            return loss
+
         optimizer = torch.optim.LBFGS(
             self.parameters(),
             line_search_fn="strong_wolfe",
             max_iter=max_iter,
         )
 
-        num_classes = self.linear.out_features
         loss_fn = bce_with_logits if num_classes == 1 else cross_entropy
         loss = torch.inf
         y = y.to(
@@ -83,6 +113,314 @@ class LogisticRegression(Classifier):
         optimizer.step(closure)
         return float(loss)
 
+    @classmethod
+    def fit_layers(
+        cls,
+        x: Tensor,
+        y: Tensor,
+        *,
+        l2_penalty: float = 0.001,
+        max_iter: int = 10_000,
+        solver: Solver = "auto",
+    ) -> list["LogisticRegression"]:
+        """Fit one binary classifier per layer.
+
+        With L-BFGS all layers are fit at once, see `fit_binary_lbfgs`. The Hessians
+        of the second order solvers are too big to batch, so those fit one layer at
+        a time.
+
+        Args:
+            x: Input tensor of shape (L, N, D), where L is the number of layers.
+            y: Binary target tensor of shape (N,), shared by all layers.
+            l2_penalty: L2 regularization strength.
+            max_iter: Maximum number of iterations for each layer.
+            solver: The solver, as in `fit`.
+
+        Returns:
+            A classifier for each layer, on the device and with the dtype of `x`.
+        """
+        if solver == "auto":
+            solver = choose_solver(*x.shape[1:])
+        if solver == "lbfgs":
+            weights, biases = fit_binary_lbfgs(
+                x, y, l2_penalty=l2_penalty, max_iter=max_iter
+            )
+        else:
+            fits = [
+                fit_binary_newton(
+                    layer_x,
+                    y,
+                    l2_penalty=l2_penalty,
+                    max_iter=max_iter,
+                    dual=solver == "dual",
+                )
+                for layer_x in x
+            ]
+            weights = [weight.to(x.dtype) for weight, _, _ in fits]
+            biases = [bias.to(x.dtype) for _, bias, _ in fits]
+
+        reporters = []
+        for weight, bias in zip(weights, biases):
+            reporter = cls(x.shape[-1], device=x.device, dtype=x.dtype)
+            reporter.linear.weight.data = weight[None]
+            reporter.linear.bias.data = bias[None]
+            reporters.append(reporter)
+        return reporters
+
     def resolve_sign(self, x: Tensor, y: Tensor) -> None:
         # the sign has already been resolved for logistic regression
         pass
+
+
+@torch.no_grad()
+def fit_binary_lbfgs(
+    x: Tensor,
+    y: Tensor,
+    *,
+    l2_penalty: float = 0.001,
+    max_iter: int = 10_000,
+    history_size: int = 100,
+    tolerance_grad: float = 1e-7,
+    tolerance_change: float = 1e-9,
+    max_ls: int = 25,
+) -> tuple[Tensor, Tensor]:
+    """Fit a batch of independent binary logistic regressions with L-BFGS.
+
+    Minimizes the same objective as `LogisticRegression.fit`, the mean BCE loss plus
+    `l2_penalty` times the squared norm of the weights, for each of the L problems.
+    The problems are solved together as one block-diagonal problem: every iteration
+    evaluates the loss and gradient of all of them with one batched matmul, but each
+    problem has its own L-BFGS history, step size and convergence test, with the same
+    tolerances as `torch.optim.LBFGS`. Converged problems are masked out of later
+    iterations, so a batch costs about as much as its slowest problem.
+
+    Steps are chosen by backtracking until the Armijo condition holds, rather than
+    with a strong Wolfe line search. Curvature pairs that would make the inverse
+    Hessian estimate indefinite are skipped.
+
+    Args:
+        x: Input tensor of shape (L, N, D).
+        y: Binary target tensor of shape (N,).
+        l2_penalty: L2 regularization strength.
+        max_iter: Maximum number of iterations.
+        history_size: Number of curvature pairs to keep.
+        tolerance_grad: A problem has converged when the largest entry of its
+            gradient is at most this.
+        tolerance_change: A problem has converged when its step or loss changes by
+            less than this.
+        max_ls: Maximum number of halvings of the step size.
+
+    Returns:
+        Weights of shape (L, D) and biases of shape (L,).
+    """
+    num_layers, n, d = x.shape
+    y = y.to(x.dtype)
+
+    def loss_and_grad(x: Tensor, params: Tensor) -> tuple[Tensor, Tensor]:
+        w, b = params[:, :-1], params[:, -1]
+        logits = torch.baddbmm(b[:, None, None], x, w[:, :, None]).squeeze(-1)
+        loss = bce_with_logits(logits, y.expand_as(logits), reduction="none").mean(-1)
+        resid = (logits.sigmoid() - y) / n
+        grad_w = torch.bmm(resid[:, None], x).squeeze(1)
+        if l2_penalty:
+            loss += l2_penalty * w.square().sum(-1)
+            grad_w += 2 * l2_penalty * w
+        return loss, torch.cat([grad_w, resid.sum(-1, keepdim=True)], dim=-1)
+
+    # the bias is the last parameter
+    params = x.new_zeros(num_layers, d + 1)
+    loss, grad = loss_and_grad(x, params)
+    active = grad.abs().amax(-1) > tolerance_grad
+
+    # curvature pairs (s, y, 1 / y.s) of every layer, zero where a pair was skipped
+    history: list[tuple[Tensor, Tensor, Tensor]] = []
+    hess_diag = x.new_ones(num_layers)
+    # the first step is scaled like in `torch.optim.LBFGS`
+    init_step = grad.abs().sum(-1).reciprocal().clamp(max=1)
+
+    layers, x_active = None, x
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        # only slice the inputs again when a layer has converged
+        if layers is None or len(layers) != int(active.sum()):
+            layers = active.nonzero().squeeze(-1)
+            x_active = x if len(layers) == num_layers else x[layers]
+
+        # two-loop recursion for the L-BFGS direction
+        g = grad[layers]
+        direction = -g
+        alphas = []
+        for s_k, y_k, rho_k in reversed(history):
+            alpha = rho_k[layers] * (s_k[layers] * direction).sum(-1)
+            direction -= alpha[:, None] * y_k[layers]
+            alphas.append(alpha)
+        direction *= hess_diag[layers, None]
+        for (s_k, y_k, rho_k), alpha in zip(history, reversed(alphas)):
+            beta = rho_k[layers] * (y_k[layers] * direction).sum(-1)
+            direction += (alpha - beta)[:, None] * s_k[layers]
+        gtd = (g * direction).sum(-1)
+
+        # backtracking line search, only re-evaluating the layers that need it
+        old_params, old_loss = params[layers], loss[layers]
+        step = init_step[layers]
+        new_loss, new_grad = old_loss.clone(), g.clone()
+        # layers without a descent direction don't move
+        pending = gtd <= -tolerance_change
+        step[~pending] = 0
+        for _ in range(max_ls):
+            todo = pending.nonzero().squeeze(-1)
+            if not len(todo):
+                break
+            trial_loss, trial_grad = loss_and_grad(
+                x_active if len(todo) == len(layers) else x_active[todo],
+                old_params[todo] + step[todo, None] * direction[todo],
+            )
+            new_loss[todo], new_grad[todo] = trial_loss, trial_grad
+            accepted = trial_loss <= old_loss[todo] + 1e-4 * step[todo] * gtd[todo]
+            pending[todo[accepted]] = False
+            step[todo[~accepted]] /= 2
+        # give up on layers whose line search failed
+        failed = pending | (gtd > -tolerance_change)
+        step[failed] = 0
+        new_loss[failed], new_grad[failed] = old_loss[failed], g[failed]
+
+        s = step[:, None] * direction
+        y_diff = new_grad - g
+        ys = (y_diff * s).sum(-1)
+        valid = ys > 1e-10
+        params[layers] = old_params + s
+        loss[layers], grad[layers] = new_loss, new_grad
+
+        s_full, y_full = torch.zeros_like(params), torch.zeros_like(params)
+        rho_full = x.new_zeros(num_layers)
+        s_full[layers] = s * valid[:, None]
+        y_full[layers] = y_diff * valid[:, None]
+        rho_full[layers] = torch.where(valid, ys.reciprocal(), 0)
+        history.append((s_full, y_full, rho_full))
+        if len(history) > history_size:
+            history.pop(0)
+        hess_diag[layers] = torch.where(
+            valid, ys / y_diff.square().sum(-1), hess_diag[layers]
+        )
+        init_step[layers] = 1.0
+
+        converged = (
+            failed
+            | (new_grad.abs().amax(-1) <= tolerance_grad)
+            | (s.abs().amax(-1) <= tolerance_change)
+            | ((new_loss - old_loss).abs() < tolerance_change)
+        )
+        active[layers[converged]] = False
+
+    return params[:, :-1], params[:, -1]
+
+
+def choose_solver(n: int, d: int, num_classes: int = 1) -> Solver:
+    """Pick the fastest solver for `n` samples with `d` features.
+
+    Newton's method needs a handful of iterations, each costing a pass over the data
+    to form the Hessian and a Cholesky factorization of it, where L-BFGS needs
+    thousands of cheap passes. So the second order solvers win unless the Hessian is
+    too big, in the space of the features or in the span of the samples, whichever
+    is smaller.
+    """
+    if num_classes > 1 or min(n, d + 1) > MAX_NEWTON_DIM:
+        return "lbfgs"
+    return "dual" if n < d else "newton"
+
+
+@torch.no_grad()
+def fit_binary_newton(
+    x: Tensor,
+    y: Tensor,
+    *,
+    l2_penalty: float = 0.001,
+    max_iter: int = 100,
+    dual: bool = False,
+    tolerance: float = 1e-12,
+) -> tuple[Tensor, Tensor, float]:
+    """Fit a binary logistic regression with Newton's method, also known as IRLS.
+
+    Minimizes the objective of `LogisticRegression.fit`. Each step solves the Newton
+    system with a Cholesky factorization of the Hessian and is shortened by
+    backtracking if it doesn't decrease the objective enough. Everything is computed
+    in float64, since the Hessians of probes on raw hidden states are badly
+    conditioned.
+
+    With `dual`, the problem is solved in the span of the samples instead, which is
+    cheaper when there are fewer samples than features. The penalized weights of
+    the optimum lie in that span, so with an orthonormal basis Q of it, where X = R Q^T,
+    the weights are Q u for the optimum u of the same problem on the N features R.
+
+    Args:
+        x: Input tensor of shape (N, D).
+        y: Binary target tensor of shape (N,).
+        l2_penalty: L2 regularization strength.
+        max_iter: Maximum number of Newton steps.
+        dual: Solve in the span of the samples.
+        tolerance: Stop when the Newton decrement, which bounds the distance of the
+            objective from its optimum, is below this.
+
+    Returns:
+        The float64 weights of shape (D,) and bias, and the final loss without the
+        L2 penalty.
+    """
+    x, y = x.double(), y.double()
+    basis = None
+    if dual:
+        basis, r = torch.linalg.qr(x.mT)
+        x = r.mT
+
+    n, d = x.shape
+    # the bias is the last parameter, and isn't penalized
+    penalty = x.new_full([d + 1], 2 * l2_penalty)
+    penalty[-1] = 0
+
+    def objective(params: Tensor) -> tuple[Tensor, Tensor]:
+        logits = x @ params[:-1] + params[-1]
+        loss = bce_with_logits(logits, y)
+        return loss + l2_penalty * params[:-1].square().sum(), logits
+
+    params = x.new_zeros(d + 1)
+    reg_loss, logits = objective(params)
+    for _ in range(max_iter):
+        probs = logits.sigmoid()
+        resid = (probs - y) / n
+        grad = torch.cat([x.mT @ resid, resid.sum(-1, keepdim=True)]) + penalty * params
+
+        weights = probs * (1 - probs) / n
+        x_weighted = x * weights[:, None]
+        hess = x.new_empty(d + 1, d + 1)
+        hess[:d, :d] = x.mT @ x_weighted
+        hess[:d, d] = hess[d, :d] = x_weighted.sum(0)
+        hess[d, d] = weights.sum()
+        hess.diagonal().add_(penalty)
+
+        chol, info = torch.linalg.cholesky_ex(hess)
+        if info == 0:
+            step = -torch.cholesky_solve(grad[:, None], chol).squeeze(-1)
+        else:
+            # the Hessian is singular, e.g. when all labels are the same
+            step = -torch.linalg.lstsq(hess.cpu(), grad[:, None].cpu()).solution
+            step = step.squeeze(-1).to(grad)
+
+        decrement = -grad @ step
+        if decrement < tolerance:
+            break
+
+        # backtracking line search
+        t = 1.0
+        new_loss, new_logits = objective(params + step)
+        while new_loss > reg_loss - 1e-4 * t * decrement and t > 1e-10:
+            t /= 2
+            new_loss, new_logits = objective(params + t * step)
+        if new_loss > reg_loss:
+            break
+        params += t * step
+        reg_loss, logits = new_loss, new_logits
+
+    weight, bias = params[:-1], params[-1]
+    if basis is not None:
+        weight = basis @ weight
+    return weight, bias, float(bce_with_logits(logits, y))
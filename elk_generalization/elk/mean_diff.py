@@ -1,8 +1,8 @@
 import torch
-from sklearn.metrics import accuracy_score, roc_auc_score
 from torch import Tensor, nn
 
-from elk_generalization.elk.classifier import Classifier
+from elk_generalization.elk.classifier import Classifier, resolve_signs
+from elk_generalization.elk.roc_auc import auroc_or_accuracy
 
 
 class MeanDiffReporter(Classifier):
@@ -24,6 +24,41 @@ class MeanDiffReporter(Classifier):
 
         self.linear.weight.data = diff.unsqueeze(0)
 
+    @classmethod
+    def fit_layers(cls, x: Tensor, y: Tensor) -> list["MeanDiffReporter"]:
+        """Fit and sign-resolve one reporter per layer, all at once.
+
+        Equivalent to calling `fit` and `resolve_sign` on each layer, but the class
+        means of all layers are computed in one pass over `x`.
+
+        Args:
+            x: Hiddens of shape [L, n, d].
+            y: Binary labels of shape [n], shared by all layers.
+        """
+        assert x.ndim == 3, "x must have shape [L, n, d]"
+        y = y.to(x.device).bool()
+        # weights that average each class, with opposite signs
+        weights = y / y.sum() - ~y / (~y).sum()
+        diffs = torch.einsum("n,lnd->ld", weights.to(x.dtype), x)
+        diffs = diffs / diffs.norm(dim=-1, keepdim=True)
+
+        reporters = [cls(x.shape[-1], device=x.device, dtype=x.dtype) for _ in x]
+        for reporter, diff in zip(reporters, diffs):
+            reporter.linear.weight.data = diff.unsqueeze(0)
+        resolve_signs(reporters, x, y)
+        return reporters
+
+    def fit_from_stats(self, means: Tensor, counts: Tensor, scatter: Tensor):
+        """Fit from class statistics, e.g. from `HiddenStats.class_stats`.
+
+        Equivalent to `fit` on the summarized rows. The class 1 mean always scores
+        higher than the class 0 mean, so the sign needs no resolving.
+        """
+        diff = means[1] - means[0]
+        diff = diff / diff.norm()
+
+        self.linear.weight.data = diff.unsqueeze(0).to(self.linear.weight)
+
     @torch.no_grad()
     def resolve_sign(
         self,
@@ -31,11 +66,5 @@ class MeanDiffReporter(Classifier):
         y: Tensor,
     ):
         """Flip the scale term if AUROC < 0.5. Use acc if all labels are the same."""
-        y = y.cpu().numpy()
-        preds = self.forward(x).cpu().numpy()
-        if len(set(y)) == 1:
-            auroc = accuracy_score(y, preds > 0)
-        else:
-            auroc = roc_auc_score(y, preds)
-        if float(auroc) < 0.5:
+        if float(auroc_or_accuracy(y, self.forward(x))) < 0.5:
             self.scale.data = -self.scale.data
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Callable
+
+import torch
+
+from elk_generalization.elk.classifier import Classifier
+from elk_generalization.elk.hidden_store import hiddens_fingerprint
+
+# Set to an empty string to disable caching
+REPORTER_CACHE_DIR = os.environ.get(
+    "ELK_REPORTER_CACHE", os.path.expanduser("~/.cache/elk_generalization/reporters")
+)
+# Bump when a change to the training code changes the reporters it fits
+CACHE_VERSION = 1
+
+
+def reporter_cache_path(
+    train_dir: str | Path,
+    hiddens_name: str,
+    method: str,
+    label_col: str,
+    config: dict,
+) -> Path | None:
+    """Where the reporters trained with these settings are cached, if caching is on.
+
+    Args:
+        train_dir: The training hiddens directory.
+        hiddens_name: The hidden states (or statistics) the reporters are fit on.
+        method: The reporter and token position, as in the results' file names.
+        label_col: The labels the reporters are fit to.
+        config: Everything else that determines the fit, e.g. the reporter's
+            keyword arguments and the solver. Values that aren't JSON are hashed by
+            their repr.
+
+    Returns:
+        A path named by a hash of the contents of the training data and all the
+        settings, so changing any of them trains new reporters, or None if caching
+        is disabled.
+    """
+    if not REPORTER_CACHE_DIR:
+        return None
+
+    train_dir = Path(train_dir)
+    with open(train_dir / f"{label_col}.pt", "rb") as f:
+        labels_hash = hashlib.sha256(f.read()).hexdigest()
+    key = dict(
+        version=CACHE_VERSION,
+        hiddens=hiddens_fingerprint(train_dir, hiddens_name),
+        labels=labels_hash,
+        method=method,
+        config=config,
+    )
+    h = hashlib.sha256(json.dumps(key, sort_keys=True, default=repr).encode())
+    return Path(REPORTER_CACHE_DIR) / f"{method}-{h.hexdigest()[:32]}.pt"
+
+
+def save_reporters(path: Path, reporters: list[Classifier], hidden_size: int):
+    """Save the full state of each layer's reporter, e.g. its scale and eraser."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first so that a crash can't leave a partial entry
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    states = [reporter.state_dict() for reporter in reporters]
+    torch.save(dict(hidden_size=hidden_size, states=states), tmp)
+    os.replace(tmp, path)
+
+
+def load_reporters(
+    path: Path, make_reporter: Callable[[int], Classifier], device: str
+) -> tuple[list[Classifier], int]:
+    """Load reporters saved by `save_reporters`.
+
+    Args:
+        path: The cache entry.
+        make_reporter: Builds an untrained reporter for the given hidden size, to
+            load each layer's state into.
+        device: Where to put the reporters' tensors.
+
+    Returns:
+        The reporters, one for each layer, and the hidden size they were trained on.
+    """
+    saved = torch.load(path, map_location=device)
+    reporters = []
+    for state in saved["states"]:
+        reporter = make_reporter(saved["hidden_size"])
+        reporter.load_state_dict(state)
+        reporters.append(reporter)
+    return reporters, saved["hidden_size"]
@@ -1,6 +1,6 @@
 import torch
 from torch import Tensor
-from argparse import ArgumentParser
+
 
 def roc_auc(y_true: Tensor, y_pred: Tensor) -> Tensor:
     """Area under the receiver operating characteristic curve (ROC AUC).
@@ -53,3 +53,33 @@ def roc_auc(y_true: Tensor, y_pred: Tensor) -> Tensor:
 
     # Calculate area under the ROC curve for each dataset using trapezoidal rule
     return torch.sum(tpr * fpr_diffs, dim=-1).squeeze()
+
+
+def auroc_or_accuracy(y_true: Tensor, y_pred: Tensor) -> Tensor:
+    """ROC AUC of each row of predictions, or their accuracy if all labels are equal.
+
+    Unlike `roc_auc`, ties are counted as half a correct ranking, like scikit-learn
+    does, so this matches `roc_auc_score` exactly. If all labels are the same, the
+    accuracy of thresholding the predictions at zero is returned instead, like
+    scikit-learn's `accuracy_score`.
+
+    Args:
+        y_true: Binary labels of shape `(n,)`, shared by all rows.
+        y_pred: Predictions of shape `(n,)` or `(N, n)`.
+
+    Returns:
+        Tensor: A scalar for 1D predictions, or a tensor of shape `(N,)`.
+    """
+    y_true = y_true.to(y_pred.device).bool()
+    num_positives = int(y_true.sum())
+    num_negatives = len(y_true) - num_positives
+    if num_positives == 0 or num_negatives == 0:
+        return ((y_pred > 0) == y_true).float().mean(-1)
+
+    # count the negatives ranked below, and tied with, each positive
+    negatives = y_pred[..., ~y_true].sort(dim=-1).values
+    positives = y_pred[..., y_true].contiguous()
+    below = torch.searchsorted(negatives, positives, side="left")
+    below_or_tied = torch.searchsorted(negatives, positives, side="right")
+    correct = (below + below_or_tied).sum(-1) / 2
+    return correct / (num_positives * num_negatives)
@@ -1,12 +1,16 @@
 import argparse
 import os
-import subprocess
-import sys
 
-from elk_generalization.utils import DATASET_ABBREVS, get_quirky_model_name
+from elk_generalization.utils import get_quirky_model_name
+from elk_generalization.worker import Worker, run_script
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--rank", type=int, default=0)
+parser.add_argument(
+    "--worker",
+    action="store_true",
+    help="Run all jobs in one persistent worker process that keeps the model loaded",
+)
 
 args = parser.parse_args()
 env = dict(os.environ)
@@ -45,16 +49,16 @@ full_finetuning = False
 
 get_ceiling_latent_knowledge = False
 
+# more than any split has, so that the whole split is extracted
+max_full_examples = 100_000
+# format to store hidden states in, e.g. "int8-channel", or None for the model dtype
+storage = None
+
 # code to modify models and datasets based on rank
 models = models[args.rank :: 8]
 print(ds_names, models)
 
 
-def unpack_abbrev(ds_name, abbrev):
-    ds_id = f"{datasets_user}/quirky_{ds_name}_raw"
-    return ds_id, *DATASET_ABBREVS[abbrev]
-
-
 if __name__ == "__main__":
     if get_ceiling_latent_knowledge:
         exps = {"lr": ["B->BH"]}
@@ -77,6 +81,8 @@ if __name__ == "__main__":
         experiments_dir = "../../experiments-ceiling"
     os.makedirs(experiments_dir, exist_ok=True)
 
+    worker = Worker.spawn(env=env) if args.worker else None
+
     for base_model_id in models:
         for ds_name in ds_names:
             quirky_model_id, quirky_model_last = get_quirky_model_name(
@@ -89,47 +95,55 @@ if __name__ == "__main__":
                 models_user,
             )
 
+            # Extract each split once over all examples, and take the character and
+            # difficulty subsets used by the experiments as cheap index views
+            abbrevs = sorted(
+                {
+                    abbrev
+                    for reporter_exps in exps.values()
+                    for exp in reporter_exps
+                    for abbrev in exp.replace("->", ",").split(",")
+                }
+            )
+            # LoRA models are run as adapters on their base model, which a worker
+            # keeps loaded across datasets
+            model_args = (
+                ["--model", quirky_model_id]
+                if full_finetuning
+                else ["--model", base_model_id, "--adapter", quirky_model_id]
+            )
+            extract_args = [
+                *model_args,
+                "--dataset",
+                f"{datasets_user}/quirky_{ds_name}_raw",
+                "--templatization-method",
+                templatization_method,
+                "--save-path",
+                f"{experiments_dir}/{quirky_model_last}/full",
+                "--max-examples",
+                str(max_full_examples),
+                str(max_full_examples),
+                "--splits",
+                "validation",
+                "test",
+                "--views",
+                *abbrevs,
+                "--view-max-examples",
+                "4000",
+                "1000",
+            ]
+            if standardize_templates:
+                extract_args.append("--standardize-templates")
+            if storage is not None:
+                extract_args += ["--storage", storage]
+            run_script("extract_hiddens", extract_args, worker, env)
+
             def run_experiment(exp, reporter):
                 train, tests = exp.split("->")
                 tests = tests.split(",")
 
-                def run_extract(abbrev, split, max_examples):
-                    ds_hub_id, character, difficulty = unpack_abbrev(ds_name, abbrev)
-                    save_dir = f"{experiments_dir}/{quirky_model_last}/{abbrev}"
-
-                    args = [
-                        sys.executable,
-                        os.path.join(os.path.dirname(__file__), "extract_hiddens.py"),
-                        "--model",
-                        quirky_model_id,
-                        "--dataset",
-                        ds_hub_id,
-                        "--character",
-                        character,
-                        "--difficulty",
-                        difficulty,
-                        "--templatization-method",
-                        templatization_method,
-                        "--save-path",
-                        save_dir,
-                        "--max-examples",
-                        str(max_examples),
-                        "--splits",
-                        split,
-                    ]
-                    if standardize_templates:
-                        args.append("--standardize-templates")
-                    print(f"Running {' '.join(args)}")
-                    subprocess.run(args, env=env)
-
-                run_extract(train, "validation", 4000)
-                for abbrev in tests:
-                    run_extract(abbrev, "test", 1000)
-
-                args = (
+                transfer_args = (
                     [
-                        sys.executable,
-                        os.path.join(os.path.dirname(__file__), "transfer.py"),
                         "--train-dir",
                         f"{experiments_dir}/{quirky_model_last}/{train}/validation",
                         "--test-dirs",
@@ -150,10 +164,12 @@ if __name__ == "__main__":
                     or weak_only
                     or get_ceiling_latent_knowledge
                 ):
-                    args += ["--label-col", "alice_labels"]
-                print(f"Running {' '.join(args)}")
-                subprocess.run(args, env=env)
+                    transfer_args += ["--label-col", "alice_labels"]
+                run_script("transfer", transfer_args, worker, env)
 
             for reporter in exps:
                 for exp in exps[reporter]:
                     run_experiment(exp, reporter)
+
+    if worker is not None:
+        worker.close()
@@ -1,19 +1,37 @@
 import argparse
 from pathlib import Path
+from typing import Iterator, get_args
 
 import torch
 from sklearn.metrics import accuracy_score, roc_auc_score
+from torch import Tensor
 from tqdm import tqdm
 
 from elk_generalization.elk.ccs import CcsConfig, CcsReporter
 from elk_generalization.elk.classifier import Classifier
 from elk_generalization.elk.crc import CrcReporter
+from elk_generalization.elk.hidden_stats import HiddenStats, stats_exist
+from elk_generalization.elk.hidden_store import (
+    POSITIONS,
+    HiddenStore,
+    HiddenStoreView,
+    hiddens_exist,
+    open_hiddens,
+    position_store_name,
+)
 from elk_generalization.elk.lda import LdaReporter
-from elk_generalization.elk.lr_classifier import LogisticRegression
+from elk_generalization.elk.lr_classifier import LogisticRegression, Solver
 from elk_generalization.elk.mean_diff import MeanDiffReporter
 from elk_generalization.elk.random_baseline import eval_random_baseline
+from elk_generalization.elk.reporter_cache import (
+    load_reporters,
+    reporter_cache_path,
+    save_reporters,
+)
+from elk_generalization.pipeline import prefetch
 
-if __name__ == "__main__":
+
+def get_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="Train a reporter and test it on multiple datasets."
     )
@@ -48,16 +66,83 @@ if __name__ == "__main__":
         choices=["labels", "alice_labels", "bob_labels"],
         default="labels",
     )
+    parser.add_argument(
+        "--position",
+        type=str,
+        choices=[p for p in POSITIONS if p != "all"],
+        default="last",
+        help="Token position of the hidden states to probe, see `--positions` of "
+        "extract_hiddens.py. Results are named with the reporter and this position.",
+    )
+    parser.add_argument(
+        "--layer-batch-size",
+        type=int,
+        default=1,
+        help="Number of layers to load and fit at once, for the reporters that can "
+        "be fit in batches. The next batch is loaded while one is in use, so about "
+        "two batches are in memory at a time.",
+    )
+    parser.add_argument(
+        "--solver",
+        type=str,
+        choices=get_args(Solver),
+        default="auto",
+        help="Solver for the logistic regression reporters, see "
+        "`LogisticRegression.fit`",
+    )
     parser.add_argument("--verbose", action="store_true")
+    return parser
+
 
-    args = parser.parse_args()
+def layer_shape(hiddens: HiddenStore | HiddenStoreView | list[Tensor]) -> tuple:
+    """The shape [n, *row_shape] shared by all layers, without loading them."""
+    if isinstance(hiddens, list):
+        shapes = {h.shape for h in hiddens}
+        assert len(shapes) == 1, "Mismatched layer shapes"
+        return tuple(shapes.pop())
+    return (hiddens.num_rows, *hiddens.row_shape)
 
+
+def iter_layers(
+    hiddens: HiddenStore | HiddenStoreView | list[Tensor],
+    device: str | torch.device,
+    dtype: torch.dtype,
+    batch_size: int = 1,
+) -> Iterator[Tensor]:
+    """Yield batches of consecutive layers of shape [batch_size, n, *row_shape].
+
+    Layers are read from disk, converted to `dtype` and, if they're going to a GPU,
+    pinned on a background thread while the previous batch is in use, so only about
+    two batches are in memory at a time instead of all layers.
+    """
+    pin = torch.device(device).type == "cuda"
+
+    def load(idxs: range) -> Tensor:
+        batch = torch.stack([hiddens[i].to(dtype) for i in idxs])
+        return batch.pin_memory() if pin else batch
+
+    batches = [
+        range(start, min(start + batch_size, len(hiddens)))
+        for start in range(0, len(hiddens), batch_size)
+    ]
+    for batch in prefetch(load, batches, depth=1):
+        yield batch.to(device, non_blocking=True)
+
+
+def main(args: argparse.Namespace):
     train_dir = Path(args.train_dir)
     test_dirs = [Path(d) for d in args.test_dirs]
 
     dtype = torch.float32
 
     use_cp = args.reporter in {"ccs", "crc", "lr-on-pair", "mean-diff-on-pair"}
+    assert not (
+        use_cp and args.position != "last"
+    ), "Contrast pair reporters use the states of the choice tokens"
+    # reporters trained at other positions than the last token get their own files
+    method = (
+        args.reporter if args.position == "last" else f"{args.reporter}-{args.position}"
+    )
 
     reporter_class = {
         "ccs": CcsReporter,
@@ -70,68 +155,127 @@ if __name__ == "__main__":
         "random": None,
     }[args.reporter]
 
-    hiddens_file = "ccs_hiddens.pt" if use_cp else "hiddens.pt"
-    train_hiddens = torch.load(train_dir / hiddens_file)
-    train_n = train_hiddens[0].shape[0]
-    d = train_hiddens[0].shape[-1]
-    assert all(
-        h.shape[0] == train_n for h in train_hiddens
-    ), "Mismatched number of samples"
-    assert all(h.shape[-1] == d for h in train_hiddens), "Mismatched hidden size"
-
-    train_labels = torch.load(train_dir / f"{args.label_col}.pt").to(args.device).int()
-    assert len(train_labels) == train_n, "Mismatched number of labels"
-
-    reporters = []  # one for each layer
-    for layer, train_hidden in tqdm(
-        enumerate(train_hiddens), desc=f"Training on {train_dir}"
-    ):
-        train_hidden = train_hidden.to(args.device).to(dtype)
-        hidden_size = train_hidden.shape[-1]
-
-        if args.reporter == "ccs":
-            kwargs = dict(
-                cfg=CcsConfig(
-                    bias=True,
-                    loss=["ccs"],
-                    norm="leace",
-                    lr=1e-2,
-                    num_epochs=1000,
-                    num_tries=10,
-                    optimizer="lbfgs",
-                    weight_decay=0.01,
-                ),
-                num_variants=1,
-            )
-        else:
-            kwargs = {}
-
-        if use_cp:
-            assert train_hidden.ndim == 3
-            train_hidden = train_hidden.view(
-                train_hidden.shape[0], -1
-            )  # cat positive and negative
-            in_features = 2 * hidden_size
-        else:
-            in_features = hidden_size
+    if args.reporter == "ccs":
+        kwargs = dict(
+            cfg=CcsConfig(
+                bias=True,
+                loss=["ccs"],
+                norm="leace",
+                lr=1e-2,
+                num_epochs=1000,
+                num_tries=10,
+                optimizer="lbfgs",
+                weight_decay=0.01,
+            ),
+            num_variants=1,
+        )
+    else:
+        kwargs = {}
 
+    # settings of the fit itself, as opposed to the reporter
+    fit_kwargs = (
+        dict(solver=args.solver) if reporter_class is LogisticRegression else {}
+    )
+    batched = hasattr(reporter_class, "fit_layers")
+    batch_size = args.layer_batch_size if batched else 1
+
+    def make_reporter(hidden_size: int) -> Classifier:
+        # contrast pair reporters see the states of both choices concatenated
+        in_features = 2 * hidden_size if use_cp else hidden_size
+        return reporter_class(
+            in_features=in_features, device=args.device, dtype=dtype, **kwargs
+        )
+
+    # layers are memory-mapped and only read from disk when they're used
+    hiddens_name = "ccs_hiddens" if use_cp else position_store_name(args.position)
+    # if the training split was extracted with --stats-only, fit the reporters from
+    # its sufficient statistics; their sign is already correct
+    use_stats = (
+        args.reporter in {"mean-diff", "lda"}
+        and args.position == "last"
+        and not hiddens_exist(train_dir)
+        and stats_exist(train_dir)
+    )
+    # reporters fit to the same data with the same settings are reused
+    cache_path = (
+        reporter_cache_path(
+            train_dir,
+            "stats" if use_stats else hiddens_name,
+            method,
+            args.label_col,
+            dict(
+                reporter=reporter_class.__name__,
+                kwargs=kwargs,
+                fit_kwargs=fit_kwargs,
+                dtype=dtype,
+                # batches of layers converge together, so their fits differ slightly
+                layer_batch_size=batch_size,
+            ),
+        )
+        if args.reporter != "random"
+        else None
+    )
+
+    if cache_path is not None and cache_path.exists():
+        print(f"Using cached reporters from {cache_path}")
+        reporters, d = load_reporters(cache_path, make_reporter, args.device)
+    elif use_stats:
+        stats = HiddenStats.load(train_dir / "stats", device=args.device)
+        d = stats.hidden_size
+        reporters = []
+        for idx in tqdm(range(len(stats)), desc=f"Training on {train_dir}"):
+            reporter = make_reporter(d)
+            reporter.fit_from_stats(*stats.class_stats(idx, args.label_col))
+            reporters.append(reporter)
+    else:
+        train_hiddens = open_hiddens(train_dir, hiddens_name)
+        train_n, *_, d = layer_shape(train_hiddens)
+
+        train_labels = (
+            torch.load(train_dir / f"{args.label_col}.pt").to(args.device).int()
+        )
+        assert len(train_labels) == train_n, "Mismatched number of labels"
+
+        reporters = []  # one for each layer
         if args.reporter == "random":
-            reporters.append(None)
+            # the random baseline reads the hiddens itself
+            reporters = [None] * len(train_hiddens)
         else:
-            reporter: Classifier = reporter_class(
-                in_features=in_features, device=args.device, dtype=dtype, **kwargs
-            )
-            reporter.fit(x=train_hidden, y=train_labels)
-            reporter.resolve_sign(x=train_hidden, y=train_labels)
-            reporters.append(reporter)
+            for train_x in tqdm(
+                iter_layers(train_hiddens, args.device, dtype, batch_size),
+                desc=f"Training on {train_dir}",
+                total=-(-len(train_hiddens) // batch_size),
+            ):
+                if batched:
+                    # fit and sign-resolve a batch of layers at once; contrast pairs are
+                    # concatenated like below
+                    reporters += reporter_class.fit_layers(
+                        train_x.flatten(2), train_labels, **fit_kwargs
+                    )
+                    continue
+
+                train_hidden = train_x[0]
+                if use_cp:
+                    assert train_hidden.ndim == 3
+                    train_hidden = train_hidden.view(
+                        train_hidden.shape[0], -1
+                    )  # cat positive and negative
+
+                reporter = make_reporter(d)
+                reporter.fit(x=train_hidden, y=train_labels, **fit_kwargs)
+                reporter.resolve_sign(x=train_hidden, y=train_labels)
+                reporters.append(reporter)
+
+    if cache_path is not None and not cache_path.exists():
+        save_reporters(cache_path, reporters, d)
 
     if reporters[0] is not None:
         weights = [reporter.linear.weight for reporter in reporters]
-        torch.save(weights, train_dir / f"{args.reporter}_reporters.pt")
+        torch.save(weights, train_dir / f"{method}_reporters.pt")
 
     with torch.inference_mode():
         for test_dir in test_dirs:
-            test_hiddens = torch.load(test_dir / hiddens_file)
+            test_hiddens = open_hiddens(test_dir, hiddens_name)
             test_labels = (
                 torch.load(test_dir / f"{args.label_col}.pt").to(args.device).int()
             )
@@ -140,23 +284,22 @@ if __name__ == "__main__":
             )
 
             # make sure that we're using a compatible test set
-            test_n = test_hiddens[0].shape[0]
-            assert len(test_hiddens) == len(
-                train_hiddens
-            ), "Mismatched number of layers"
-            assert all(
-                h.shape[0] == test_n for h in test_hiddens
-            ), "Mismatched number of samples"
-            assert all(h.shape[-1] == d for h in test_hiddens), "Mismatched hidden size"
+            test_n, *_, test_d = layer_shape(test_hiddens)
+            assert len(test_hiddens) == len(reporters), "Mismatched number of layers"
+            assert test_d == d, "Mismatched hidden size"
 
             log_odds = torch.full(
                 [len(test_hiddens), test_n], torch.nan, device=args.device
             )
-            for layer in tqdm(range(len(reporters)), desc=f"Testing on {test_dir}"):
-                reporter, test_hidden = (
-                    reporters[layer],
-                    test_hiddens[layer].to(args.device).to(dtype),
-                )
+            test_layers = (
+                iter_layers(test_hiddens, args.device, dtype)
+                if args.reporter != "random"
+                else []
+            )
+            for layer, test_x in enumerate(
+                tqdm(test_layers, desc=f"Testing on {test_dir}", total=len(reporters))
+            ):
+                reporter, test_hidden = reporters[layer], test_x[0]
                 if args.reporter == "ccs":
                     test_hidden = test_hidden.unsqueeze(1)
                     log_odds[layer] = reporter(test_hidden, ens="full")
@@ -170,15 +313,20 @@ if __name__ == "__main__":
                         test_hidden.shape[0], -1
                     )  # cat positive and negative
                     log_odds[layer] = reporter(test_hidden).squeeze(-1)
-                elif args.reporter != "random":
+                else:
                     log_odds[layer] = reporter(test_hidden).squeeze(-1)
 
             if args.reporter == "random":
                 aucs = []
-                for layer in range(len(test_hiddens)):
+                # stored layers are on the CPU and may be in a compact dtype
+                layer_pairs = zip(
+                    iter_layers(train_hiddens, args.device, dtype),
+                    iter_layers(test_hiddens, args.device, dtype),
+                )
+                for layer, (train_x, test_x) in enumerate(layer_pairs):
                     auc = eval_random_baseline(
-                        train_hiddens[layer],
-                        test_hiddens[layer],
+                        train_x[0],
+                        test_x[0],
                         train_labels,
                         test_labels,
                         num_samples=1000,
@@ -189,7 +337,7 @@ if __name__ == "__main__":
                 torch.save(
                     aucs,
                     test_dir
-                    / f"{train_dir.parent.name}_random_aucs_against_{args.label_col}.pt",
+                    / f"{train_dir.parent.name}_{method}_aucs_against_{args.label_col}.pt",
                 )
             else:
                 # save the log odds to disk
@@ -198,7 +346,7 @@ if __name__ == "__main__":
                 # we save to test_dir / "alice_ccs_log_odds.pt"[]
                 torch.save(
                     log_odds,
-                    test_dir / f"{train_dir.parent.name}_{args.reporter}_log_odds.pt",
+                    test_dir / f"{train_dir.parent.name}_{method}_log_odds.pt",
                 )
 
                 if args.verbose:
@@ -226,3 +374,7 @@ if __name__ == "__main__":
                             test_labels.cpu().numpy(), lm_log_odds.cpu().numpy() > 0
                         )
                         print("LM ACC:", acc)
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -1,39 +1,86 @@
 import json
 import os
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
+from typing import Callable
 
 import torch
 from datasets import Dataset
 from sklearn.metrics import roc_auc_score
 from tqdm.auto import tqdm
-from transformers import (
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    GPTNeoXForCausalLM,
-    LlamaForCausalLM,
-    MistralForCausalLM,
-)
 
 from elk_generalization import loader_utils
-from elk_generalization.elk.extract_hiddens import encode_choice
+from elk_generalization.batching import plan_batches, prefix_inputs
+from elk_generalization.elk.hidden_store import open_hiddens
+from elk_generalization.model_utils import (
+    PrefixCache,
+    choice_logits,
+    get_decoder_layers,
+    load_pretrained,
+    lora_adapter,
+    set_cpu_threads,
+)
+from elk_generalization.token_cache import cached_tokenize
 from elk_generalization.utils import assert_type, get_quirky_model_name
 
 
-def compute_prob(out, row, tokenizer):
-    logits = out.logits
-    relevant_logits = logits[
-        0,
-        -1,
-        [
-            encode_choice(row["choices"][0], tokenizer),
-            encode_choice(row["choices"][1], tokenizer),
-        ],
-    ]
-    p_yes = torch.softmax(relevant_logits, dim=0)[1]
-    return p_yes
+def compute_probs(
+    model,
+    prompts: list[list[int]],
+    choice_toks: list[list[int]],
+    batches: list[tuple[int, list[int]]],
+    pad_token_id: int,
+    prefix_cache: PrefixCache,
+    edit_module: torch.nn.Module | None = None,
+    edit: Callable[[torch.Tensor, torch.Tensor], None] | None = None,
+) -> list[float]:
+    """Get the probability of the second choice after each prompt, in row order.
 
+    Rows are run in the given (prefix length, indices) batches (see `plan_batches`),
+    continuing from a cached KV of their shared prefix, and the results are
+    scattered back to the original order. If given, `edit` is called on the output
+    states of `edit_module` with the batch's attention mask, both [B, T, ...], and
+    may modify the states in place. It must see every token of the prompts, so the
+    batches may not share prefixes.
+    """
+    probs = torch.full([len(prompts)], torch.nan)
+    for prefix_len, batch in batches:
+        assert not (edit and prefix_len), "Edited prompts can't share a prefix"
+        prefix_past_key_values = (
+            prefix_cache.get(model, prompts[batch[0]][:prefix_len], len(batch))
+            if prefix_len
+            else None
+        )
+        input_ids, attention_mask, position_ids = prefix_inputs(
+            [prompts[i][prefix_len:] for i in batch],
+            prefix_len,
+            pad_token_id,
+            model.device,
+        )
 
-if __name__ == "__main__":
+        def edit_hook(module, args, outputs):
+            # later elements of the tuple, if any, are the key value cache
+            edit(outputs[0] if isinstance(outputs, tuple) else outputs, attention_mask)
+
+        handle = edit_module.register_forward_hook(edit_hook) if edit else None
+        try:
+            relevant_logits, _ = choice_logits(
+                model,
+                torch.as_tensor([choice_toks[i] for i in batch], device=model.device),
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=prefix_past_key_values,
+                use_cache=prefix_past_key_values is not None,
+            )
+        finally:
+            if handle is not None:
+                handle.remove()
+        probs[batch] = torch.softmax(relevant_logits.float(), dim=-1)[:, 1].cpu()
+
+    return probs.tolist()
+
+
+def get_parser() -> ArgumentParser:
     parser = ArgumentParser(description="Description of your program")
 
     parser.add_argument(
@@ -85,6 +132,49 @@ if __name__ == "__main__":
     )
     parser.add_argument("--n_test", type=int, default=1000, help="Number of tests")
     parser.add_argument("--layer_stride", type=int, default=1, help="Layer stride")
+    parser.add_argument(
+        "--batch_size", type=int, default=32, help="Maximum prompts per batch"
+    )
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        default=None,
+        help="Maximum padded prompt tokens per batch",
+    )
+    parser.add_argument(
+        "--min_prefix_len",
+        type=int,
+        default=32,
+        help="Prompts sharing a prefix of at least this many tokens compute its KV "
+        "cache once. Set to 0 to disable.",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default=None,
+        help="Device to run the model on, defaults to the GPU if there is one",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        choices=["auto", "float32", "bfloat16", "float16"],
+        default="bfloat16",
+        help="Model dtype. Use float32 on CPUs without fast bfloat16 support.",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Dynamically quantize the model's linear layers to int8 (CPU only)",
+    )
+    parser.add_argument(
+        "--num_threads", type=int, default=None, help="Threads per CPU op"
+    )
+    parser.add_argument(
+        "--num_interop_threads",
+        type=int,
+        default=None,
+        help="Threads for running independent CPU ops in parallel",
+    )
     parser.add_argument("--probe_root_dir", type=str, default="../../experiments")
     parser.add_argument(
         "--templatization_method",
@@ -106,8 +196,16 @@ if __name__ == "__main__":
     parser.add_argument(
         "--model_hub_user", type=str, default="EleutherAI", help="Model Hub user"
     )
+    parser.add_argument(
+        "--unmerged_adapter",
+        action="store_true",
+        help="Run the LoRA adapter alongside the base weights instead of merging it in",
+    )
+
+    return parser
+
 
-    args = parser.parse_args()
+def main(args: Namespace):
     mname, mname_last = get_quirky_model_name(
         args.ds_name,
         args.base_model_name,
@@ -125,118 +223,135 @@ if __name__ == "__main__":
     )
     if os.path.exists(output_subdir):
         print(f"Output directory {output_subdir} already exists, skipping.")
-        exit(0)
+        return
     probe_char_abbrev = args.probe_character[0]
     probe_dir = f"{args.probe_root_dir}/{mname_last}/{probe_char_abbrev}/validation"
 
-    tokenizer = AutoTokenizer.from_pretrained(mname)
-    model = AutoModelForCausalLM.from_pretrained(
-        mname,
-        device_map={"": torch.cuda.current_device()},
-    ).to(torch.bfloat16)
-    all_hiddens = torch.load(f"{probe_dir}/hiddens.pt")
+    set_cpu_threads(args.num_threads, args.num_interop_threads)
+    # LoRA models run on their base model, so that a worker can keep the base model
+    # loaded for all datasets and only swap the adapters
+    adapter = None if args.full_finetuning else mname
+    assert not (
+        adapter and args.quantize
+    ), "Adapters can't be applied to quantized models"
+    model, tokenizer = load_pretrained(
+        mname if args.full_finetuning else args.base_model_name,
+        device=args.device,
+        dtype=args.dtype,
+        quantize=args.quantize,
+    )
+    all_hiddens = open_hiddens(probe_dir)
     if args.probe_method == "random":
         reporters = torch.randn(len(all_hiddens), all_hiddens[0].shape[1])
     else:
         reporters = torch.load(f"{probe_dir}/{args.probe_method}_reporters.pt")
     assert len(all_hiddens) == len(reporters)
+    # hidden stores may only hold a subset of the model's layers
+    stored_layers = getattr(all_hiddens, "layers", list(range(len(all_hiddens))))
     # select layers based on layer_stride, starting from the last layer
-    layers = list(range(len(all_hiddens) - 1, -1, -args.layer_stride))
-
-    summary = []
-    all_results = []
-    for layer in layers:
-        hiddens = all_hiddens[layer]
-        mean_act = hiddens.mean(dim=0).reshape(1, -1).to(model.device)
-        weight = reporters[layer].reshape(-1, 1).to(model.device)
-        unit_weight = weight / weight.norm()
-
-        if isinstance(model, GPTNeoXForCausalLM):
-            module_to_hook = model.gpt_neox.layers[layer]
-        elif isinstance(model, MistralForCausalLM) or isinstance(
-            model, LlamaForCausalLM
-        ):
-            module_to_hook = model.model.layers[layer]
-        else:
-            raise ValueError(f"Model type {type(model)} not supported.")
-
-        def negate_truth_hook(module, args, outputs):
-            hiddens = outputs[0]  # later elements of the tuple are key value cache
-            ctrd = hiddens[:, -1, :] - mean_act
-            proj = ctrd @ unit_weight
-            assert list(proj.shape) == [ctrd.shape[0], 1]
-            ctrd = ctrd - 2 * proj * unit_weight.T
-            hiddens[-1] = ctrd + mean_act
-
-        ds_hub_id = f"EleutherAI/quirky_{args.ds_name}_raw"
-        ds = assert_type(
-            Dataset,
-            loader_utils.templatize_quirky_dataset(
-                loader_utils.load_quirky_dataset(
-                    ds_hub_id,
-                    character=args.test_character,
-                    max_difficulty_quantile=args.test_max_difficulty_quantile,
-                    min_difficulty_quantile=args.test_min_difficulty_quantile,
-                    split="test",
-                ),
+    idxs = list(range(len(all_hiddens) - 1, -1, -args.layer_stride))
+
+    ds_hub_id = f"EleutherAI/quirky_{args.ds_name}_raw"
+    ds = assert_type(
+        Dataset,
+        loader_utils.templatize_quirky_dataset(
+            loader_utils.load_quirky_dataset(
                 ds_hub_id,
-                method=args.templatization_method,
-                standardize_templates=args.standardize_templates,
+                character=args.test_character,
+                max_difficulty_quantile=args.test_max_difficulty_quantile,
+                min_difficulty_quantile=args.test_min_difficulty_quantile,
+                split="test",
             ),
-        )
+            ds_hub_id,
+            method=args.templatization_method,
+            standardize_templates=args.standardize_templates,
+        ),
+    ).select(range(args.n_test))
+    tokens = cached_tokenize(tokenizer, ds, args.templatization_method)
+    prompts = tokens.prompts()
+    choice_toks = tokens.choice_ids.tolist()
+    alice_labels = torch.tensor(ds["alice_label"])
+    bob_labels = torch.tensor(ds["bob_label"])
+    # prompts sharing a long prefix, e.g. few-shot demonstrations, reuse its KV
+    # cache, and within each group prompts of similar length are batched together
+    batches = plan_batches(
+        prompts, args.min_prefix_len, args.max_tokens, args.batch_size
+    )
+    # the intervention edits every token, so those runs can't reuse a clean prefix
+    edited_batches = plan_batches(prompts, 0, args.max_tokens, args.batch_size)
+    pad_token_id = tokenizer.pad_token_id or 0
+    prefix_cache = PrefixCache()
 
+    with lora_adapter(model, adapter, merge=not args.unmerged_adapter):
         with torch.inference_mode():
-            intervened_probs = []
-            clean_probs = []
-            alice_labels = []
-            bob_labels = []
-            for row in tqdm(ds.select(range(args.n_test))):
-                assert isinstance(row, dict)
-
-                handle = module_to_hook.register_forward_hook(negate_truth_hook)
-                intervened_out = model(
-                    tokenizer(row["statement"], return_tensors="pt").input_ids.to(
-                        model.device
+            # the clean run doesn't depend on the layer, so we only need it once
+            clean_probs = compute_probs(
+                model, prompts, choice_toks, batches, pad_token_id, prefix_cache
+            )
+
+        summary = []
+        all_results = []
+        for idx in idxs:
+            layer = stored_layers[idx]
+            hiddens = all_hiddens[idx]
+            mean_act = hiddens.mean(dim=0).reshape(1, -1).to(model.device)
+            weight = reporters[idx].reshape(-1, 1).to(model.device)
+            unit_weight = weight / weight.norm()
+
+            module_to_hook = get_decoder_layers(model)[layer]
+
+            def negate_truth(hiddens, attention_mask):
+                # prompts are left-padded, so the last position is the last token
+                ctrd = hiddens[:, -1, :] - mean_act
+                proj = ctrd @ unit_weight
+                assert list(proj.shape) == [ctrd.shape[0], 1]
+                ctrd = ctrd - 2 * proj * unit_weight.T
+                # the negated last-token state replaces the state of every token of
+                # the prompt, leaving the padding alone
+                hiddens.copy_(
+                    torch.where(
+                        attention_mask[..., None].bool(),
+                        (ctrd + mean_act)[:, None, :],
+                        hiddens,
                     )
                 )
 
-                handle.remove()
-                clean_out = model(
-                    tokenizer(row["statement"], return_tensors="pt").input_ids.to(
-                        model.device
-                    )
+            with torch.inference_mode():
+                intervened_probs = compute_probs(
+                    model,
+                    prompts,
+                    choice_toks,
+                    tqdm(edited_batches),
+                    pad_token_id,
+                    prefix_cache,
+                    edit_module=module_to_hook,
+                    edit=negate_truth,
                 )
 
-                intervened_p = compute_prob(intervened_out, row, tokenizer).item()
-                clean_p = compute_prob(clean_out, row, tokenizer).item()
-                intervened_probs.append(intervened_p)
-                clean_probs.append(clean_p)
-                alice_labels.append(row["alice_label"])
-                bob_labels.append(row["bob_label"])
-
-            alice_labels = torch.tensor(alice_labels)
-            bob_labels = torch.tensor(bob_labels)
-
-            summ = {
-                "layer": layer,
-                "int_auroc_alice": roc_auc_score(alice_labels, intervened_probs),
-                "int_auroc_bob": roc_auc_score(bob_labels, intervened_probs),
-                "cl_auroc_alice": roc_auc_score(alice_labels, clean_probs),
-                "cl_auroc_bob": roc_auc_score(bob_labels, clean_probs),
-            }
-            print(summ)
-            summary.append(summ)
-            all_results.append(
-                {
+                summ = {
                     "layer": layer,
-                    "intervened_probs": intervened_probs,
-                    "clean_probs": clean_probs,
-                    "alice_labels": alice_labels,
-                    "bob_labels": bob_labels,
+                    "int_auroc_alice": roc_auc_score(alice_labels, intervened_probs),
+                    "int_auroc_bob": roc_auc_score(bob_labels, intervened_probs),
+                    "cl_auroc_alice": roc_auc_score(alice_labels, clean_probs),
+                    "cl_auroc_bob": roc_auc_score(bob_labels, clean_probs),
                 }
-            )
+                print(summ)
+                summary.append(summ)
+                all_results.append(
+                    {
+                        "layer": layer,
+                        "intervened_probs": intervened_probs,
+                        "clean_probs": clean_probs,
+                        "alice_labels": alice_labels,
+                        "bob_labels": bob_labels,
+                    }
+                )
 
     os.makedirs(output_subdir)
     with open(f"{output_subdir}/summary.json", "w") as f:
         json.dump(summary, f)
     torch.save(all_results, f"{output_subdir}/all_results.pt")
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -1,12 +1,16 @@
 import argparse
 import os
-import subprocess
-import sys
 
 from elk_generalization.utils import DATASET_ABBREVS
+from elk_generalization.worker import Worker, run_script
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--rank", type=int, default=0)
+parser.add_argument(
+    "--worker",
+    action="store_true",
+    help="Run all jobs in one persistent worker process that keeps the model loaded",
+)
 
 args = parser.parse_args()
 env = dict(os.environ)
@@ -59,6 +63,8 @@ if __name__ == "__main__":
         "lda": ["A->A", "B->B", "A->B", "B->A"],
     }
 
+    worker = Worker.spawn(env=env) if args.worker else None
+
     for base_model in models:
         for ds_name in ds_names:
             for probe_method, exps in method_to_exps.items():
@@ -70,9 +76,7 @@ if __name__ == "__main__":
                         character, difficulty = DATASET_ABBREVS[test]
                         assert difficulty == "none"
 
-                        args = [
-                            sys.executable,
-                            os.path.join(os.path.dirname(__file__), "intervene.py"),
+                        intervene_args = [
                             "--ds_name",
                             ds_name,
                             "--base_model_name",
@@ -97,10 +101,12 @@ if __name__ == "__main__":
                             models_user,
                         ]
                         if full_finetuning:
-                            args.append("--full_finetuning")
+                            intervene_args.append("--full_finetuning")
                         if standardize_templates:
-                            args.append("--standardize_templates")
+                            intervene_args.append("--standardize_templates")
                         if weak_only:
-                            args.append("--weak_only")
-                        print(f"Running {' '.join(args)}")
-                        subprocess.run(args, env=env)
+                            intervene_args.append("--weak_only")
+                        run_script("intervene", intervene_args, worker, env)
+
+    if worker is not None:
+        worker.close()
@@ -0,0 +1,382 @@
+import copy
+import gc
+import re
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable
+
+import torch
+from peft.tuners.tuners_utils import BaseTunerLayer
+from torch import Tensor, nn
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    GPTNeoXForCausalLM,
+    LlamaForCausalLM,
+    MistralForCausalLM,
+    PreTrainedModel,
+)
+
+# models kept loaded between calls to `load_pretrained`, most recently used last
+_resident_models: OrderedDict[tuple, tuple[PreTrainedModel, Any]] = OrderedDict()
+_max_resident_models = 0
+
+
+def keep_models_resident(max_models: int = 1):
+    """Make `load_pretrained` keep up to `max_models` models loaded for reuse.
+
+    This is meant for long-lived processes like `elk_generalization.worker` that run
+    many jobs on the same model. When more models are loaded, the least recently
+    used one is evicted. Models are never cached by default.
+    """
+    global _max_resident_models
+    _max_resident_models = max_models
+    _evict_models()
+
+
+def _evict_models():
+    if len(_resident_models) <= _max_resident_models:
+        return
+    while len(_resident_models) > _max_resident_models:
+        _resident_models.popitem(last=False)
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def default_device() -> str:
+    """The current CUDA device if there is one, otherwise the CPU."""
+    if torch.cuda.is_available():
+        return f"cuda:{torch.cuda.current_device()}"
+    return "cpu"
+
+
+def set_cpu_threads(
+    num_threads: int | None = None, num_interop_threads: int | None = None
+):
+    """Set the number of threads torch uses within and across CPU ops.
+
+    Inter-op threads can only be set before torch first runs ops in parallel, so
+    later attempts, e.g. in a worker that already ran a job, are ignored with a
+    warning.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            print(f"Couldn't set the number of inter-op threads: {e}")
+
+
+def load_pretrained(
+    name: str,
+    device: str | None = None,
+    dtype: str | torch.dtype = "auto",
+    quantize: bool = False,
+    **kwargs,
+) -> tuple[PreTrainedModel, Any]:
+    """Load a causal LM for inference, reusing a resident copy if there is one.
+
+    Args:
+        name: The model name or path.
+        device: Device to load the model on, defaults to `default_device()`.
+        dtype: The model dtype. "auto" uses the checkpoint's dtype on GPU and
+            float32 on CPU, where half-precision kernels are often slow or missing.
+        quantize: Dynamically quantize the linear layers to int8, with activations
+            quantized on the fly. This is CPU only, and speeds up the matmuls that
+            dominate inference at the cost of some accuracy. The unembedding is left
+            as is, since `choice_logits` only reads a few of its rows.
+        **kwargs: Passed to `AutoModelForCausalLM.from_pretrained`. A resident model
+            is only reused if it was loaded with the same arguments.
+
+    Returns:
+        The model, in eval mode and without gradients, and its tokenizer.
+    """
+    device = device or default_device()
+    if dtype == "auto" and torch.device(device).type == "cpu":
+        dtype = torch.float32
+    elif isinstance(dtype, str) and dtype != "auto":
+        dtype = getattr(torch, dtype)
+    assert not quantize or (
+        device == "cpu" and dtype == torch.float32
+    ), "Dynamic quantization needs a float32 model on the CPU"
+
+    key = (name, device, str(dtype), quantize, repr(sorted(kwargs.items())))
+    if key in _resident_models:
+        _resident_models.move_to_end(key)
+        return _resident_models[key]
+
+    model = AutoModelForCausalLM.from_pretrained(
+        name, device_map={"": device}, torch_dtype=dtype, **kwargs
+    )
+    model.eval().requires_grad_(False)
+    if quantize:
+        unembed = model.get_output_embeddings()
+        model = torch.ao.quantization.quantize_dynamic(
+            model,
+            {
+                name: torch.ao.quantization.default_dynamic_qconfig
+                for name, module in model.named_modules()
+                if isinstance(module, nn.Linear) and module is not unembed
+            },
+            dtype=torch.qint8,
+        )
+    tokenizer = AutoTokenizer.from_pretrained(name)
+    if _max_resident_models > 0:
+        _resident_models[key] = model, tokenizer
+        _evict_models()
+    return model, tokenizer
+
+
+@contextmanager
+def lora_adapter(model: PreTrainedModel, adapter: str | None, merge: bool = True):
+    """Activate a LoRA adapter on a base model for the duration of the `with` block.
+
+    This lets one base model, e.g. a resident one from `load_pretrained`, serve the
+    quirky models fine-tuned from it, which are named by `get_quirky_model_name`.
+    The adapter is loaded the first time it's used and kept, disabled, on the model
+    afterwards, so switching back to it later is free.
+
+    Args:
+        model: The base model.
+        adapter: Hub id or path of the adapter. If None, the base model is used as is.
+        merge: Add the adapter's weight deltas to the base weights, so the model
+            runs at the base model's speed. The original weights of the layers the
+            adapter targets are copied to the CPU and restored on exit, exactly, so
+            merging many adapters in turn doesn't accumulate rounding errors.
+            Merging costs about as much as running the unmerged model on a few
+            hundred tokens, so only very short jobs, or models whose linear layers
+            can't be merged into, are faster unmerged.
+
+    Yields:
+        The model, with the adapter active.
+    """
+    if adapter is None:
+        yield model
+        return
+
+    # adapters are stored in `nn.ModuleDict`s, whose keys can't contain dots
+    name = re.sub(r"[^\w-]", "_", adapter)
+    if name not in getattr(model, "peft_config", {}):
+        model.load_adapter(adapter, adapter_name=name)
+    model.set_adapter(name)
+    model.enable_adapters()
+
+    original_weights = {}
+    try:
+        if merge:
+            for module in model.modules():
+                # layers wrapped for other adapters are left as they are
+                if isinstance(module, BaseTunerLayer) and any(
+                    name in getattr(module, layer_name)
+                    for layer_name in module.adapter_layer_names
+                ):
+                    weight = module.get_base_layer().weight
+                    original_weights[module] = weight.detach().to("cpu", copy=True)
+                    module.merge()
+        yield model
+    finally:
+        for module, weight in original_weights.items():
+            if module.merged:
+                module.unmerge()
+            module.get_base_layer().weight.data.copy_(weight)
+        model.disable_adapters()
+
+
+def get_decoder_layers(model: PreTrainedModel) -> nn.ModuleList:
+    """Get the list of transformer blocks of a causal LM."""
+    if isinstance(model, GPTNeoXForCausalLM):
+        return model.gpt_neox.layers
+    elif isinstance(model, (MistralForCausalLM, LlamaForCausalLM)):
+        return model.model.layers
+    else:
+        raise ValueError(f"Model type {type(model)} not supported.")
+
+
+def get_final_norm(model: PreTrainedModel) -> nn.Module:
+    """Get the norm applied to the output of the last transformer block."""
+    if isinstance(model, GPTNeoXForCausalLM):
+        return model.gpt_neox.final_layer_norm
+    elif isinstance(model, (MistralForCausalLM, LlamaForCausalLM)):
+        return model.model.norm
+    else:
+        raise ValueError(f"Model type {type(model)} not supported.")
+
+
+def choice_logits(
+    model: PreTrainedModel, choices: Tensor, **kwargs
+) -> tuple[Tensor, Any]:
+    """Run a causal LM and get the logits of a few choice tokens after the last token.
+
+    Only the transformer body is run, and only the last position's final state is
+    projected onto the unembedding rows of the choices, so the full-vocabulary
+    logits of every position are never computed. The results match the
+    corresponding entries of `model(**kwargs).logits[:, -1]`.
+
+    Args:
+        model: The causal LM.
+        choices: [B, k] tensor of the token ids to score for each row.
+        **kwargs: Passed to the transformer body, e.g. `input_ids`,
+            `attention_mask` and `past_key_values`.
+
+    Returns:
+        logits: [B, k] tensor of the logit of each choice.
+        outputs: The outputs of the body, including `past_key_values` if
+            `use_cache` is set.
+    """
+    outputs = model.base_model(**kwargs)
+    last_state = outputs.last_hidden_state[:, -1, :]
+    unembed = model.get_output_embeddings()
+    weight = unembed.weight[choices].to(last_state.dtype)  # [B, k, d]
+    logits = torch.einsum("bd,bkd->bk", last_state, weight)
+    if getattr(unembed, "bias", None) is not None:
+        logits = logits + unembed.bias[choices]
+    return logits, outputs
+
+
+def parse_layers(spec: list[str] | None, num_layers: int) -> list[int]:
+    """Parse a layer specification into a sorted list of layer indices.
+
+    Each element of `spec` is one of:
+        - an integer layer index, e.g. "12" or "-1"
+        - a Python slice over the layers, e.g. "::2" or "4:20:4"
+        - a fraction of the depth, selecting the layer there, e.g. "0.5" or "1.0"
+            for the last layer
+        - a fraction range of the depth, with an optional integer stride,
+            e.g. "0.5:1.0" or "0.25:0.75:2"
+    The union of all elements is returned. `None` or an empty spec selects every layer.
+    """
+    if not spec:
+        return list(range(num_layers))
+
+    def fraction(field: str) -> float:
+        frac = float(field)
+        if not 0 <= frac <= 1:
+            raise ValueError(f"Layer fraction {field} is outside of [0, 1]")
+        return frac
+
+    all_layers = list(range(num_layers))
+    layers = set()
+    for part in spec:
+        fields = part.split(":")
+        if len(fields) == 1 and "." in part:
+            layers.add(min(round(fraction(part) * num_layers), num_layers - 1))
+        elif len(fields) == 1:
+            layers.add(all_layers[int(part)])
+        elif any("." in f for f in fields[:2]):
+            lo, hi = (fraction(f) if f else d for f, d in zip(fields[:2], (0.0, 1.0)))
+            step = int(fields[2]) if len(fields) > 2 and fields[2] else 1
+            layers.update(
+                all_layers[round(lo * num_layers) : round(hi * num_layers)][::step]
+            )
+        else:
+            start, stop, step = (
+                int(f) if f else None for f in fields + [""] * (3 - len(fields))
+            )
+            layers.update(all_layers[start:stop:step])
+
+    return sorted(layers)
+
+
+def repeat_past_key_values(past_key_values, repeats: int):
+    """Repeat each row of a KV cache `repeats` times along the batch dimension.
+
+    The cache is a `transformers.Cache` and is modified in place, so the original
+    cache should not be reused.
+    """
+    past_key_values.batch_repeat_interleave(repeats)
+    return past_key_values
+
+
+class PrefixCache:
+    """KV caches of prompt prefixes that are shared by many examples.
+
+    Each prefix is run through the model once, and every batch of examples that
+    starts with it continues from a copy of its cache. Only the `max_size` most
+    recently used prefixes are kept.
+    """
+
+    def __init__(self, max_size: int = 4):
+        self.max_size = max_size
+        self._caches: OrderedDict[tuple[int, ...], Any] = OrderedDict()
+
+    @torch.inference_mode()
+    def get(self, model: PreTrainedModel, prefix: list[int], batch_size: int):
+        """Get a KV cache of `prefix` repeated `batch_size` times along the batch.
+
+        The returned cache is a copy, so the caller may extend it.
+        """
+        key = tuple(prefix)
+        if key in self._caches:
+            self._caches.move_to_end(key)
+        else:
+            outputs = model(torch.as_tensor([prefix], device=model.device))
+            self._caches[key] = outputs.past_key_values
+            while len(self._caches) > self.max_size:
+                self._caches.popitem(last=False)
+
+        return repeat_past_key_values(copy.deepcopy(self._caches[key]), batch_size)
+
+
+class StopForward(Exception):
+    """Raised from a forward hook to skip the rest of the model."""
+
+
+@contextmanager
+def capture_states(
+    model: PreTrainedModel,
+    layers: list[int],
+    select: Callable[[Tensor], Any],
+    stop_early: bool = False,
+):
+    """Capture a selection of the output states of the given transformer blocks.
+
+    Yields a dict mapping each layer index to `select(state)`, where `state` is the
+    [B, T, d] output of the block, filled in while the model runs inside the `with`
+    block. Selecting inside the hook means only the selected states are kept. The
+    last layer is read after the final norm, matching `hidden_states[-1]` of
+    `output_hidden_states=True`. If `stop_early` is set, the forward pass is aborted
+    once the deepest requested layer has run, which is only safe when the model
+    outputs (e.g. logits) aren't needed.
+    """
+    blocks = get_decoder_layers(model)
+    last = max(layers)
+    captured: dict[int, Any] = {}
+
+    def make_hook(layer: int):
+        def hook(module, args, output):
+            state = output[0] if isinstance(output, tuple) else output
+            captured[layer] = select(state)
+            if stop_early and layer == last:
+                raise StopForward
+
+        return hook
+
+    handles = [
+        (
+            get_final_norm(model) if layer == len(blocks) - 1 else blocks[layer]
+        ).register_forward_hook(make_hook(layer))
+        for layer in layers
+    ]
+    try:
+        yield captured
+    except StopForward:
+        pass
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+@contextmanager
+def capture_last_states(
+    model: PreTrainedModel, layers: list[int], stop_early: bool = False
+):
+    """Capture the last token's output state of the given transformer blocks.
+
+    Yields a dict mapping each layer index to a [B, d] tensor. See `capture_states`.
+    """
+    with capture_states(
+        model, layers, lambda state: state[:, -1, :].clone(), stop_early
+    ) as captured:
+        yield captured
@@ -0,0 +1,80 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, TypeVar
+
+In, Out = TypeVar("In"), TypeVar("Out")
+
+
+def prefetch(
+    fn: Callable[[In], Out], items: Iterable[In], depth: int = 2
+) -> Iterator[Out]:
+    """Yield `fn(item)` for each item, computed up to `depth` items ahead on a thread.
+
+    This overlaps Python-side preprocessing, e.g. tokenization, with the consumer's
+    work, e.g. running the model, which releases the GIL. Results are yielded in
+    order, and an exception raised by `fn` is re-raised when its result is reached.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending: deque[Future] = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) > depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class OrderedWriter:
+    """Run tasks, e.g. disk writes, one at a time in order on a background thread.
+
+    At most `max_pending` tasks are queued, after which `submit` waits for the oldest
+    one, so a slow disk applies backpressure instead of buffering without bound. An
+    exception raised by a task is re-raised by the `submit` or `join` that waits on
+    it, and the tasks after it are skipped, so that e.g. a chunk is never marked as
+    done after one of its writes failed. Use as a context manager to wait for all
+    tasks on exit.
+    """
+
+    def __init__(self, max_pending: int = 8):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: deque[Future] = deque()
+        self._failed = False
+
+    def _run(self, fn: Callable, args, kwargs):
+        if self._failed:
+            return
+        try:
+            fn(*args, **kwargs)
+        except BaseException:
+            self._failed = True
+            raise
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        self._pending.append(self._executor.submit(self._run, fn, args, kwargs))
+        # check finished tasks for errors without waiting on unfinished ones
+        while self._pending and (
+            len(self._pending) > self.max_pending or self._pending[0].done()
+        ):
+            self._pending.popleft().result()
+
+    def join(self):
+        """Wait for every submitted task to finish."""
+        while self._pending:
+            self._pending.popleft().result()
+
+    def close(self):
+        try:
+            self.join()
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+
+    def __enter__(self) -> "OrderedWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,93 @@
+import json
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+
+
+class StageTimer:
+    """Cumulative wall time and call counts of named stages, plus event counters.
+
+    Stages may run on several threads at once, e.g. tokenization ahead of the model
+    and writes behind it, so the stage times can add up to more than the wall time.
+    CUDA kernels run asynchronously, so with `cuda_sync` the device is synchronized
+    at the end of every stage, which attributes GPU time to the stage that launched
+    it at the cost of some overlap.
+    """
+
+    def __init__(self, cuda_sync: bool = False):
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.seconds: defaultdict[str, float] = defaultdict(float)
+        self.calls: defaultdict[str, int] = defaultdict(int)
+        self.counts: defaultdict[str, int] = defaultdict(int)
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.cuda_sync:
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.seconds[name] += elapsed
+                self.calls[name] += 1
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counts[name] += n
+
+    def summary(self) -> dict:
+        """Get the stage times, counters and peak memory use so far."""
+        with self._lock:
+            stages = {
+                name: dict(seconds=seconds, calls=self.calls[name])
+                for name, seconds in self.seconds.items()
+            }
+            counts = dict(self.counts)
+        return dict(
+            wall_time=time.perf_counter() - self.start_time,
+            stages=stages,
+            counts=counts,
+            # ru_maxrss is in KiB on Linux
+            peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            peak_cuda_mb=(
+                torch.cuda.max_memory_allocated() / 2**20
+                if torch.cuda.is_available()
+                else None
+            ),
+        )
+
+    def save(self, path: str | Path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def merge_timings(summaries: list[dict]) -> dict:
+    """Combine the `StageTimer.summary` of processes that ran side by side, e.g. the
+    shards of an extraction. Times and counts are summed, except for the wall time
+    and peak memory, which are the maximum over processes."""
+    stages = defaultdict(lambda: dict(seconds=0.0, calls=0))
+    counts = defaultdict(int)
+    for summary in summaries:
+        for name, stage in summary["stages"].items():
+            stages[name]["seconds"] += stage["seconds"]
+            stages[name]["calls"] += stage["calls"]
+        for name, n in summary["counts"].items():
+            counts[name] += n
+
+    peak_cuda = [s["peak_cuda_mb"] for s in summaries if s["peak_cuda_mb"] is not None]
+    return dict(
+        wall_time=max(s["wall_time"] for s in summaries),
+        stages=dict(stages),
+        counts=dict(counts),
+        peak_rss_mb=max(s["peak_rss_mb"] for s in summaries),
+        peak_cuda_mb=max(peak_cuda) if peak_cuda else None,
+    )
@@ -7,7 +7,9 @@ import numpy as np
 import pandas as pd
 import torch
 from sklearn.metrics import accuracy_score, roc_auc_score
+from transformers import AutoConfig
 
+from elk_generalization.elk.hidden_store import model_layers, stored_layers
 from elk_generalization.utils import get_quirky_model_name
 
 
@@ -108,18 +110,29 @@ def get_result_dfs(
             else:
                 raise ValueError(f"Unknown filter_by: {filter_by}")
 
+            # only a subset of layers may have been extracted, so fractions are of
+            # the model's depth rather than of the last extracted layer
+            layers = stored_layers(results_dir) or list(range(len(reporter_log_odds)))
+            assert len(layers) == len(reporter_log_odds)
+            num_layers = model_layers(results_dir)
+            if num_layers is None:
+                num_layers = (
+                    len(layers)
+                    if layers == list(range(len(layers)))
+                    else AutoConfig.from_pretrained(base_model).num_hidden_layers
+                )
             results_dfs[(base_model, ds_name)] = pd.DataFrame(
                 [
                     {
                         # start with layer 1, embedding layer is skipped
-                        "layer": i + 1,
-                        # max layer is len(reporter_log_odds)
-                        "layer_frac": (i + 1) / len(reporter_log_odds),
+                        "layer": layer + 1,
+                        "layer_frac": (layer + 1) / num_layers,
+                        "num_layers": num_layers,
                         metric: metric_fn(
                             other_cols[label_col][mask], layer_log_odds[mask]
                         ),
                     }
-                    for i, layer_log_odds in enumerate(reporter_log_odds)
+                    for layer, layer_log_odds in zip(layers, reporter_log_odds)
                 ]
             )
             lm_results[(base_model, ds_name)] = metric_fn(
@@ -131,6 +144,7 @@ def get_result_dfs(
         layers_all=[v["layer"].values for v in results_dfs.values()],
         results_all=[v[metric].values for v in results_dfs.values()],
         names=[k for k in results_dfs],
+        num_layers_all=[v["num_layers"].iloc[0] for v in results_dfs.values()],
     )
     avg_lm_result = float(np.nanmean(list(lm_results.values())))
     avg_reporter_results = pd.DataFrame(
@@ -152,6 +166,11 @@ def get_result_dfs(
                 v[metric].values for k, v in results_dfs.items() if k[1] == ds_name
             ],
             names=[k for k in results_dfs if k[1] == ds_name],
+            num_layers_all=[
+                v["num_layers"].iloc[0]
+                for k, v in results_dfs.items()
+                if k[1] == ds_name
+            ],
         )
         per_ds_results[ds_name] = pd.DataFrame(
             {
@@ -173,21 +192,26 @@ def get_result_dfs(
     )
 
 
-def interpolate(layers_all, results_all, names, n_points=501):
+def interpolate(layers_all, results_all, names, n_points=501, num_layers_all=None):
     # average these results over models and templates
     all_layer_fracs = np.linspace(0, 1, n_points)
     avg_reporter_results = np.zeros(len(all_layer_fracs), dtype=np.float32)
-    for layers, results, name in zip(layers_all, results_all, names):
+    if num_layers_all is None:
+        # the results cover every layer, up to the max layer in results_df
+        num_layers_all = [layers.max() for layers in layers_all]
+    for layers, results, name, num_layers in zip(
+        layers_all, results_all, names, num_layers_all
+    ):
         if np.isnan(results).any():
             print(f"Skipping {name} because it has NaN results")
             continue
-        # convert `layer` to a fraction of max layer in results_df
+        # convert `layer` to a fraction of the model's layers
         # linearly interpolate to get auroc at each layer_frac
-        max_layer = layers.max()
-        layer_fracs = layers / max_layer
+        layer_fracs = layers / num_layers
         assert np.all(np.diff(layer_fracs) > 0)  # interp requires strictly increasing
 
-        interp_result = np.interp(all_layer_fracs, layer_fracs, results)
+        # deeper than the last extracted layer there are no results
+        interp_result = np.interp(all_layer_fracs, layer_fracs, results, right=np.nan)
         avg_reporter_results += interp_result / len(results_all)
 
     return all_layer_fracs, avg_reporter_results
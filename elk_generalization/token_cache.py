@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from datasets import Dataset
+
+# Set to an empty string to disable caching
+TOKEN_CACHE_DIR = os.environ.get(
+    "ELK_TOKEN_CACHE", os.path.expanduser("~/.cache/elk_generalization/tokens")
+)
+
+warned_about_choices = set()
+
+
+def encode_choice(text, tokenizer):
+    global warned_about_choices
+
+    c_ids = tokenizer.encode(text, add_special_tokens=False)
+
+    # some tokenizers split off the leading whitespace character
+    if tokenizer.decode(c_ids[0]).strip() == "":
+        c_ids = c_ids[1:]
+        assert c_ids == tokenizer.encode(text.lstrip(), add_special_tokens=False)
+
+    c_ids = tuple(c_ids)
+    if len(c_ids) != 1 and c_ids not in warned_about_choices:
+        warned_about_choices.add(c_ids)
+        print(f"Choice should be one token: {c_ids} -> {tokenizer.decode(c_ids)}")
+    return c_ids[0]
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """Hash everything about a tokenizer that affects how it encodes text.
+
+    For fast tokenizers that is the serialized backend, which includes the vocab,
+    merges, normalizer and post-processor (e.g. whether BOS is added). Paths and
+    names are left out, so copies of a tokenizer in different places share a hash.
+    """
+    h = hashlib.sha256(type(tokenizer).__name__.encode())
+    if tokenizer.is_fast:
+        h.update(tokenizer.backend_tokenizer.to_str().encode())
+    else:
+        h.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    init_kwargs = {
+        k: v
+        for k, v in tokenizer.init_kwargs.items()
+        if not k.endswith("_file") and k != "name_or_path"
+    }
+    h.update(json.dumps(init_kwargs, sort_keys=True, default=str).encode())
+    h.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+@dataclass
+class StatementTokens:
+    """Token ids of the statements and choices of a templatized dataset.
+
+    Per-token arrays hold the tokens of all rows back to back, with the tokens of row
+    `i` at `row_starts[i]:row_starts[i + 1]`.
+    """
+
+    # [n] number of tokens of each statement
+    lengths: np.ndarray
+    # [N] token ids of every statement, with special tokens like BOS
+    input_ids: np.ndarray
+    # [N] whether each token is a special token
+    special_tokens_mask: np.ndarray
+    # [N, 2] character span of each token in its statement, or None for slow tokenizers
+    offset_mapping: np.ndarray | None
+    # [n, 2] id of each choice on its own, see `encode_choice`
+    choice_ids: np.ndarray
+    # [n, 2] id of the first token of each choice when appended to the statement
+    context_choice_ids: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    @property
+    def row_starts(self) -> np.ndarray:
+        return np.concatenate([[0], np.cumsum(self.lengths)])
+
+    def select(self, rows) -> "StatementTokens":
+        """Get the tokens of a subset of rows, in the given order."""
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.row_starts
+        tokens = np.concatenate(
+            [np.arange(starts[r], starts[r + 1]) for r in rows] or [np.arange(0)]
+        )
+        return StatementTokens(
+            lengths=self.lengths[rows],
+            input_ids=self.input_ids[tokens],
+            special_tokens_mask=self.special_tokens_mask[tokens],
+            offset_mapping=(
+                None if self.offset_mapping is None else self.offset_mapping[tokens]
+            ),
+            choice_ids=self.choice_ids[rows],
+            context_choice_ids=self.context_choice_ids[rows],
+        )
+
+    def prompts(self) -> list[list[int]]:
+        """The token ids of each statement, as lists."""
+        if not len(self):
+            return []
+        return [ids.tolist() for ids in np.split(self.input_ids, self.row_starts[1:-1])]
+
+    def save(self, path: str | Path):
+        """Write the tokens to the file `path`, replacing it atomically."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        arrays = {k: v for k, v in vars(self).items() if v is not None}
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str | Path) -> "StatementTokens":
+        with np.load(path) as arrays:
+            fields = {k: arrays[k] for k in arrays.files}
+        fields.setdefault("offset_mapping", None)
+        return cls(**fields)
+
+
+def tokenize_statements(
+    tokenizer, dataset: Dataset, batch_size: int = 1024
+) -> StatementTokens:
+    """Tokenize the statements and choices of a templatized dataset.
+
+    Statements are encoded in batches, which fast tokenizers parallelize. Each
+    distinct choice is encoded once with `encode_choice`. The first token of each
+    choice in the context of its statement, which is what fine-tuning computes the
+    loss on, is read off the encoding of the statement followed by the choice.
+    """
+    lengths, input_ids, special_tokens_mask, offset_mapping = [], [], [], []
+    context_choice_ids = []
+    for start in range(0, len(dataset), batch_size):
+        batch = dataset[start : start + batch_size]
+        encodings = tokenizer(
+            batch["statement"],
+            return_special_tokens_mask=True,
+            return_offsets_mapping=tokenizer.is_fast,
+        )
+        continued = tokenizer(
+            [
+                s + c
+                for s, choices in zip(batch["statement"], batch["choices"])
+                for c in choices
+            ]
+        )["input_ids"]
+        for i, ids in enumerate(encodings["input_ids"]):
+            lengths.append(len(ids))
+            input_ids.extend(ids)
+            special_tokens_mask.extend(encodings["special_tokens_mask"][i])
+            if tokenizer.is_fast:
+                offset_mapping.extend(encodings["offset_mapping"][i])
+            context_choice_ids.append(
+                [continued[2 * i][len(ids)], continued[2 * i + 1][len(ids)]]
+            )
+
+    all_choices = dataset["choices"]
+    choice_to_id = {
+        c: encode_choice(c, tokenizer) for c in {c for cs in all_choices for c in cs}
+    }
+    choice_ids = [[choice_to_id[c] for c in choices] for choices in all_choices]
+    return StatementTokens(
+        lengths=np.array(lengths, dtype=np.int64),
+        input_ids=np.array(input_ids, dtype=np.int32),
+        special_tokens_mask=np.array(special_tokens_mask, dtype=np.int8),
+        offset_mapping=(
+            np.array(offset_mapping, dtype=np.int32).reshape(-1, 2)
+            if tokenizer.is_fast
+            else None
+        ),
+        choice_ids=np.array(choice_ids, dtype=np.int64).reshape(-1, 2),
+        context_choice_ids=np.array(context_choice_ids, dtype=np.int64).reshape(-1, 2),
+    )
+
+
+def cached_tokenize(
+    tokenizer,
+    dataset: Dataset,
+    template_method: str,
+    cache_dir: str | Path | None = TOKEN_CACHE_DIR,
+) -> StatementTokens:
+    """Tokenize a templatized dataset, reusing the result of an earlier call.
+
+    Results are stored in `cache_dir` under a key made from the tokenizer's
+    fingerprint (see `tokenizer_fingerprint`), the dataset's fingerprint, which
+    `datasets` updates with every transform like shuffling, filtering or
+    templatizing, and the templatization method. So every script that tokenizes the
+    same split with the same tokenizer shares one cache entry. Pass an empty
+    `cache_dir` to skip the cache.
+    """
+    if not cache_dir:
+        return tokenize_statements(tokenizer, dataset)
+
+    key = hashlib.sha256(
+        f"{tokenizer_fingerprint(tokenizer)}-{dataset._fingerprint}".encode()
+    ).hexdigest()[:32]
+    path = Path(cache_dir) / f"{template_method}-{key}.npz"
+    if path.exists():
+        tokens = StatementTokens.load(path)
+        if len(tokens) == len(dataset):
+            return tokens
+
+    tokens = tokenize_statements(tokenizer, dataset)
+    tokens.save(path)
+    return tokens
@@ -26,6 +26,8 @@ from elk_generalization.datasets.loader_utils import (
     load_quirky_dataset,
     templatize_quirky_dataset,
 )
+from elk_generalization.model_utils import default_device
+from elk_generalization.token_cache import cached_tokenize
 from elk_generalization.utils import assert_type
 
 
@@ -123,7 +125,7 @@ if __name__ == "__main__":
 
     model = AutoModelForCausalLM.from_pretrained(
         args.model,
-        device_map={"": torch.cuda.current_device()},
+        device_map={"": default_device()},
         token=args.token,
         # we can use bf16 if we're using lora because the base weights don't get updated
         torch_dtype=torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float32,
@@ -145,21 +147,24 @@ if __name__ == "__main__":
     train = balance(assert_type(Dataset, ds["train"]))
     val = balance(assert_type(Dataset, ds["validation"]))
 
-    model_short = args.model.split("/")[-1]
+    def add_token_columns(split: Dataset) -> Dataset:
+        # the ids of the statement and of the first token of each choice in its
+        # context, which is where loss is computed. The choice has to be encoded in
+        # the context of the statement bc of inconsistent behavior of some
+        # tokenizers (Llama, Mistral), see `tokenize_statements`.
+        tokens = cached_tokenize(tokenizer, split, args.method)
+        return split.add_column("statement_ids", tokens.prompts()).add_column(
+            "choice_ids", tokens.context_choice_ids.tolist()
+        )
 
-    def truncate_to_first_choice_id(statement, choice):
-        # We want only the first token of choice--this is where loss is computed
-        # Unfortunately the choice has to be encoded in the context of the
-        # statement bc of inconsistent behavior of some tokenizers (Llama, Mistral)
-        # So we duplicate work here, but it's fast.
-        s_toks = tokenizer.encode(statement)
-        full_toks = tokenizer.encode(statement + choice)
-        return full_toks[: len(s_toks) + 1]
+    train, val = add_token_columns(train), add_token_columns(val)
+
+    model_short = args.model.split("/")[-1]
 
     def format_fn(x):
         lst = [
-            tokenizer.decode(truncate_to_first_choice_id(s, choices[y]))
-            for s, choices, y in zip(x["statement"], x["choices"], x["label"])
+            tokenizer.decode(s_ids + [c_ids[y]])
+            for s_ids, c_ids, y in zip(x["statement_ids"], x["choice_ids"], x["label"])
         ]
         return lst
 
@@ -171,13 +176,7 @@ if __name__ == "__main__":
     # probabilities to compare between vary by example, so we disable accuracy
     # and AUROC logging in this case.
     # get the two unique choice first tokens, if they exist
-    unique_label_pairs = {
-        tuple(
-            truncate_to_first_choice_id(val[i]["statement"], c)[-1]
-            for c in val[i]["choices"]
-        )
-        for i in range(len(val))
-    }
+    unique_label_pairs = {tuple(c_ids) for c_ids in val["choice_ids"]}
     enable_accuracy_logging = len(unique_label_pairs) == 1
     if enable_accuracy_logging:
         unique_labels = list(unique_label_pairs.pop())  # get only item in set
@@ -243,7 +242,7 @@ if __name__ == "__main__":
         model=model,
         args=TrainingArguments(
             f"{args.output_dir}/{output_name}",
-            fp16=not torch.cuda.is_bf16_supported(),
+            fp16=torch.cuda.is_available() and not torch.cuda.is_bf16_supported(),
             gradient_accumulation_steps=args.accum_steps,
             learning_rate=2e-5,
             logging_steps=50,
@@ -0,0 +1,210 @@
+"""A long-lived process that runs extraction, intervention and transfer jobs.
+
+Starting a fresh Python process for every job means re-importing torch and
+transformers and reloading the model weights each time, which dominates the runtime
+of experiments on small datasets. A worker instead runs each job's `main` in-process
+and keeps the most recently used models loaded between jobs (see
+`model_utils.keep_models_resident`). Jobs are received over a local socket and run
+one at a time in the order they arrive.
+
+Start a worker with
+    ELK_WORKER_AUTHKEY=<secret> python -m elk_generalization.worker \
+        --address /tmp/elk_worker.sock
+and submit jobs with `Worker(address).run(script, argv)`, or let an orchestrator
+spawn its own worker with `Worker.spawn()`.
+
+Connections unpickle the jobs they receive, so anyone who can connect can run code
+in the worker. Clients therefore authenticate with a secret key: `Worker.spawn`
+makes a random one for its worker, and a worker started by hand, and its clients,
+read it from the ELK_WORKER_AUTHKEY environment variable, which must be set.
+"""
+
+import importlib
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from argparse import ArgumentParser
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from elk_generalization.model_utils import keep_models_resident
+
+# the scripts that jobs can run, each a module with `get_parser` and `main`
+SCRIPTS = {
+    "extract_hiddens": "elk_generalization.elk.extract_hiddens",
+    "transfer": "elk_generalization.elk.transfer",
+    "intervene": "elk_generalization.interventions.intervene",
+}
+
+SHUTDOWN = "shutdown"
+AUTHKEY_ENV = "ELK_WORKER_AUTHKEY"
+
+
+def _authkey() -> bytes:
+    key = os.environ.get(AUTHKEY_ENV)
+    if not key:
+        raise RuntimeError(
+            f"Set {AUTHKEY_ENV} to a secret shared by the worker and its clients, "
+            "e.g. the output of `python -c 'import secrets; print(secrets.token_hex())'`"
+        )
+    return key.encode()
+
+
+def parse_address(address: str) -> str | tuple[str, int]:
+    """Parse "host:port" into a TCP address; anything else is a Unix socket path."""
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def run_job(script: str, argv: list[str]):
+    """Run a script's `main` in this process, as if called with `argv`."""
+    module = importlib.import_module(SCRIPTS[script])
+    module.main(module.get_parser().parse_args(argv))
+
+
+def serve(address: str, max_models: int = 1):
+    """Run jobs sent to `address` until a shutdown message is received."""
+    keep_models_resident(max_models)
+
+    with Listener(parse_address(address), authkey=_authkey()) as listener:
+        print(f"Worker listening on {address}", flush=True)
+        while True:
+            try:
+                conn = listener.accept()
+            except AuthenticationError:
+                print("Rejected a client with the wrong key", flush=True)
+                continue
+            with conn:
+                job = conn.recv()
+                if job == SHUTDOWN:
+                    conn.send(dict(ok=True))
+                    break
+
+                script, argv = job
+                print(f"Running {script} {' '.join(argv)}", flush=True)
+                try:
+                    run_job(script, argv)
+                    conn.send(dict(ok=True))
+                # argparse exits on bad arguments, which shouldn't kill the worker
+                except (Exception, SystemExit):
+                    traceback.print_exc()
+                    conn.send(dict(ok=False, error=traceback.format_exc()))
+
+
+class Worker:
+    """Client for a worker process, optionally one that it spawned itself."""
+
+    def __init__(
+        self,
+        address: str,
+        process: subprocess.Popen | None = None,
+        authkey: bytes | None = None,
+    ):
+        self.address = address
+        self.process = process
+        self.authkey = authkey or _authkey()
+
+    @classmethod
+    def spawn(cls, env: dict[str, str] | None = None, max_models: int = 1) -> "Worker":
+        """Start a worker listening on a fresh Unix socket and wait until it's up.
+
+        Args:
+            env: Environment of the worker process, e.g. to set
+                CUDA_VISIBLE_DEVICES. Defaults to the current environment.
+            max_models: How many models the worker keeps loaded.
+        """
+        # the socket is in a directory only we can access, and only we know the key
+        address = os.path.join(tempfile.mkdtemp(prefix="elk_worker_"), "socket")
+        authkey = secrets.token_hex(32)
+        env = dict(os.environ if env is None else env, **{AUTHKEY_ENV: authkey})
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "elk_generalization.worker",
+                "--address",
+                address,
+                "--max-models",
+                str(max_models),
+            ],
+            env=env,
+        )
+        while not os.path.exists(address):
+            if process.poll() is not None:
+                raise RuntimeError(f"Worker exited with code {process.returncode}")
+            time.sleep(0.1)
+
+        return cls(address, process, authkey.encode())
+
+    def _send(self, message) -> dict:
+        with Client(parse_address(self.address), authkey=self.authkey) as conn:
+            conn.send(message)
+            return conn.recv()
+
+    def run(self, script: str, argv: list[str]) -> bool:
+        """Run a job on the worker and wait for it to finish.
+
+        Args:
+            script: One of `SCRIPTS`.
+            argv: Command line arguments for the script.
+
+        Returns:
+            Whether the job succeeded. Its output and any traceback are printed by
+            the worker.
+        """
+        assert script in SCRIPTS, f"Unknown script '{script}'"
+        return self._send((script, list(argv)))["ok"]
+
+    def close(self):
+        """Shut the worker down if we spawned it."""
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self._send(SHUTDOWN)
+        self.process.wait()
+        self.process = None
+
+    def __enter__(self) -> "Worker":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_script(
+    script: str,
+    argv: list[str],
+    worker: Worker | None = None,
+    env: dict[str, str] | None = None,
+):
+    """Run a job on `worker` if given, otherwise in a new Python process."""
+    print(f"Running {script} {' '.join(argv)}")
+    if worker is not None:
+        worker.run(script, argv)
+    else:
+        subprocess.run([sys.executable, "-m", SCRIPTS[script], *argv], env=env)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Run jobs with the model kept loaded.")
+    parser.add_argument(
+        "--address",
+        type=str,
+        required=True,
+        help="Unix socket path or host:port to listen on",
+    )
+    parser.add_argument(
+        "--max-models",
+        type=int,
+        default=1,
+        help="Number of models to keep loaded between jobs",
+    )
+    args = parser.parse_args()
+
+    serve(args.address, args.max_models)
@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from elk_generalization.elk.benchmark import (
+    ARCHS,
+    make_config,
+    make_dataset,
+    make_tokenizer,
+)
+
+
+@pytest.fixture(scope="session")
+def dataset_path(tmp_path_factory):
+    """A quirky addition dataset with 24 rows in each split."""
+    return make_dataset(tmp_path_factory.mktemp("data"), 24)
+
+
+@pytest.fixture(scope="session")
+def model_path(tmp_path_factory, dataset_path):
+    """A tiny random Llama model and its tokenizer, saved like a hub checkpoint."""
+    tokenizer = make_tokenizer(dataset_path)
+    path = tmp_path_factory.mktemp("models") / "tiny-llama"
+    torch.manual_seed(0)
+    ARCHS["llama"][1](make_config("llama", "tiny", len(tokenizer))).save_pretrained(
+        path
+    )
+    tokenizer.save_pretrained(path)
+    return path
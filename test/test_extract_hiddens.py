@@ -0,0 +1,176 @@
+import json
+
+import pytest
+import torch
+
+from elk_generalization.elk.benchmark import ARCHS, make_config
+from elk_generalization.elk.extract_hiddens import extract_batch, get_parser, main
+from elk_generalization.elk.hidden_stats import STATS_META, HiddenStats
+from elk_generalization.elk.hidden_store import STORE_META, ChunkManifest
+from elk_generalization.model_utils import PrefixCache
+
+LAYERS = [0, 1, 3]
+
+
+def make_model(arch: str):
+    torch.manual_seed(0)
+    return ARCHS[arch][1](make_config(arch, "tiny", vocab_size=100)).eval()
+
+
+def token_ranges(prompts: list[list[int]], start: int = 0):
+    """The last token of each prompt, and all of its tokens from `start` on."""
+    return dict(
+        last=[(len(p) - 1, len(p)) for p in prompts],
+        all=[(start, len(p)) for p in prompts],
+    )
+
+
+def assert_same_outputs(outputs, expected):
+    """Check that the outputs of `extract_batch` match those of running each row
+    alone, given as a list with one set of outputs per row."""
+    hiddens, ccs_hiddens, log_odds = outputs
+    for position, states in hiddens.items():
+        for idx, state in enumerate(states):
+            torch.testing.assert_close(
+                state,
+                torch.cat([row[0][position][idx] for row in expected]),
+                atol=1e-5,
+                rtol=1e-5,
+            )
+    for idx, state in enumerate(ccs_hiddens):
+        torch.testing.assert_close(
+            state, torch.cat([row[1][idx] for row in expected]), atol=1e-5, rtol=1e-5
+        )
+    torch.testing.assert_close(
+        log_odds, torch.cat([row[2] for row in expected]), atol=1e-5, rtol=1e-5
+    )
+
+
+@pytest.mark.parametrize("arch", list(ARCHS))
+def test_batched_matches_unbatched(arch):
+    model = make_model(arch)
+    prompts = [torch.randint(1, 100, [n]).tolist() for n in [7, 3, 12, 12, 5]]
+    choice_toks = torch.randint(1, 100, [len(prompts), 2]).tolist()
+
+    outputs = extract_batch(
+        model, prompts, choice_toks, LAYERS, token_ranges=token_ranges(prompts)
+    )
+    expected = [
+        extract_batch(model, [p], [c], LAYERS, token_ranges=token_ranges([p]))
+        for p, c in zip(prompts, choice_toks)
+    ]
+    assert_same_outputs(outputs, expected)
+
+
+@pytest.mark.parametrize("arch", list(ARCHS))
+def test_shared_prefix_matches_unshared(arch):
+    model = make_model(arch)
+    prefix = torch.randint(1, 100, [9]).tolist()
+    rests = [torch.randint(1, 100, [n]).tolist() for n in [4, 1, 6, 6]]
+    prompts = [prefix + rest for rest in rests]
+    choice_toks = torch.randint(1, 100, [len(prompts), 2]).tolist()
+
+    outputs = extract_batch(
+        model,
+        rests,
+        choice_toks,
+        LAYERS,
+        prefix_past_key_values=PrefixCache().get(model, prefix, len(rests)),
+        prefix_len=len(prefix),
+        token_ranges=token_ranges(prompts, len(prefix)),
+    )
+    # the prefix's states are in its cache, so only the tokens after it are gathered
+    expected = [
+        extract_batch(
+            model, [p], [c], LAYERS, token_ranges=token_ranges([p], len(prefix))
+        )
+        for p, c in zip(prompts, choice_toks)
+    ]
+    assert_same_outputs(outputs, expected)
+
+
+def extract(model_path, dataset_path, save_path, *extra_args: str):
+    args = get_parser().parse_args(
+        [
+            "--model",
+            str(model_path),
+            "--dataset",
+            str(dataset_path),
+            "--save-path",
+            str(save_path),
+            "--templatization-method",
+            "first",
+            "--max-examples",
+            "24",
+            "--splits",
+            "validation",
+            "--device",
+            "cpu",
+            *extra_args,
+        ]
+    )
+    main(args)
+    return save_path / "validation"
+
+
+def content_hashes(root) -> dict[str, str]:
+    """The content hash of each store or of the statistics in `root`."""
+    hashes = {}
+    for meta in [*root.glob(f"*/{STORE_META}"), *root.glob(f"*/{STATS_META}")]:
+        with open(meta) as f:
+            hashes[meta.parent.name] = json.load(f)["content_hash"]
+    return hashes
+
+
+@pytest.mark.parametrize("stats_only", [False, True])
+def test_resume_after_crash_matches_uninterrupted(
+    model_path, dataset_path, tmp_path, monkeypatch, stats_only
+):
+    extra_args = ["--chunk-size", "8", *(["--stats-only"] if stats_only else [])]
+    expected = extract(model_path, dataset_path, tmp_path / "clean", *extra_args)
+
+    # stop after the first chunk is committed and the second is written
+    commit, calls = ChunkManifest.commit, []
+
+    def crash_on_second_commit(self, start, end):
+        calls.append(start)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        commit(self, start, end)
+
+    monkeypatch.setattr(ChunkManifest, "commit", crash_on_second_commit)
+    with pytest.raises(KeyboardInterrupt):
+        extract(model_path, dataset_path, tmp_path / "resumed", *extra_args)
+    monkeypatch.setattr(ChunkManifest, "commit", commit)
+    resumed = extract(model_path, dataset_path, tmp_path / "resumed", *extra_args)
+
+    assert content_hashes(resumed) == content_hashes(expected) != {}
+    for name in ["labels", "lm_log_odds"]:
+        torch.testing.assert_close(
+            torch.load(resumed / f"{name}.pt"), torch.load(expected / f"{name}.pt")
+        )
+
+
+@pytest.mark.parametrize("stats_only", [False, True])
+def test_sharded_matches_unsharded(model_path, dataset_path, tmp_path, stats_only):
+    extra_args = ["--stats-only"] if stats_only else []
+    expected = extract(model_path, dataset_path, tmp_path / "unsharded", *extra_args)
+    sharded = extract(
+        model_path, dataset_path, tmp_path / "sharded", "--num-shards", "2", *extra_args
+    )
+
+    if stats_only:
+        # the statistics of each shard are merged, which reorders the float sums
+        merged = HiddenStats.load(sharded / "stats")
+        stats = HiddenStats.load(expected / "stats")
+        assert merged.num_rows == stats.num_rows
+        torch.testing.assert_close(merged.class_counts, stats.class_counts)
+        for name in ["means", "scatters", "class_sums"]:
+            for a, b in zip(getattr(merged, name), getattr(stats, name)):
+                torch.testing.assert_close(a, b)
+    else:
+        assert content_hashes(sharded) == content_hashes(expected) != {}
+    for name in ["labels", "lm_log_odds"]:
+        torch.testing.assert_close(
+            torch.load(sharded / f"{name}.pt"), torch.load(expected / f"{name}.pt")
+        )
@@ -0,0 +1,109 @@
+import json
+import os
+
+import pytest
+import torch
+
+from elk_generalization.elk import hidden_store
+from elk_generalization.elk.hidden_store import (
+    HiddenStore,
+    hiddens_fingerprint,
+    open_hiddens,
+)
+
+
+def make_store(path, num_rows: int = 10, num_layers: int = 2, hidden_size: int = 4):
+    states = torch.randn(num_layers, num_rows, hidden_size)
+    store = HiddenStore.create(
+        path, num_rows, list(range(num_layers)), (hidden_size,), torch.float32
+    )
+    store.write(0, list(states))
+    store.close()
+    return store, states
+
+
+def crash_convert(store: HiddenStore, monkeypatch):
+    """Convert `store` to float16, stopping between moving it away and moving the
+    converted store in."""
+    replace, calls = os.replace, []
+
+    def crash_on_second_rename(src, dst):
+        calls.append(src)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        replace(src, dst)
+
+    monkeypatch.setattr(hidden_store.os, "replace", crash_on_second_rename)
+    with pytest.raises(KeyboardInterrupt):
+        store.convert("float16")
+    monkeypatch.setattr(hidden_store.os, "replace", replace)
+
+
+def test_convert_recovers_from_crash_between_renames(tmp_path, monkeypatch):
+    store, states = make_store(tmp_path / "hiddens")
+    crash_convert(store, monkeypatch)
+    assert not (tmp_path / "hiddens").exists()
+
+    # the converted store was complete, so opening the store finishes the swap
+    hiddens = open_hiddens(tmp_path)
+    assert hiddens.dtype == "float16"
+    assert not (tmp_path / "hiddens.old").exists()
+    for idx in range(len(hiddens)):
+        torch.testing.assert_close(hiddens[idx], states[idx].half())
+
+
+def test_convert_rolls_back_without_complete_conversion(tmp_path, monkeypatch):
+    store, states = make_store(tmp_path / "hiddens")
+    crash_convert(store, monkeypatch)
+    meta_path = tmp_path / "hiddens.convert" / hidden_store.STORE_META
+    meta_path.write_text(
+        meta_path.read_text().replace('"complete": true', '"complete": false')
+    )
+
+    # without a complete conversion the original store is moved back
+    hiddens = open_hiddens(tmp_path)
+    assert hiddens.dtype == "float32"
+    for idx in range(len(hiddens)):
+        torch.testing.assert_close(hiddens[idx], states[idx])
+
+
+def make_view(root, rows: list[int]):
+    """Make `root / "view"` a view of the given rows of the extraction in `root`."""
+    num_rows = HiddenStore(root / "hiddens").num_rows
+    for name in hidden_store.ROW_FILES:
+        torch.save(torch.zeros(num_rows), root / f"{name}.pt")
+    with open(root / hidden_store.ROW_METADATA, "w") as f:
+        json.dump(dict(difficulty=list(range(num_rows))), f)
+    hidden_store.write_view(root, root / "view", rows)
+    return root / "view"
+
+
+def test_fingerprint_uses_hash_recorded_on_close(tmp_path, monkeypatch):
+    store, _ = make_store(tmp_path / "hiddens")
+    assert store.content_hash == HiddenStore(tmp_path / "hiddens").content_hash
+    view = make_view(tmp_path, [1, 3])
+    fingerprints = [hiddens_fingerprint(tmp_path), hiddens_fingerprint(view)]
+
+    def read_states(*args):
+        raise AssertionError("Fingerprinting a closed store read its states")
+
+    monkeypatch.setattr(HiddenStore, "hash_rows", read_states)
+    assert fingerprints == [hiddens_fingerprint(tmp_path), hiddens_fingerprint(view)]
+    assert fingerprints[0] != fingerprints[1]
+
+
+def test_fingerprint_without_recorded_hash_covers_view_rows(tmp_path):
+    store, states = make_store(tmp_path / "hiddens")
+    meta_path = tmp_path / "hiddens" / hidden_store.STORE_META
+    meta_path.write_text(meta_path.read_text().replace('"content_hash"', '"unused"'))
+    view = make_view(tmp_path, [1, 3])
+    fingerprint = hiddens_fingerprint(view)
+
+    # rows outside the view don't change its fingerprint, but rows inside do
+    store = HiddenStore(tmp_path / "hiddens", mode="r+")
+    store.write(0, list(states[:, :1] + 1))
+    store.flush()
+    assert hiddens_fingerprint(view) == fingerprint
+    store.write(3, list(states[:, 3:4] + 1))
+    store.flush()
+    assert hiddens_fingerprint(view) != fingerprint
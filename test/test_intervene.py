@@ -0,0 +1,58 @@
+import torch
+from transformers import LlamaForCausalLM
+
+from elk_generalization.batching import plan_batches
+from elk_generalization.elk.benchmark import make_config
+from elk_generalization.interventions.intervene import compute_probs
+from elk_generalization.model_utils import PrefixCache, get_decoder_layers
+
+
+def test_negation_matches_unbatched_baseline():
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(make_config("llama", "tiny", vocab_size=100)).eval()
+    prompts = [torch.randint(1, 100, [n]).tolist() for n in [5, 9, 9, 12, 3, 7]]
+    choice_toks = [[1, 2]] * len(prompts)
+    mean_act = torch.randn(1, 64)
+    unit_weight = torch.randn(64, 1)
+    unit_weight /= unit_weight.norm()
+    layer = get_decoder_layers(model)[1]
+
+    def reflect(last):
+        ctrd = last - mean_act
+        return ctrd - 2 * (ctrd @ unit_weight) * unit_weight.T + mean_act
+
+    def negate_truth(hiddens, attention_mask):
+        hiddens.copy_(
+            torch.where(
+                attention_mask[..., None].bool(),
+                reflect(hiddens[:, -1, :])[:, None, :],
+                hiddens,
+            )
+        )
+
+    # the original intervention, which ran one unpadded prompt at a time
+    def baseline_hook(module, args, outputs):
+        hiddens = outputs[0] if isinstance(outputs, tuple) else outputs
+        hiddens[-1] = reflect(hiddens[:, -1, :])
+
+    with torch.inference_mode():
+        probs = compute_probs(
+            model,
+            prompts,
+            choice_toks,
+            plan_batches(prompts, 0, max_batch_size=4),
+            0,
+            PrefixCache(),
+            edit_module=layer,
+            edit=negate_truth,
+        )
+        handle = layer.register_forward_hook(baseline_hook)
+        try:
+            expected = [
+                torch.softmax(model(torch.tensor([p])).logits[0, -1, [1, 2]], -1)[1]
+                for p in prompts
+            ]
+        finally:
+            handle.remove()
+
+    torch.testing.assert_close(torch.tensor(probs), torch.stack(expected))
@@ -0,0 +1,62 @@
+import pytest
+import torch
+from torch.nn.functional import binary_cross_entropy_with_logits as bce_with_logits
+
+from elk_generalization.elk.lr_classifier import LogisticRegression
+
+L2_PENALTY = 0.001
+
+
+def make_data(num_layers: int, n: int, d: int) -> tuple[torch.Tensor, torch.Tensor]:
+    torch.manual_seed(0)
+    y = torch.randint(0, 2, (n,))
+    x = torch.randn(num_layers, n, d, dtype=torch.float64)
+    # each layer separates the classes along a different direction, to a different
+    # degree
+    x += torch.randn(num_layers, 1, d, dtype=torch.float64) * (2 * y[:, None] - 1)
+    return x, y
+
+
+def objective(x: torch.Tensor, y: torch.Tensor, reporter: LogisticRegression):
+    """The objective `LogisticRegression.fit` minimizes, and its largest gradient."""
+    params = [p.detach().requires_grad_() for p in reporter.parameters()]
+    weight, bias = params
+    loss = bce_with_logits((x @ weight.T).squeeze(-1) + bias, y.to(x.dtype))
+    loss = loss + L2_PENALTY * weight.square().sum()
+    grads = torch.autograd.grad(loss, params)
+    return loss.item(), max(g.abs().max().item() for g in grads)
+
+
+@pytest.mark.parametrize("n, d", [(200, 10), (20, 50)])
+def test_fit_layers_lbfgs_reaches_per_layer_optimum(n, d):
+    x, y = make_data(3, n, d)
+    reporters = LogisticRegression.fit_layers(
+        x, y, l2_penalty=L2_PENALTY, solver="lbfgs"
+    )
+
+    for layer_x, reporter in zip(x, reporters):
+        expected = LogisticRegression(d, dtype=torch.float64)
+        expected.fit(layer_x, y, l2_penalty=L2_PENALTY, solver="lbfgs")
+        loss, max_grad = objective(layer_x, y, reporter)
+        # separable layers are badly conditioned, and torch's L-BFGS can stop short
+        assert loss <= objective(layer_x, y, expected)[0] + 1e-7
+        assert max_grad < 1e-5
+
+
+@pytest.mark.parametrize("solver", ["newton", "dual"])
+@pytest.mark.parametrize("n, d", [(200, 10), (20, 50)])
+def test_second_order_solvers_reach_per_layer_optimum(solver, n, d):
+    x, y = make_data(3, n, d)
+    reporters = LogisticRegression.fit_layers(
+        x, y, l2_penalty=L2_PENALTY, solver=solver
+    )
+
+    for layer_x, reporter in zip(x, reporters):
+        expected = LogisticRegression(d, dtype=torch.float64)
+        expected.fit(layer_x, y, l2_penalty=L2_PENALTY, solver="lbfgs")
+        single = LogisticRegression(d, dtype=torch.float64)
+        single.fit(layer_x, y, l2_penalty=L2_PENALTY, solver=solver)
+        for fit in [reporter, single]:
+            loss, max_grad = objective(layer_x, y, fit)
+            assert loss <= objective(layer_x, y, expected)[0] + 1e-7
+            assert max_grad < 1e-6
@@ -0,0 +1,21 @@
+import pytest
+
+from elk_generalization.model_utils import parse_layers
+
+
+def test_parse_layers():
+    assert parse_layers(None, 8) == list(range(8))
+    assert parse_layers(["-1", "::4"], 8) == [0, 4, 7]
+    assert parse_layers(["0.5:1.0:2"], 8) == [4, 6]
+    assert parse_layers([":0.25"], 8) == [0, 1]
+
+
+def test_parse_layers_single_fraction():
+    assert parse_layers(["0.5"], 8) == [4]
+    assert parse_layers(["0.0"], 8) == [0]
+    # the end of the depth is the last layer
+    assert parse_layers(["1.0"], 8) == [7]
+    assert parse_layers(["0.5", "-1"], 8) == [4, 7]
+
+    with pytest.raises(ValueError, match="outside of"):
+        parse_layers(["1.5"], 8)
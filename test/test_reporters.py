@@ -0,0 +1,75 @@
+import pytest
+import torch
+
+from elk_generalization.elk.classifier import resolve_signs
+from elk_generalization.elk.hidden_stats import LABEL_COLS, HiddenStats
+from elk_generalization.elk.lda import LdaReporter
+from elk_generalization.elk.mean_diff import MeanDiffReporter
+
+REPORTERS = [MeanDiffReporter, LdaReporter]
+
+
+def make_data(num_layers: int, n: int, d: int) -> tuple[torch.Tensor, torch.Tensor]:
+    torch.manual_seed(0)
+    y = torch.randint(0, 2, (n,))
+    x = torch.randn(num_layers, n, d) @ torch.randn(num_layers, d, d)
+    x += torch.randn(num_layers, 1, d) * y[:, None]
+    return x, y
+
+
+def direction(reporter) -> torch.Tensor:
+    """The unit direction the reporter scores rows along, including its sign."""
+    weight = reporter.linear.weight[0] * reporter.scale
+    return weight.detach().double() / weight.norm()
+
+
+@pytest.mark.parametrize("cls", REPORTERS)
+@pytest.mark.parametrize("n, d", [(200, 8), (20, 30)])
+def test_fit_from_stats_matches_fit(cls, n, d):
+    x, y = make_data(3, n, d)
+    stats = HiddenStats(list(range(len(x))), d)
+    # accumulate in uneven batches, like the chunks of an extraction
+    for start in range(0, n, 7):
+        batch_y = y[start : start + 7]
+        stats.update(
+            list(x[:, start : start + 7]), {col: batch_y for col in LABEL_COLS}
+        )
+
+    for idx, layer_x in enumerate(x):
+        expected = cls(d, device="cpu", dtype=torch.float32)
+        expected.fit(layer_x, y)
+        expected.resolve_sign(layer_x, y)
+        reporter = cls(d, device="cpu", dtype=torch.float32)
+        reporter.fit_from_stats(*stats.class_stats(idx, "labels"))
+        torch.testing.assert_close(
+            direction(reporter), direction(expected), atol=1e-4, rtol=1e-4
+        )
+
+
+@pytest.mark.parametrize("cls", REPORTERS)
+@pytest.mark.parametrize("n, d", [(200, 8), (20, 30)])
+def test_fit_layers_matches_per_layer_fit(cls, n, d):
+    x, y = make_data(3, n, d)
+    reporters = cls.fit_layers(x, y)
+
+    for layer_x, reporter in zip(x, reporters):
+        expected = cls(d, device="cpu", dtype=torch.float32)
+        expected.fit(layer_x, y)
+        expected.resolve_sign(layer_x, y)
+        torch.testing.assert_close(
+            direction(reporter), direction(expected), atol=1e-4, rtol=1e-4
+        )
+
+
+def test_resolve_signs_matches_per_layer():
+    x, y = make_data(8, 50, 4)
+    # random directions, so that about half of them need flipping
+    reporters = [MeanDiffReporter(4, device="cpu", dtype=torch.float32) for _ in x]
+    expected = [MeanDiffReporter(4, device="cpu", dtype=torch.float32) for _ in x]
+    for reporter, other, layer_x in zip(reporters, expected, x):
+        other.load_state_dict(reporter.state_dict())
+        other.resolve_sign(layer_x, y)
+
+    resolve_signs(reporters, x, y)
+    assert [r.scale.item() for r in reporters] == [r.scale.item() for r in expected]
+    assert {r.scale.item() for r in reporters} == {-1.0, 1.0}
@@ -0,0 +1,93 @@
+import pytest
+import torch
+
+from elk_generalization.elk import reporter_cache
+from elk_generalization.elk.hidden_store import HiddenStore
+from elk_generalization.elk.transfer import get_parser, main
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def write_split(root, num_rows: int, num_layers: int = 3, hidden_size: int = 8):
+    labels = torch.randint(0, 2, (num_rows,))
+    hiddens = torch.randn(num_layers, num_rows, hidden_size)
+    hiddens[..., 0] += 2 * labels
+
+    # stores are memory-mapped on the CPU and may hold a compact dtype
+    store = HiddenStore.create(
+        root / "hiddens",
+        num_rows,
+        list(range(num_layers)),
+        (hidden_size,),
+        torch.bfloat16,
+    )
+    store.write(0, list(hiddens.bfloat16()))
+    store.close()
+    torch.save(labels, root / "labels.pt")
+    torch.save(torch.randn(num_rows), root / "lm_log_odds.pt")
+
+
+def test_random_baseline(tmp_path):
+    torch.manual_seed(0)
+    train_dir, test_dir = tmp_path / "alice" / "validation", tmp_path / "test"
+    write_split(train_dir, 40)
+    write_split(test_dir, 30)
+
+    args = get_parser().parse_args(
+        [
+            "--train-dir",
+            str(train_dir),
+            "--test-dirs",
+            str(test_dir),
+            "--reporter",
+            "random",
+            "--device",
+            DEVICE,
+        ]
+    )
+    main(args)
+
+    aucs = torch.load(test_dir / "alice_random_aucs_against_labels.pt")
+    assert len(aucs) == 3
+    assert all(0 <= auc["mean"] <= 1 for auc in aucs)
+
+
+def run_transfer(train_dir, test_dir, reporter: str) -> dict:
+    """Run transfer and load the reporters and test results it writes."""
+    main(
+        get_parser().parse_args(
+            [
+                "--train-dir",
+                str(train_dir),
+                "--test-dirs",
+                str(test_dir),
+                "--reporter",
+                reporter,
+                "--device",
+                DEVICE,
+            ]
+        )
+    )
+    return {
+        f.name: torch.load(f)
+        for d in (train_dir, test_dir)
+        for f in d.glob(f"*{reporter}_*.pt")
+    }
+
+
+@pytest.mark.parametrize("reporter", ["lr", "mean-diff", "lda"])
+def test_cache_hit_matches_miss(tmp_path, monkeypatch, capsys, reporter):
+    torch.manual_seed(0)
+    train_dir, test_dir = tmp_path / "alice" / "validation", tmp_path / "test"
+    write_split(train_dir, 40)
+    write_split(test_dir, 30)
+    monkeypatch.setattr(reporter_cache, "REPORTER_CACHE_DIR", str(tmp_path / "cache"))
+
+    missed = run_transfer(train_dir, test_dir, reporter)
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+    assert "Using cached reporters" not in capsys.readouterr().out
+    hit = run_transfer(train_dir, test_dir, reporter)
+    assert "Using cached reporters" in capsys.readouterr().out
+
+    assert missed.keys() == hit.keys() and missed
+    torch.testing.assert_close(hit, missed)
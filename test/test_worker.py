@@ -0,0 +1,24 @@
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+import pytest
+
+from elk_generalization import worker
+from elk_generalization.worker import AUTHKEY_ENV, Worker, parse_address
+
+
+def test_worker_needs_an_explicit_key(monkeypatch):
+    monkeypatch.delenv(AUTHKEY_ENV, raising=False)
+    with pytest.raises(RuntimeError, match=AUTHKEY_ENV):
+        worker.serve("localhost:0")
+    with pytest.raises(RuntimeError, match=AUTHKEY_ENV):
+        Worker("/tmp/elk_worker.sock")
+
+
+def test_spawned_worker_rejects_other_keys(monkeypatch):
+    # the spawned worker makes its own key rather than using ours
+    monkeypatch.setenv(AUTHKEY_ENV, "guessed")
+    with Worker.spawn() as spawned:
+        with pytest.raises(AuthenticationError):
+            Client(parse_address(spawned.address), authkey=b"guessed")
+        assert not spawned.run("transfer", ["--reporter", "nonexistent"])